@@ -0,0 +1,272 @@
+"""Online backups of the database with SQLite's backup API
+
+Snapshots are copied a few pages at a time with a pause in between, so the bot
+keeps reading and writing while a backup runs. In WAL mode every step reads the
+same snapshot of the database, so writes in the meantime don't make the backup
+start over. Each snapshot is checked with PRAGMA integrity_check before it
+replaces the oldest one.
+
+Usage: python backup.py now|list|verify|restore [options]
+"""
+import argparse
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+class BackupAborted(Exception):
+    """The backup was stopped before it finished"""
+
+def check_snapshot(path):
+    """Returns whether the database file at path passes PRAGMA integrity_check"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchall() == [("ok",)]
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        conn.close()
+
+def restore(snapshot, dbname):
+    """Overwrite the database at dbname with a snapshot, after checking the snapshot
+    The bot must be stopped, or it keeps serving what it cached from before"""
+    if not check_snapshot(snapshot):
+        raise ValueError(f"{snapshot} fails the integrity check")
+
+    src = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    dst = sqlite3.connect(dbname)
+    try:
+        # All at once: nothing else should be using the database meanwhile
+        src.backup(dst)
+
+        # The snapshot is in rollback journal mode, the bot expects WAL
+        dst.execute("PRAGMA journal_mode = WAL")
+    finally:
+        src.close()
+        dst.close()
+
+class BackupScheduler:
+    """Backs up the database at dbname into directory every `interval` seconds, from a thread of its own
+    Copies `pages` pages per step and sleeps pause_ms milliseconds between steps, so a write never
+    waits on a backup for long. Keeps the `keep` newest snapshots, and skips a backup if nothing was
+    committed since the last one. observe(seconds, pages) is called after every backup"""
+    def __init__(self, dbname, directory, interval=3600, keep=7, pages=256, pause_ms=10, max_restarts=10, observe=None):
+        self.dbname = dbname
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.pages = pages
+        self.pause_ms = pause_ms
+        self.max_restarts = max_restarts
+        self.observe = observe
+
+        # Snapshots are named after the database, e.g. debt-20240131-235959-000000.sqlite
+        self.prefix = os.path.splitext(os.path.basename(dbname))[0]
+
+        # Kept open between backups, so PRAGMA data_version tells whether another connection committed since
+        self.source = None
+        self.version = None
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.backups = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_seconds = 0.0
+        self.last_pages = 0
+        self.last_restarts = 0
+        self.total_pages = 0
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def snapshots(self):
+        """Paths of the finished snapshots, oldest first"""
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory), f"{glob.escape(self.prefix)}-*.sqlite")))
+
+    def backup(self, force=False):
+        """Take a snapshot now, returning its path, or None if nothing changed since the last one"""
+        with self.lock:
+            if self.source is None:
+                os.makedirs(self.directory, exist_ok=True)
+
+                # Transactions are begun and ended by hand
+                self.source = sqlite3.connect(self.dbname, check_same_thread=False, isolation_level=None)
+                self.source.execute("PRAGMA query_only = ON")
+
+            # Commits that land from here on change the version again, so the next backup isn't skipped
+            version = self.source.execute("PRAGMA data_version").fetchone()[0]
+            if not force and version == self.version and self.snapshots():
+                self.skipped += 1
+                return None
+
+            return self._backup(version)
+
+    def _copy(self, dst, progress):
+        """Copy the database into dst, a step of self.pages pages at a time"""
+        # In WAL mode, a read transaction held over every step pins the snapshot being copied without
+        # blocking writers. Without WAL it would block them for the whole backup, so each step reads on its own.
+        # Checkpoints can't get past a pinned snapshot, so it is let go as soon as the copy is done
+        pin = self.source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if pin:
+            self.source.execute("BEGIN")
+            self.source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        try:
+            self.source.backup(dst, pages=self.pages, progress=progress)
+        finally:
+            if pin:
+                self.source.execute("ROLLBACK")
+
+    def _backup(self, version):
+
+        name = f"{self.prefix}-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S-%f')}.sqlite"
+        path = os.path.join(self.directory, name)
+        tmp = path + ".tmp"
+
+        # Pages copied over every step. Without a pinned snapshot, a write from another connection makes
+        # SQLite start over, which shows up as more pages remaining than after the step before
+        copied = 0
+        restarts = 0
+        remaining = None
+
+        def progress(status, left, total):
+            nonlocal copied, restarts, remaining
+            if remaining is not None and left > remaining:
+                restarts += 1
+                if restarts > self.max_restarts:
+                    raise BackupAborted(f"Restarted {restarts} times by concurrent writes")
+            copied += total - left if remaining is None or left > remaining else remaining - left
+            remaining = left
+
+            if self.stopping.is_set():
+                raise BackupAborted("Stopping")
+
+            # Leave the disk to the bot between steps. Without WAL, this is also when writers get in
+            time.sleep(self.pause_ms / 1000)
+
+        start = time.monotonic()
+        dst = sqlite3.connect(tmp)
+        try:
+            self._copy(dst, progress)
+
+            # A single file, without the -wal and -shm files of the source
+            dst.execute("PRAGMA journal_mode = DELETE")
+            dst.close()
+
+            if not check_snapshot(tmp):
+                raise sqlite3.DatabaseError(f"{tmp} fails the integrity check")
+
+            # Only finished, checked snapshots get a name snapshots() finds
+            os.replace(tmp, path)
+
+        except Exception:
+            # Being stopped isn't a failure of the backup
+            if not self.stopping.is_set():
+                self.failed += 1
+            dst.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        seconds = time.monotonic() - start
+        self.version = version
+        self.backups += 1
+        self.last_seconds = seconds
+        self.last_pages = copied
+        self.last_restarts = restarts
+        self.total_pages += copied
+        if self.observe:
+            self.observe(seconds, copied)
+
+        # Drop the oldest snapshots beyond the ones to keep
+        for old in self.snapshots()[:-self.keep]:
+            os.remove(old)
+
+        logging.info("Backed up %s to %s in %.2fs, %s pages copied, %s restarts", self.dbname, path, seconds, copied, restarts)
+        return path
+
+    def _run(self):
+        # Carry on the cadence of the snapshots already there, so restarting the bot doesn't delay the next one
+        snapshots = self.snapshots()
+        wait = max(0, self.interval - (time.time() - os.path.getmtime(snapshots[-1]))) if snapshots else 0
+
+        while not self.stopping.wait(wait):
+            try:
+                self.backup()
+            except BackupAborted as e:
+                logging.warning("Backup of %s aborted: %s", self.dbname, e)
+            except Exception:
+                logging.exception("Backup of %s failed", self.dbname)
+            wait = self.interval
+
+    def start(self):
+        """Back up in the background until stop() is called"""
+        self.thread = threading.Thread(target=self._run, name=f"backup-{self.prefix}", daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        """Returns backup counts, and the duration and pages copied of the latest one"""
+        return {
+            'backups': self.backups,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'snapshots': len(self.snapshots()),
+            'last_seconds': self.last_seconds,
+            'last_pages': self.last_pages,
+            'last_restarts': self.last_restarts,
+            'total_pages': self.total_pages,
+        }
+
+    def stop(self):
+        """Abort a backup in progress and stop the thread"""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            if self.source:
+                self.source.close()
+                self.source = None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online backups of the bot's database")
+    parser.add_argument("command", choices=["now", "list", "verify", "restore"])
+    parser.add_argument("snapshot", nargs="?", help="restore: path of the snapshot to restore")
+    parser.add_argument("--db", default="debt.sqlite", help="path to the database file")
+    parser.add_argument("--dir", default="backups", help="directory of the snapshots")
+    parser.add_argument("--keep", type=int, default=7, help="now: number of snapshots to keep")
+    parser.add_argument("--pages", type=int, default=256, help="now: pages copied per step")
+    parser.add_argument("--pause-ms", type=int, default=10, help="now: pause between steps")
+    opts = parser.parse_args()
+
+    scheduler = BackupScheduler(opts.db, opts.dir, keep=opts.keep, pages=opts.pages, pause_ms=opts.pause_ms)
+
+    if opts.command == "now":
+        path = scheduler.backup(force=True)
+        x = scheduler.stats()
+        print(f"Backed up to {path} in {x['last_seconds']:.2f}s, {x['last_pages']} pages copied, {x['last_restarts']} restarts")
+        scheduler.stop()
+
+    elif opts.command == "list":
+        for path in scheduler.snapshots():
+            print(f"{path}  {os.path.getsize(path)} bytes")
+
+    elif opts.command == "verify":
+        # Check every snapshot, newest first
+        bad = [path for path in reversed(scheduler.snapshots()) if not check_snapshot(path)]
+        for path in bad:
+            print(f"{path} fails the integrity check")
+        print(f"{len(scheduler.snapshots()) - len(bad)} snapshot(s) ok, {len(bad)} bad")
+        if bad:
+            raise SystemExit(1)
+
+    elif opts.command == "restore":
+        # The newest snapshot unless one is given
+        snapshot = opts.snapshot or (scheduler.snapshots() or [None])[-1]
+        if snapshot is None:
+            raise SystemExit(f"No snapshots in {opts.dir}")
+        restore(snapshot, opts.db)
+        print(f"Restored {opts.db} from {snapshot}")
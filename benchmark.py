@@ -0,0 +1,438 @@
+"""Offline benchmarks for the bot
+
+Usage: python benchmark.py <benchmark> [options]
+Each benchmark works on throwaway databases in a temporary directory.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+from telegram import Bot
+from dbhelper import DBHelper, SEARCH_PAGE_SIZE
+from backup import BackupScheduler, check_snapshot
+import settle
+
+# The benchmarks build dispatchers without worker threads and per-message tracking, on purpose
+warnings.filterwarnings('ignore', category=UserWarning, module='telegram')
+
+class StubBot(Bot):
+    """Bot that records outgoing API calls instead of sending them to Telegram"""
+    def __init__(self):
+        super().__init__('123456:BENCHMARK')
+        self.calls = []
+        self.message_ids = itertools.count(1)
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        data = dict(data or {}, **(api_kwargs or {}))
+        self.calls.append((endpoint, data))
+
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if endpoint.startswith('send') or endpoint.startswith('edit'):
+            # Enough of a Message for the handlers to carry on
+            return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                    'chat': {'id': data.get('chat_id', 0), 'type': 'private'}, 'text': data.get('text', '')}
+        return True
+
+def message(update_id, chat_id, text):
+    """Payload of an update carrying a text message, as Telegram would send it"""
+    entities = []
+    if text.startswith('/'):
+        entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': text, 'entities': entities,
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}}}
+
+def percentile(samples, p):
+    """The p-th percentile of a list of samples"""
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+def bench_writes(opts):
+    """Compare records/sec of per-statement commits against the group-commit writer"""
+    def run(label, **kwargs):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DBHelper(os.path.join(tmp, "bench.sqlite"), synchronous=opts.synchronous, **kwargs)
+            db.setup()
+
+            # Every thread behaves like a handler: add a record, then wait until it is saved
+            def worker(owner):
+                for i in range(opts.records // opts.threads):
+                    db.add_record(owner, "Bob", i, "bench").result()
+
+            threads = [threading.Thread(target=worker, args=(owner,)) for owner in range(opts.threads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+            db.close()
+
+        total = opts.records // opts.threads * opts.threads
+        print(f"{label:<24} {total / elapsed:>10.0f} records/sec")
+
+    print(f"{opts.records} records from {opts.threads} threads, synchronous={opts.synchronous}")
+    run("commit per statement")
+    run("write-behind", write_behind=True, batch_size=opts.batch_size, flush_ms=opts.flush_ms)
+
+def bench_lambda(opts):
+    """Compare a cold serverless invocation with warm ones"""
+    with tempfile.TemporaryDirectory() as tmp:
+        # Importing run is part of every real cold start
+        start = time.perf_counter()
+        import run
+        imported = time.perf_counter() - start
+
+        run.db = DBHelper(os.path.join(tmp, "bench.sqlite"))
+        bot = StubBot()
+        ids = itertools.count(1)
+
+        def invoke():
+            # Spread over a few chats, as a real bot's traffic would be
+            update_id = next(ids)
+            event = {'body': json.dumps(message(update_id, update_id % opts.chats + 1, '/add Bob 5 Lunch'))}
+            start = time.perf_counter()
+            assert run.lambda_handler(event, None)['statusCode'] == 200
+            return time.perf_counter() - start
+
+        def rebuild():
+            # Forget the warm dispatcher, as if the process had been recycled
+            run.lambdaDispatcher = None
+            run.getLambdaDispatcher(bot)
+
+        # Cold: handler graph, persistence and database setup are built before the update
+        cold = []
+        for _ in range(opts.events):
+            start = time.perf_counter()
+            rebuild()
+            cold.append(invoke() + time.perf_counter() - start)
+
+        # Warm: everything is reused
+        rebuild()
+        warm = [invoke() for _ in range(opts.events)]
+
+        run.db.close()
+
+    print(f"import run: {imported * 1000:.1f}ms")
+    for label, samples in (("cold", cold), ("warm", warm)):
+        print(f"{label:<5} p50 {percentile(samples, 50) * 1000:7.2f}ms  p95 {percentile(samples, 95) * 1000:7.2f}ms")
+
+# Messages a user sends to go through each flow once. {id} is replaced by one of
+# the user's record IDs. Destructive flows are declined at the confirmation step
+# so the database keeps its size for the whole run
+FLOWS = {
+    'add (one line)': ['/add Bob 12 Taxi'],
+    'add (conversation)': ['/add', 'Bob', '4.50', 'Coffee'],
+    'add (bulk)': ['/add Bob 12 Taxi\nAlice -4 Coffee\nBob 3.20 Bus\nAlice 8 Dinner'],
+    'check': ['/check', 'Bob'],
+    'balances': ['/balances'],
+    'delete': ['/delete', '{id}', 'No'],
+    'clear': ['/clear', 'Bob', 'No'],
+    'default': ['/default', 'Bob'],
+}
+
+def bench_load(opts):
+    """Push synthetic updates for every flow through the dispatcher and report throughput and latency"""
+    import run
+    from telegram import Update
+    from telegram.ext import Dispatcher
+    from queue import Queue
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run.db = DBHelper(os.path.join(tmp, "bench.sqlite"))
+        run.db.setup()
+
+        # Seed every user with records
+        users = range(1, opts.users + 1)
+        rows = [(user, i % 100, "Bob" if i % 2 else "Alice", "seed") for user in users for i in range(opts.records)]
+        run.db.conn.executemany("INSERT INTO records (owner, amount, friend, desc) VALUES (?, ?, ?, ?)", rows)
+        run.db.conn.commit()
+        firstID = {user: id for user, id in run.db.conn.execute("SELECT owner, MIN(id) FROM records GROUP BY owner")}
+
+        bot = StubBot()
+        dispatcher = Dispatcher(bot, Queue(), workers=0, use_context=True)
+        run.addHandlers(dispatcher)
+        ids = itertools.count(1)
+
+        latencies = {flow: [] for flow in FLOWS}
+        elapsed = {flow: 0.0 for flow in FLOWS}
+
+        for _ in range(opts.rounds):
+            for flow, texts in FLOWS.items():
+                # Interleave users step by step, so many conversations are open at once
+                for text in texts:
+                    for user in users:
+                        update = Update.de_json(message(next(ids), user, text.format(id=firstID.get(user, 0))), bot)
+
+                        start = time.perf_counter()
+                        dispatcher.process_update(update)
+                        took = time.perf_counter() - start
+
+                        latencies[flow].append(took)
+                        elapsed[flow] += took
+
+        run.db.close()
+
+    print(f"{opts.users} users, {opts.records} records each, {opts.rounds} rounds, {len(bot.calls)} API calls")
+    print(f"{'flow':<20} {'updates':>8} {'updates/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for flow, samples in latencies.items():
+        print(f"{flow:<20} {len(samples):>8} {len(samples) / elapsed[flow]:>10.0f} "
+              f"{percentile(samples, 50) * 1000:>8.2f} {percentile(samples, 95) * 1000:>8.2f} {percentile(samples, 99) * 1000:>8.2f}")
+
+def bench_csv(opts):
+    """Import and export a large ledger through the /import and /export code paths"""
+    import run
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run.db = DBHelper(os.path.join(tmp, "bench.sqlite"))
+        run.db.setup()
+
+        # A CSV file as a user would upload it
+        source = os.path.join(tmp, "source.csv")
+        with open(source, "w") as f:
+            f.write("friend,amount,description\n")
+            for i in range(opts.rows):
+                f.write(f"Friend{chr(65 + i % 26)},{i % 1000 - 500}.{i % 100:02d},Expense {i}\n")
+
+        def measure(fn, *args):
+            # Time first, then run again under tracemalloc for the peak memory
+            start = time.perf_counter()
+            result = fn(*args)
+            elapsed = time.perf_counter() - start
+
+            tracemalloc.start()
+            fn(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            return result, elapsed, peak
+
+        # Each import goes to a new user, so every user ends up with opts.rows records
+        owners = itertools.count(1)
+
+        def importFile():
+            with open(source, "rb") as f:
+                return run.importCSV(next(owners), f)
+
+        def exportFile(owner):
+            with tempfile.TemporaryFile() as f:
+                return run.exportCSV(owner, f)
+
+        (imported, rejected), importTime, importPeak = measure(importFile)
+        count, exportTime, exportPeak = measure(exportFile, 1)
+
+        run.db.close()
+
+    assert imported == count == opts.rows and not rejected
+    print(f"{opts.rows} rows, batches of {run.IMPORT_BATCH_SIZE}")
+    print(f"import {opts.rows / importTime:>10.0f} rows/sec, peak {importPeak / 1024:8.0f} KiB")
+    print(f"export {opts.rows / exportTime:>10.0f} rows/sec, peak {exportPeak / 1024:8.0f} KiB")
+
+def bench_search(opts):
+    """Latency of /search through the full-text index against a LIKE scan of the user's records"""
+    rng = random.Random(opts.seed)
+
+    # Made-up words, so descriptions share some words and not others
+    syllables = ["ba", "ko", "ri", "zu", "me", "ta", "no", "shi", "pe", "lo"]
+    words = sorted({"".join(rng.choice(syllables) for _ in range(3)) for _ in range(opts.words)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, "bench.sqlite"))
+        db.setup()
+
+        # Seed in chunks, through the triggers that keep the index in sync
+        start = time.perf_counter()
+        for first in range(0, opts.records, 10000):
+            rows = [(i % opts.users, i % 1000, f"Friend{i % 50}", " ".join(rng.sample(words, 3)))
+                    for i in range(first, min(first + 10000, opts.records))]
+            db.conn.executemany("INSERT INTO records (owner, amount, friend, desc) VALUES (?, ?, ?, ?)", rows)
+        db.conn.commit()
+        seedTime = time.perf_counter() - start
+
+        like = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND (desc LIKE (?) OR friend LIKE (?)) ORDER BY id DESC LIMIT (?)"
+
+        def measure(fn, missing=False):
+            samples = []
+            for _ in range(opts.searches):
+                # A word no description has makes LIKE read every one of the user's records
+                owner, word = rng.randrange(opts.users), "xyzzy" if missing else rng.choice(words)
+                start = time.perf_counter()
+                fn(owner, word)
+                samples.append(time.perf_counter() - start)
+            return samples
+
+        def fts(owner, word):
+            db.search_records(owner, [word])
+
+        def scan(owner, word):
+            db.reader.execute(like, (owner, f"%{word}%", f"%{word}%", SEARCH_PAGE_SIZE + 1)).fetchall()
+
+        results = {
+            "fts": measure(fts),
+            "fts (prefix)": measure(lambda owner, word: fts(owner, word[:3])),
+            "fts (no match)": measure(fts, missing=True),
+            "like": measure(scan),
+            "like (no match)": measure(scan, missing=True),
+        }
+        db.close()
+
+    print(f"{opts.records} records of {opts.users} users seeded and indexed in {seedTime:.1f}s, {len(words)} words")
+    print(f"{'search':<16} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, samples in results.items():
+        print(f"{name:<16} {percentile(samples, 50) * 1000:>8.2f} {percentile(samples, 95) * 1000:>8.2f} {percentile(samples, 99) * 1000:>8.2f}")
+
+def bench_settle(opts):
+    """Settle up a large group ledger kept by the database
+    The netting itself is checked by test_settle.py"""
+    rng = random.Random(opts.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DBHelper(os.path.join(tmp, "bench.sqlite"))
+        db.setup()
+        chat = -1
+
+        for member in range(opts.members):
+            db.join_group(chat, member, f"Member{member}")
+
+        # Expenses split between a random handful of members, as /split would save them
+        start = time.perf_counter()
+        for _ in range(opts.expenses):
+            amount = rng.randint(100, 50000)
+            members = rng.sample(range(opts.members), rng.randint(2, min(10, opts.members)))
+            db.add_expense(chat, members[0], amount, settle.split(amount, members))
+        db.add_expense(chat, 0, 100, [(0, 100)]).result()
+        addTime = time.perf_counter() - start
+
+        # What /settle does: read the balances kept by the triggers, then net them
+        samples = []
+        for _ in range(opts.rounds):
+            start = time.perf_counter()
+            balances = {member: net for member, name, net in db.get_group_balances(chat)}
+            payments = settle.simplify(balances)
+            samples.append(time.perf_counter() - start)
+
+        assert not db.verify_group_balances()
+        db.close()
+
+    print(f"{opts.members} members, {opts.expenses} expenses added at {opts.expenses / addTime:.0f}/sec")
+    print(f"settle: {len(payments)} payments, p50 {percentile(samples, 50) * 1000:.2f} ms, p99 {percentile(samples, 99) * 1000:.2f} ms")
+
+def bench_backup(opts):
+    """Latency of writes while the database is backed up: in page steps, all at once, and not at all"""
+    with tempfile.TemporaryDirectory() as tmp:
+        dbname = os.path.join(tmp, "bench.sqlite")
+        db = DBHelper(dbname)
+        db.setup()
+
+        # Seed straight into records, the triggers keep everything else in step
+        for first in range(0, opts.records, 10000):
+            rows = [(i % 1000, i % 1000, f"Friend{i % 50}", f"Expense {i}") for i in range(first, min(first + 10000, opts.records))]
+            db.conn.executemany("INSERT INTO records (owner, amount, friend, desc) VALUES (?, ?, ?, ?)", rows)
+        db.conn.commit()
+
+        def measure(label, backup):
+            # A user adding records as fast as they commit while the backup runs
+            samples = []
+            done = threading.Event()
+
+            def write():
+                while not done.is_set():
+                    start = time.perf_counter()
+                    db.add_record(1, "Friend", 100, "Benchmark").result()
+                    samples.append(time.perf_counter() - start)
+
+            writer = threading.Thread(target=write)
+            writer.start()
+            start = time.perf_counter()
+            stats = backup() if backup else time.sleep(opts.idle_ms / 1000)
+            elapsed = time.perf_counter() - start
+            done.set()
+            writer.join()
+
+            print(f"{label:<10} {elapsed:>8.2f} {len(samples) / elapsed:>10.0f} {percentile(samples, 50) * 1000:>8.2f} "
+                  f"{percentile(samples, 99) * 1000:>8.2f} {max(samples) * 1000:>8.2f}  {stats or ''}")
+
+        def stepped():
+            scheduler = BackupScheduler(dbname, os.path.join(tmp, "stepped"), pages=opts.pages, pause_ms=opts.pause_ms)
+            path = scheduler.backup(force=True)
+            scheduler.stop()
+            assert check_snapshot(path)
+            x = scheduler.stats()
+            return f"{x['last_pages']} pages, {x['last_restarts']} restarts"
+
+        def whole():
+            # Copying every page in one step, as a plain file copy would
+            scheduler = BackupScheduler(dbname, os.path.join(tmp, "whole"), pages=-1, pause_ms=0)
+            path = scheduler.backup(force=True)
+            scheduler.stop()
+            assert check_snapshot(path)
+            return f"{scheduler.stats()['last_pages']} pages"
+
+        print(f"{opts.records} records, {os.path.getsize(dbname) // 1024} KiB, steps of {opts.pages} pages with {opts.pause_ms}ms pauses")
+        print(f"{'backup':<10} {'seconds':>8} {'writes/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        measure("none", None)
+        measure("stepped", stepped)
+        measure("whole", whole)
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bot")
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+
+    writes = commands.add_parser("writes", help="group commit against per-statement commits")
+    writes.add_argument("--records", type=int, default=2000)
+    writes.add_argument("--threads", type=int, default=32)
+    writes.add_argument("--batch-size", type=int, default=100)
+    writes.add_argument("--flush-ms", type=int, default=0)
+    writes.add_argument("--synchronous", default="FULL", help="PRAGMA synchronous for both runs")
+    writes.set_defaults(run=bench_writes)
+
+    serverless = commands.add_parser("lambda", help="cold against warm serverless invocations")
+    serverless.add_argument("--events", type=int, default=50)
+    serverless.add_argument("--chats", type=int, default=10, help="chats the events come from")
+    serverless.set_defaults(run=bench_lambda)
+
+    load = commands.add_parser("load", help="throughput and latency of every flow through the dispatcher")
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--records", type=int, default=1000, help="records seeded per user")
+    load.add_argument("--rounds", type=int, default=5)
+    load.set_defaults(run=bench_load)
+
+    ledger = commands.add_parser("csv", help="/import and /export of a large ledger")
+    ledger.add_argument("--rows", type=int, default=100000, help="records in the ledger")
+    ledger.set_defaults(run=bench_csv)
+
+    text = commands.add_parser("search", help="/search through the full-text index against a LIKE scan")
+    text.add_argument("--records", type=int, default=1000000)
+    text.add_argument("--users", type=int, default=1000)
+    text.add_argument("--words", type=int, default=2000, help="distinct words in descriptions")
+    text.add_argument("--searches", type=int, default=200)
+    text.add_argument("--seed", type=int, default=0)
+    text.set_defaults(run=bench_search)
+
+    group = commands.add_parser("settle", help="/settle of a large group ledger")
+    group.add_argument("--members", type=int, default=500)
+    group.add_argument("--expenses", type=int, default=20000)
+    group.add_argument("--rounds", type=int, default=20, help="times /settle is timed")
+    group.add_argument("--seed", type=int, default=0)
+    group.set_defaults(run=bench_settle)
+
+    snapshot = commands.add_parser("backup", help="write latency during stepped and all-at-once online backups")
+    snapshot.add_argument("--records", type=int, default=500000)
+    snapshot.add_argument("--pages", type=int, default=256, help="pages copied per step")
+    snapshot.add_argument("--pause-ms", type=int, default=10, help="pause between steps")
+    snapshot.add_argument("--idle-ms", type=int, default=1000, help="time writes are measured without a backup")
+    snapshot.set_defaults(run=bench_backup)
+
+    opts = parser.parse_args()
+    opts.run(opts)
@@ -1,9 +1,398 @@
 import sqlite3
+import argparse
+import json
+import threading
+import queue
+import time
+from concurrent.futures import Future
+from statestore import StateStore
+
+# Schema migrations, applied in order on top of the tables created in setup().
+# PRAGMA user_version stores how many of these have been applied, so each
+# entry runs exactly once per database. Never edit or reorder an entry that
+# has shipped; append a new one instead.
+MIGRATIONS = [
+    # 1: Index owner-scoped lookups. Friend names are compared case-insensitively,
+    # so the index uses the same collation as the queries or SQLite ignores it
+    [
+        "CREATE INDEX IF NOT EXISTS records_owner_friend ON records (owner, friend COLLATE NOCASE, amount, desc)",
+        "CREATE INDEX IF NOT EXISTS records_owner_id ON records (owner, id)",
+    ],
+    # 2: Running total and record count per (owner, friend), kept up to date by
+    # triggers so every write to records updates it in the same transaction
+    [
+        "CREATE TABLE IF NOT EXISTS balances (`owner` INT NOT NULL, `friend` VARCHAR(45) NOT NULL COLLATE NOCASE, `total` FLOAT NOT NULL DEFAULT 0, `count` INT NOT NULL DEFAULT 0, PRIMARY KEY (`owner`, `friend`))",
+        "INSERT INTO balances (owner, friend, total, count) SELECT owner, friend, SUM(amount), COUNT(*) FROM records GROUP BY owner, friend COLLATE NOCASE",
+        "CREATE TRIGGER IF NOT EXISTS records_balance_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO balances (owner, friend, total, count) VALUES (NEW.owner, NEW.friend, NEW.amount, 1) "
+            "ON CONFLICT (owner, friend) DO UPDATE SET total = total + excluded.total, count = count + 1; "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS records_balance_delete AFTER DELETE ON records BEGIN "
+            "UPDATE balances SET total = total - OLD.amount, count = count - 1 WHERE owner = OLD.owner AND friend = OLD.friend; "
+            "DELETE FROM balances WHERE owner = OLD.owner AND friend = OLD.friend AND count <= 0; "
+        "END",
+    ],
+    # 3: One row per friend of each user, so the reply keyboard no longer needs
+    # to read every record. last_used holds the ID of the latest record added
+    # for that friend, which orders friends by recent use without a clock
+    [
+        "CREATE TABLE IF NOT EXISTS friends (`owner` INT NOT NULL, `name_key` VARCHAR(45) NOT NULL, `display_name` VARCHAR(45) NOT NULL, `last_used` INT NOT NULL, PRIMARY KEY (`owner`, `name_key`))",
+        "CREATE INDEX IF NOT EXISTS friends_owner_last_used ON friends (owner, last_used, display_name)",
+        "INSERT INTO friends (owner, name_key, display_name, last_used) SELECT owner, lower(friend), friend, MAX(id) FROM records GROUP BY owner, lower(friend)",
+        "CREATE TRIGGER IF NOT EXISTS records_friend_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO friends (owner, name_key, display_name, last_used) VALUES (NEW.owner, lower(NEW.friend), NEW.friend, NEW.id) "
+            "ON CONFLICT (owner, name_key) DO UPDATE SET display_name = excluded.display_name, last_used = excluded.last_used; "
+        "END",
+    ],
+    # 4: Conversation states and user_data, so half-finished conversations survive a restart
+    [
+        "CREATE TABLE IF NOT EXISTS user_data (`user_id` INT NOT NULL, `data` BLOB NOT NULL, PRIMARY KEY (`user_id`))",
+        "CREATE TABLE IF NOT EXISTS conversations (`name` VARCHAR(45) NOT NULL, `key` VARCHAR(45) NOT NULL, `state` VARCHAR(45) NOT NULL, PRIMARY KEY (`name`, `key`))",
+    ],
+    # 5: Amounts as integer cents, so totals are exact. SQLite can't change a
+    # column's type, so records is rebuilt. Dropping the old table drops its
+    # indexes and triggers too, which are recreated as they were
+    [
+        "CREATE TABLE records_new (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `owner` INT NOT NULL, `amount` INTEGER NOT NULL, `friend` VARCHAR(45) NOT NULL, `desc` VARCHAR(45) NULL, CONSTRAINT `userID` FOREIGN KEY (`owner`) REFERENCES `pref` (`userID`) ON DELETE NO ACTION ON UPDATE CASCADE)",
+        "INSERT INTO records_new (id, owner, amount, friend, desc) SELECT id, owner, CAST(ROUND(amount * 100) AS INTEGER), friend, desc FROM records",
+        # Keep the AUTOINCREMENT counter, so IDs of deleted records are still never reused
+        "DELETE FROM sqlite_sequence WHERE name = 'records_new'",
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'records_new', seq FROM sqlite_sequence WHERE name = 'records'",
+        "DROP TABLE records",
+        "ALTER TABLE records_new RENAME TO records",
+        "CREATE INDEX records_owner_friend ON records (owner, friend COLLATE NOCASE, amount, desc)",
+        "CREATE INDEX records_owner_id ON records (owner, id)",
+        "DROP TABLE balances",
+        "CREATE TABLE balances (`owner` INT NOT NULL, `friend` VARCHAR(45) NOT NULL COLLATE NOCASE, `total` INTEGER NOT NULL DEFAULT 0, `count` INT NOT NULL DEFAULT 0, PRIMARY KEY (`owner`, `friend`))",
+        "INSERT INTO balances (owner, friend, total, count) SELECT owner, friend, SUM(amount), COUNT(*) FROM records GROUP BY owner, friend COLLATE NOCASE",
+        "CREATE TRIGGER records_balance_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO balances (owner, friend, total, count) VALUES (NEW.owner, NEW.friend, NEW.amount, 1) "
+            "ON CONFLICT (owner, friend) DO UPDATE SET total = total + excluded.total, count = count + 1; "
+        "END",
+        "CREATE TRIGGER records_balance_delete AFTER DELETE ON records BEGIN "
+            "UPDATE balances SET total = total - OLD.amount, count = count - 1 WHERE owner = OLD.owner AND friend = OLD.friend; "
+            "DELETE FROM balances WHERE owner = OLD.owner AND friend = OLD.friend AND count <= 0; "
+        "END",
+        "CREATE TRIGGER records_friend_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO friends (owner, name_key, display_name, last_used) VALUES (NEW.owner, lower(NEW.friend), NEW.friend, NEW.id) "
+            "ON CONFLICT (owner, name_key) DO UPDATE SET display_name = excluded.display_name, last_used = excluded.last_used; "
+        "END",
+    ],
+    # 6: Shared ledgers of group chats. Each expense is paid by one member and split
+    # into shares between members. Triggers keep every member's net balance (paid
+    # minus shares) up to date, so settling up never reads the expenses
+    [
+        "CREATE TABLE group_members (`chat` INT NOT NULL, `user` INT NOT NULL, `name` VARCHAR(45) NOT NULL COLLATE NOCASE, PRIMARY KEY (`chat`, `user`))",
+        "CREATE TABLE group_expenses (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `chat` INT NOT NULL, `payer` INT NOT NULL, `amount` INTEGER NOT NULL, `desc` VARCHAR(45) NULL)",
+        "CREATE INDEX group_expenses_chat ON group_expenses (chat, id)",
+        "CREATE TABLE group_shares (`expense` INT NOT NULL REFERENCES group_expenses (id), `chat` INT NOT NULL, `member` INT NOT NULL, `share` INTEGER NOT NULL, PRIMARY KEY (`expense`, `member`))",
+        "CREATE TABLE group_balances (`chat` INT NOT NULL, `member` INT NOT NULL, `net` INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (`chat`, `member`))",
+        "CREATE TRIGGER group_expenses_insert AFTER INSERT ON group_expenses BEGIN "
+            "INSERT INTO group_balances (chat, member, net) VALUES (NEW.chat, NEW.payer, NEW.amount) "
+            "ON CONFLICT (chat, member) DO UPDATE SET net = net + excluded.net; "
+        "END",
+        "CREATE TRIGGER group_expenses_delete AFTER DELETE ON group_expenses BEGIN "
+            "UPDATE group_balances SET net = net - OLD.amount WHERE chat = OLD.chat AND member = OLD.payer; "
+        "END",
+        "CREATE TRIGGER group_shares_insert AFTER INSERT ON group_shares BEGIN "
+            "INSERT INTO group_balances (chat, member, net) VALUES (NEW.chat, NEW.member, -NEW.share) "
+            "ON CONFLICT (chat, member) DO UPDATE SET net = net + excluded.net; "
+        "END",
+        "CREATE TRIGGER group_shares_delete AFTER DELETE ON group_shares BEGIN "
+            "UPDATE group_balances SET net = net + OLD.share WHERE chat = OLD.chat AND member = OLD.member; "
+        "END",
+    ],
+    # 7: Full-text index of friend names and descriptions. The index reads its text from
+    # records (external content) rather than keeping a second copy, and triggers keep
+    # it in sync. owner is indexed too, so a search only matches the user's own records.
+    # Prefix indexes make partial words as fast as whole ones, and owner doesn't count
+    # towards the ranking
+    [
+        "CREATE VIRTUAL TABLE records_fts USING fts5(friend, desc, owner, content='records', content_rowid='id', prefix='2 3')",
+        "INSERT INTO records_fts (records_fts, rank) VALUES ('rank', 'bm25(1.0, 1.0, 0.0)')",
+        "INSERT INTO records_fts (records_fts) VALUES ('rebuild')",
+        "CREATE TRIGGER records_fts_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO records_fts (rowid, friend, desc, owner) VALUES (NEW.id, NEW.friend, NEW.desc, NEW.owner); "
+        "END",
+        "CREATE TRIGGER records_fts_delete AFTER DELETE ON records BEGIN "
+            "INSERT INTO records_fts (records_fts, rowid, friend, desc, owner) VALUES ('delete', OLD.id, OLD.friend, OLD.desc, OLD.owner); "
+        "END",
+        "CREATE TRIGGER records_fts_update AFTER UPDATE ON records BEGIN "
+            "INSERT INTO records_fts (records_fts, rowid, friend, desc, owner) VALUES ('delete', OLD.id, OLD.friend, OLD.desc, OLD.owner); "
+            "INSERT INTO records_fts (rowid, friend, desc, owner) VALUES (NEW.id, NEW.friend, NEW.desc, NEW.owner); "
+        "END",
+    ],
+    # 8: Append-only log of every change to a user's ledger, with the change to each
+    # friend's total and record count. An operation (one /add, /delete, /clear or
+    # /default) is one or more events sharing an op number, and /undo appends events
+    # reverting the latest one. Compaction folds old events into a snapshot per friend,
+    # so a total from the log is that snapshot plus a short tail of events. records and
+    # balances stay as they are, the current state the log leads to. Existing totals
+    # become the first snapshots
+    [
+        "CREATE TABLE events (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `owner` INT NOT NULL, `op` INT NOT NULL, `kind` VARCHAR(16) NOT NULL, `friend` VARCHAR(45) NULL COLLATE NOCASE, `amount` INTEGER NOT NULL DEFAULT 0, `count` INT NOT NULL DEFAULT 0, `payload` TEXT NOT NULL, `reverts` INT NULL, `created` INT NOT NULL)",
+        "CREATE INDEX events_owner_op ON events (owner, op)",
+        "CREATE INDEX events_owner_friend ON events (owner, friend, id, amount, count)",
+        "CREATE INDEX events_owner_reverts ON events (owner, reverts) WHERE reverts IS NOT NULL",
+        "CREATE TABLE snapshots (`owner` INT NOT NULL, `friend` VARCHAR(45) NOT NULL COLLATE NOCASE, `event` INT NOT NULL, `total` INTEGER NOT NULL, `count` INT NOT NULL, PRIMARY KEY (`owner`, `friend`))",
+        "INSERT INTO snapshots (owner, friend, event, total, count) SELECT owner, friend, 0, total, count FROM balances",
+    ],
+    # 9: When each record was added (Unix time), so old records can be moved to the archive.
+    # Existing records count as added now. Setting created mustn't touch the search index,
+    # so its update trigger only fires for the indexed columns from now on
+    [
+        "ALTER TABLE records ADD COLUMN `created` INT NULL",
+        "CREATE INDEX records_created ON records (created)",
+        "DROP TRIGGER records_fts_update",
+        "CREATE TRIGGER records_fts_update AFTER UPDATE OF friend, desc, owner ON records BEGIN "
+            "INSERT INTO records_fts (records_fts, rowid, friend, desc, owner) VALUES ('delete', OLD.id, OLD.friend, OLD.desc, OLD.owner); "
+            "INSERT INTO records_fts (rowid, friend, desc, owner) VALUES (NEW.id, NEW.friend, NEW.desc, NEW.owner); "
+        "END",
+        "UPDATE records SET created = CAST(strftime('%s', 'now') AS INT)",
+    ],
+    # 10: Friend names are told apart regardless of case in any alphabet, like the reply keyboard did
+    # before migration 3. SQLite's lower() only lowercases ASCII, so name_key is rebuilt with
+    # casefold(), which every connection of DBHelper registers. Names that only differ in case
+    # merge into one friend, shown as last used
+    [
+        "DROP TRIGGER records_friend_insert",
+        "CREATE TABLE friends_new (`owner` INT NOT NULL, `name_key` VARCHAR(45) NOT NULL, `display_name` VARCHAR(45) NOT NULL, `last_used` INT NOT NULL, PRIMARY KEY (`owner`, `name_key`))",
+        "INSERT INTO friends_new (owner, name_key, display_name, last_used) SELECT owner, casefold(display_name), display_name, MAX(last_used) FROM friends GROUP BY owner, casefold(display_name)",
+        "DROP TABLE friends",
+        "ALTER TABLE friends_new RENAME TO friends",
+        "CREATE INDEX friends_owner_last_used ON friends (owner, last_used, display_name)",
+        "CREATE TRIGGER records_friend_insert AFTER INSERT ON records BEGIN "
+            "INSERT INTO friends (owner, name_key, display_name, last_used) VALUES (NEW.owner, casefold(NEW.friend), NEW.friend, NEW.id) "
+            "ON CONFLICT (owner, name_key) DO UPDATE SET display_name = excluded.display_name, last_used = excluded.last_used; "
+        "END",
+    ],
+]
+
+# Maximum number of friends offered on the reply keyboard
+FRIENDS_LIMIT = 8
+
+# Number of records shown per page of /delete
+RECENT_PAGE_SIZE = 10
+
+# Number of friends shown per page of /balances
+BALANCES_PAGE_SIZE = 20
+
+# Number of friends suggested for an inline query
+INLINE_RESULTS_LIMIT = 10
+
+# Number of records shown per page of /search
+SEARCH_PAGE_SIZE = 10
+
+# Most events folded into snapshots per transaction by compact_events
+EVENT_COMPACT_BATCH = 10000
+
+# Number of archived records shown per page of /history
+HISTORY_PAGE_SIZE = 10
+
+# Most records moved to the archive per transaction by archive_records
+ARCHIVE_BATCH = 500
+
+# Number of records fetched at a time when streaming a whole ledger
+EXPORT_CHUNK_SIZE = 500
+
+def search_query(owner, terms):
+    """Full-text query matching the user's records that contain every term, the last one as a prefix
+    Terms are quoted so that whatever the user typed is searched for as text, never as query syntax"""
+    phrases = ['"' + term.replace('"', '""') + '"' for term in terms]
+    phrases[-1] += '*'
+
+    return f'owner:"{owner}" AND {{friend desc}}: ({" ".join(phrases)})'
 
 class DBHelper:
-    def __init__(self, dbname="debt.sqlite"):
+    def __init__(self, dbname="debt.sqlite", write_behind=False, batch_size=100, flush_ms=0, synchronous="NORMAL", cache_kb=8192, cache_entries=10000, archive=None):
         self.dbname = dbname
-        self.conn = sqlite3.connect(dbname, check_same_thread=False)
+        self.synchronous = synchronous
+        self.cache_kb = cache_kb
+
+        # Old and cleared records are moved to records_archive, in a database file of its own if archive is set.
+        # Without one, the table lives in the main database
+        self.archive = archive
+        self.archived = "archive.records_archive" if archive else "records_archive"
+
+        # One connection is reserved for writes. Every other thread reads through
+        # its own connection, so with WAL reads never wait behind a write
+        self.conn = self._connect()
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+
+        # Writes either commit straight away on the caller's thread, or are queued
+        # for a single writer thread that commits them in batches (group commit)
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.write_lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.writer = None
+
+        if write_behind:
+            self.writer = threading.Thread(target=self._write_loop, name="dbhelper-writer", daemon=True)
+            self.writer.start()
+
+        # Friend lists and default friends of the cache_entries most recently active users,
+        # as owner -> {key: result}. Writes drop the keys they change once they are committed
+        self.cache = StateStore(maxsize=cache_entries) if cache_entries else None
+        self.cache_lock = threading.Lock()
+
+        # Bumped by every invalidation, so a read that raced with a write doesn't cache its stale result
+        self.cache_version = 0
+
+        # Metrics
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _connect(self):
+        """Open a connection to the database with the tuned pragmas"""
+        conn = sqlite3.connect(self.dbname, check_same_thread=False)
+
+        # Keys of the friends table, written by a trigger on records. Python's casefold() matches
+        # names regardless of case in any alphabet, where SQLite's lower() only knows ASCII
+        conn.create_function("casefold", 1, lambda x: x.casefold() if isinstance(x, str) else x, deterministic=True)
+
+        # WAL lets readers carry on while a write is in progress.
+        # It is stored in the database file, so this only changes anything the first time
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+
+        # Negative cache sizes are in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_kb)}")
+
+        # The archive is only read on demand, so it gets the default cache
+        if self.archive:
+            conn.execute("ATTACH DATABASE (?) AS archive", (self.archive,))
+            conn.execute("PRAGMA archive.journal_mode = WAL")
+            conn.execute(f"PRAGMA archive.synchronous = {self.synchronous}")
+
+        return conn
+
+    @property
+    def reader(self):
+        """The calling thread's read-only connection"""
+        # An in-memory database only exists inside its one connection
+        if self.dbname == ":memory:":
+            return self.conn
+
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            self.local.conn = conn
+
+            # Remember it so close() can reach connections of other threads
+            with self.readers_lock:
+                self.readers.append(conn)
+
+        return conn
+
+    def close(self):
+        """Flush any queued writes and close the database"""
+        if self.writer:
+            # Wake the writer up with the stop signal and wait for it to drain the queue
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+
+        self.conn.close()
+
+    def _submit(self, op, committed=None):
+        """Run op(conn) in a write transaction
+        Returns a Future that resolves to op's result once the write is committed.
+        committed() is called after the commit, before the Future resolves"""
+        future = Future()
+
+        if self.writer:
+            # Hand over to the writer thread
+            self.writes.put((op, future, committed))
+            return future
+
+        # Commit straight away, one writer at a time
+        with self.write_lock:
+            try:
+                result = op(self.conn)
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                future.set_exception(e)
+            else:
+                if committed:
+                    committed()
+                future.set_result(result)
+
+        return future
+
+    def _execute(self, stmt, args, committed=None):
+        """Queue a single write statement, returning a Future of the number of rows it changed"""
+        return self._submit(lambda conn: conn.execute(stmt, args).rowcount, committed)
+
+    def _write_loop(self):
+        """Writer thread: commit queued writes in batches"""
+        stopping = False
+
+        while not stopping:
+            # Block until there is something to write
+            item = self.writes.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # Keep collecting until the batch is full or the deadline passes
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.writes.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Stop after writing what we already have
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """Commit a batch of writes in one transaction
+        Each write runs under its own savepoint so a failing one doesn't take the others down with it"""
+        conn = self.conn
+        results = []
+
+        try:
+            conn.execute("BEGIN")
+            for op, future, committed in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, op(conn), None, committed))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((future, None, e, None))
+                conn.execute("RELEASE write")
+            conn.commit()
+
+        except Exception as e:
+            # The whole batch failed to commit
+            conn.rollback()
+            for op, future, committed in batch:
+                future.set_exception(e)
+            return
+
+        # Only report success once the data is durable
+        for future, result, error, committed in results:
+            if error:
+                future.set_exception(error)
+            else:
+                if committed:
+                    committed()
+                future.set_result(result)
 
     def setup(self):
         print("Creating Tables")
@@ -19,67 +408,508 @@ class DBHelper:
         
         self.conn.commit()
 
+        # Bring the schema up to date
+        self.migrate()
+
+        # The archive may be a database of its own, which the migrations don't reach.
+        # cleared is set for records removed with /clear, the others still count towards balances
+        schema = "archive." if self.archive else ""
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {schema}records_archive (`id` INTEGER PRIMARY KEY, `owner` INT NOT NULL, `amount` INTEGER NOT NULL, `friend` VARCHAR(45) NOT NULL, `desc` VARCHAR(45) NULL, `created` INT NULL, `archived` INT NOT NULL, `cleared` INT NOT NULL DEFAULT 0)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}records_archive_owner_id ON records_archive (owner, id)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}records_archive_owner_friend ON records_archive (owner, friend COLLATE NOCASE, id)")
+        self.conn.commit()
+
+    def migrate(self):
+        """Apply any migrations newer than the database's schema version"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+        for number, stmts in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Applying migration {number}")
+
+            # Run each migration in its own transaction, including the version bump
+            self.conn.execute("BEGIN")
+            try:
+                for stmt in stmts:
+                    self.conn.execute(stmt)
+                self.conn.execute(f"PRAGMA user_version = {number}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _cached(self, owner, key, query):
+        """Returns the cached result of query() for the owner, running it on a miss"""
+        if self.cache is None:
+            return query()
+
+        with self.cache_lock:
+            entry = self.cache.get(owner)
+            if entry is not None and key in entry:
+                self.cache_hits += 1
+                return entry[key]
+            self.cache_misses += 1
+            version = self.cache_version
+
+        result = query()
+
+        with self.cache_lock:
+            # Only keep it if no write was committed while querying
+            if version == self.cache_version:
+                entry = self.cache.get(owner)
+                if entry is None:
+                    self.cache[owner] = entry = {}
+                entry[key] = result
+
+        return result
+
+    def _invalidate(self, owner, kind):
+        """Returns a callback that drops the owner's cached results of that kind, for _submit"""
+        def invalidate():
+            with self.cache_lock:
+                self.cache_version += 1
+                entry = self.cache.get(owner) if self.cache is not None else None
+                if entry:
+                    for key in [x for x in entry if x[0] == kind]:
+                        del entry[key]
+
+        return invalidate
+
+    def cache_stats(self):
+        """Returns the number of users cached and how often the cache was hit"""
+        return {
+            'entries': len(self.cache) if self.cache is not None else 0,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+        }
+
+    def check_query_plans(self):
+        """Assert that every owner-scoped query is served by an index instead of a table scan"""
+        # Same statements as the methods below, with placeholder arguments
+        queries = [
+            ("SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) ORDER BY id DESC LIMIT (?)", (0, RECENT_PAGE_SIZE)),
+            ("SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id < (?) ORDER BY id DESC LIMIT (?)", (0, 0, RECENT_PAGE_SIZE)),
+            ("SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id > (?) ORDER BY id ASC LIMIT (?)", (0, 0, RECENT_PAGE_SIZE)),
+            ("SELECT amount, desc FROM records WHERE owner = (?) AND friend = (?) COLLATE NOCASE", (0, "")),
+            ("SELECT id, amount, friend, desc FROM records WHERE owner = (?) ORDER BY id", (0,)),
+            ("SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id = (?)", (0, 0)),
+            ("SELECT display_name FROM friends WHERE owner = (?) ORDER BY last_used DESC LIMIT (?)", (0, FRIENDS_LIMIT)),
+            ("SELECT total, count FROM balances WHERE owner = (?) AND friend = (?)", (0, "")),
+            ("SELECT friend, total, count, SUM(total) OVER (), COUNT(*) OVER () FROM balances WHERE owner = (?) ORDER BY ABS(total) DESC, friend LIMIT (?) OFFSET (?)", (0, BALANCES_PAGE_SIZE, 0)),
+            ("SELECT defaultFriend FROM pref WHERE userID = (?)", (0,)),
+            ("DELETE FROM records WHERE owner = (?) AND friend = (?) COLLATE NOCASE", (0, "")),
+            ("DELETE FROM records WHERE owner = (?) AND id = (?)", (0, 0)),
+            ("SELECT user, name FROM group_members WHERE chat = (?) ORDER BY name", (0,)),
+            ("SELECT b.member, m.name, b.net FROM group_balances b LEFT JOIN group_members m ON m.chat = b.chat AND m.user = b.member WHERE b.chat = (?) AND b.net != 0", (0,)),
+            ("SELECT f.display_name, IFNULL(b.total, 0), IFNULL(b.count, 0) FROM friends f LEFT JOIN balances b ON b.owner = f.owner AND b.friend = f.display_name WHERE f.owner = (?) AND f.name_key >= (?) AND f.name_key < (?) ORDER BY f.last_used DESC LIMIT (?)", (0, "", "\U0010ffff", INLINE_RESULTS_LIMIT)),
+            ("SELECT IFNULL(MAX(op), 0) + 1 FROM events WHERE owner = (?)", (0,)),
+            ("SELECT op FROM events e WHERE owner = (?) AND kind != 'undo' AND NOT EXISTS (SELECT 1 FROM events u WHERE u.owner = e.owner AND u.reverts = e.op) ORDER BY op DESC LIMIT 1", (0,)),
+            ("SELECT kind, friend, amount, count, payload FROM events WHERE owner = (?) AND op = (?) ORDER BY id", (0, 0)),
+            ("SELECT event, total, count FROM snapshots WHERE owner = (?) AND friend = (?)", (0, "")),
+            ("SELECT IFNULL(SUM(amount), 0), IFNULL(SUM(count), 0) FROM events WHERE owner = (?) AND friend = (?) AND id > (?)", (0, "", 0)),
+            ("SELECT id, owner, amount, friend, desc, created FROM records WHERE created < (?) ORDER BY created LIMIT (?)", (0, ARCHIVE_BATCH)),
+            (f"SELECT id, amount FROM {self.archived} WHERE owner = (?) AND friend = (?) COLLATE NOCASE AND cleared = 0", (0, "")),
+            (f"SELECT id, owner, amount, friend, desc, cleared FROM {self.archived} WHERE owner = (?) AND id < (?) ORDER BY id DESC LIMIT (?)", (0, 0, HISTORY_PAGE_SIZE)),
+            (f"SELECT id, owner, amount, friend, desc, cleared FROM {self.archived} WHERE owner = (?) AND friend = (?) COLLATE NOCASE AND id < (?) ORDER BY id DESC LIMIT (?)", (0, "", 0, HISTORY_PAGE_SIZE)),
+            (f"SELECT id, amount, friend, desc FROM {self.archived} a WHERE owner = (?) AND cleared = 0 AND NOT EXISTS (SELECT 1 FROM records r WHERE r.id = a.id) ORDER BY id", (0,)),
+            ("SELECT r.id, r.owner, r.amount, r.friend, r.desc FROM records_fts JOIN records r ON r.id = records_fts.rowid WHERE records_fts MATCH (?) AND r.owner = (?) ORDER BY records_fts.rank, r.id DESC LIMIT (?) OFFSET (?)", (search_query(0, ["x"]), 0, SEARCH_PAGE_SIZE + 1, 0)),
+        ]
+
+        for stmt, args in queries:
+            plan = [x[3] for x in self.reader.execute("EXPLAIN QUERY PLAN " + stmt, args)]
+
+            # Window functions read back the rows found through the index as a subquery, and the
+            # full-text index shows up as a scan of its virtual table using the MATCH constraint, which are fine
+            scans = [x for x in plan if x.startswith("SCAN") and not x.startswith("SCAN (subquery") and not
+                     ("VIRTUAL TABLE INDEX" in x and ":M" in x)]
+            assert not scans, f"Full scan in query plan for {stmt!r}: {plan}"
+
+        return len(queries)
+
+    def _log(self, conn, owner, events, reverts=None):
+        """Append the (kind, friend, amount, count, payload) events of one operation to the owner's log
+        amount and count are the changes to the friend's total and number of records"""
+        # Operations are numbered per owner, in the order they happened
+        op = conn.execute("SELECT IFNULL(MAX(op), 0) + 1 FROM events WHERE owner = (?)", (owner,)).fetchone()[0]
+        created = int(time.time())
+
+        conn.executemany("INSERT INTO events (owner, op, kind, friend, amount, count, payload, reverts, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(owner, op, kind, friend, amount, count, json.dumps(payload), reverts, created)
+                          for kind, friend, amount, count, payload in events])
+
     def add_record(self, owner, friend, amount, desc=""):
-        """Add new record to database"""
-        if not friend:
-            # get default
-            pass
-        
+        """Add new record to database, with the amount in cents"""
+        return self.add_records(owner, [(friend, amount, desc)])
+
+    def add_records(self, owner, records):
+        """Add many (friend, amount in cents, desc) records to database in a single transaction"""
         # Prepare statement
-        stmt = "INSERT INTO records (owner, amount, friend, desc) VALUES (?, ?, ?, ?)"
-        args = (owner, amount, friend, desc,)
+        created = int(time.time())
+        stmt = "INSERT INTO records (owner, amount, friend, desc, created) VALUES (?, ?, ?, ?, ?)"
+        args = [(owner, amount, friend, desc, created) for friend, amount, desc in records]
 
-        # Execute statement
-        self.conn.execute(stmt, args)
+        def add(conn):
+            conn.executemany(stmt, args)
 
-        # Commit to database
-        self.conn.commit()
+            # Nothing else writes in between, so the new records got the IDs up to the last one
+            last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self._log(conn, owner, [("add", friend, amount, 1, {"id": id, "amount": amount, "desc": desc, "created": created})
+                                    for id, (friend, amount, desc) in enumerate(records, start=last - len(records) + 1)])
+            return len(records)
+
+        # Execute statement and commit to database. The friends move to the front of the list
+        return self._submit(add, self._invalidate(owner, "friends"))
+
+    def _adjust_balance(self, conn, owner, friend, total, count):
+        """Add to a friend's total and record count, for records moving in or out of the archive
+        Triggers only see changes to records"""
+        conn.execute("INSERT INTO balances (owner, friend, total, count) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (owner, friend) DO UPDATE SET total = total + excluded.total, count = count + excluded.count", (owner, friend, total, count))
+        conn.execute("DELETE FROM balances WHERE owner = (?) AND friend = (?) AND count <= 0", (owner, friend))
 
     def clear_record(self, owner, friend):
-        """Clear all records between the user and a specific friend"""
-        # Prepare statement
-        stmt = "DELETE FROM records WHERE owner = (?) AND friend = (?)"
+        """Clear all records between the user and a specific friend, moving them to the archive"""
+        # Prepare statements
+        select = "SELECT id, friend, amount, desc, created FROM records WHERE owner = (?) AND friend = (?) COLLATE NOCASE"
+        selectArchived = f"SELECT id, amount FROM {self.archived} WHERE owner = (?) AND friend = (?) COLLATE NOCASE AND cleared = 0"
+        stmt = "DELETE FROM records WHERE owner = (?) AND friend = (?) COLLATE NOCASE"
         args = (owner, friend)
 
-        # Execute statement
-        self.conn.execute(stmt, args)
+        def clear(conn):
+            records = conn.execute(select, args).fetchall()
 
-        # Commit to database
-        self.conn.commit()
+            # A move to a separate archive file that was cut short can leave a record in both tables, where it counts once
+            ids = {x[0] for x in records}
+            archived = [x for x in conn.execute(selectArchived, args) if x[0] not in ids]
+
+            # The archive keeps the records for /history, and the log keeps which ones were cleared for /undo
+            now = int(time.time())
+            conn.executemany(f"INSERT OR REPLACE INTO {self.archived} (id, owner, amount, friend, desc, created, archived, cleared) VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+                             [(id, owner, amount, name, desc, created, now) for id, name, amount, desc, created in records])
+            conn.executemany(f"UPDATE {self.archived} SET cleared = 1 WHERE id = (?)", [(x[0],) for x in archived])
+            if records or archived:
+                total, count = sum(x[2] for x in records) + sum(x[1] for x in archived), len(records) + len(archived)
+                self._log(conn, owner, [("clear", friend, -total, -count, {"records": records, "archived": [x[0] for x in archived]})])
+
+            # Records that were already archived still counted towards the total, so it goes as a whole
+            deleted = conn.execute(stmt, args).rowcount
+            conn.execute("DELETE FROM balances WHERE owner = (?) AND friend = (?)", args)
+            return deleted + len(archived)
+
+        # Execute statements and commit to database.
+        # The friend stays in the friends table, so cached friend lists are still right
+        return self._submit(clear)
 
     def delete_record(self, owner, id):
         """Delete a single record by owner and ID"""
-        # Prepare statement
+        # Prepare statements
+        select = "SELECT id, friend, amount, desc, created FROM records WHERE owner = (?) AND id = (?)"
         stmt = "DELETE FROM records WHERE owner = (?) AND id = (?)"
         args = (owner, id)
 
-        # Execute statement
-        res = self.conn.execute(stmt, args)
+        def delete(conn):
+            for id, friend, amount, desc, created in conn.execute(select, args).fetchall():
+                self._log(conn, owner, [("delete", friend, -amount, -1, {"id": id, "amount": amount, "desc": desc, "created": created})])
+            return conn.execute(stmt, args).rowcount
 
-        # Commit to database
-        self.conn.commit()
+        # Execute statements and commit to database
+        return self._submit(delete)
+
+    def undo(self, owner):
+        """Revert the user's latest operation that is still in the log and not reverted yet
+        Returns the (kind, friend, amount, count, payload) events it reverted, or None if there is nothing to undo"""
+        def undo(conn):
+            # Walk back from the latest operation, past the ones that were reverted already
+            row = conn.execute("SELECT op FROM events e WHERE owner = (?) AND kind != 'undo' AND NOT EXISTS "
+                               "(SELECT 1 FROM events u WHERE u.owner = e.owner AND u.reverts = e.op) ORDER BY op DESC LIMIT 1", (owner,)).fetchone()
+            if row is None:
+                return None
+            op = row[0]
 
-        return [x for x in res]
+            events = [(kind, friend, amount, count, json.loads(payload)) for kind, friend, amount, count, payload in
+                      conn.execute("SELECT kind, friend, amount, count, payload FROM events WHERE owner = (?) AND op = (?) ORDER BY id", (owner, op))]
 
-    def check_recent(self, owner):
-        """Returns all records of user in reverse order"""
+            # Put back what each event changed, newest first
+            for kind, friend, amount, count, payload in reversed(events):
+                if kind == "add":
+                    if not conn.execute("DELETE FROM records WHERE owner = (?) AND id = (?)", (owner, payload["id"])).rowcount:
+                        # Moved to the archive since, where it still counted towards the total
+                        if conn.execute(f"DELETE FROM {self.archived} WHERE owner = (?) AND id = (?) AND cleared = 0", (owner, payload["id"])).rowcount:
+                            self._adjust_balance(conn, owner, friend, -payload["amount"], -1)
+                elif kind == "delete":
+                    conn.execute("INSERT INTO records (id, owner, amount, friend, desc, created) VALUES (?, ?, ?, ?, ?, ?)",
+                                 (payload["id"], owner, payload["amount"], friend, payload["desc"], payload.get("created")))
+                elif kind == "clear":
+                    # Cleared records go back from the archive. Older entries in the log don't have created
+                    records = [(row[0], owner, row[2], row[1], row[3], row[4] if len(row) > 4 else None) for row in payload["records"]]
+                    conn.executemany(f"DELETE FROM {self.archived} WHERE id = (?)", [(x[0],) for x in records])
+                    conn.executemany("INSERT INTO records (id, owner, amount, friend, desc, created) VALUES (?, ?, ?, ?, ?, ?)", records)
+
+                    # Records that were already archived stay there, counting towards the total again
+                    for id in payload.get("archived", []):
+                        row = conn.execute(f"SELECT friend, amount FROM {self.archived} WHERE id = (?)", (id,)).fetchone()
+                        conn.execute(f"UPDATE {self.archived} SET cleared = 0 WHERE id = (?)", (id,))
+                        self._adjust_balance(conn, owner, row[0], row[1], 1)
+                elif kind == "default":
+                    if payload["previous"] is None:
+                        conn.execute("DELETE FROM `pref` WHERE userID = (?)", (owner,))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO `pref` (userID, defaultFriend) VALUES (?, ?)", (owner, payload["previous"]))
+
+            # Reverting is an operation of its own, with the opposite changes
+            self._log(conn, owner, [("undo", friend, -amount, -count, {"kind": kind}) for kind, friend, amount, count, payload in events], reverts=op)
+            return events
+
+        # Execute statements and commit to database. Records coming back may change the friend list, and the default may change
+        friends, default = self._invalidate(owner, "friends"), self._invalidate(owner, "default")
+        return self._submit(undo, lambda: (friends(), default()))
+
+    def archive_records(self, before, batch=ARCHIVE_BATCH):
+        """Move up to batch of the oldest records added before the Unix time before to the archive
+        They still count towards balances. Returns the number of records moved"""
+        def archive(conn):
+            rows = conn.execute("SELECT id, owner, amount, friend, desc, created FROM records WHERE created < (?) ORDER BY created LIMIT (?)", (before, batch)).fetchall()
+
+            now = int(time.time())
+            # Replacing makes moving the same record again harmless, should a move to a separate archive file have been cut short
+            conn.executemany(f"INSERT OR REPLACE INTO {self.archived} (id, owner, amount, friend, desc, created, archived) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [row + (now,) for row in rows])
+
+            # Count them twice before deleting them, so the totals stay the same and no balance row drops out in between
+            conn.executemany("INSERT INTO balances (owner, friend, total, count) VALUES (?, ?, ?, 1) "
+                             "ON CONFLICT (owner, friend) DO UPDATE SET total = total + excluded.total, count = count + 1",
+                             [(owner, friend, amount) for id, owner, amount, friend, desc, created in rows])
+            conn.executemany("DELETE FROM records WHERE id = (?)", [(x[0],) for x in rows])
+
+            return len(rows)
+
+        return self._submit(archive)
+
+    def check_history(self, owner, friend=None, before=None, limit=HISTORY_PAGE_SIZE):
+        """Returns a page of the user's archived (id, owner, amount, friend, desc, cleared) records, newest first
+        Only records with friend if it is given. Pass before=ID for the page of older records"""
         # Prepare statement
-        stmt = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?)"
-        args = (owner,)
-        
-        res = [x for x in self.conn.execute(stmt, args)]
+        # Without a cursor, start past the highest possible ID
+        before = before if before is not None else 2 ** 63 - 1
+        if friend:
+            stmt = f"SELECT id, owner, amount, friend, desc, cleared FROM {self.archived} WHERE owner = (?) AND friend = (?) COLLATE NOCASE AND id < (?) ORDER BY id DESC LIMIT (?)"
+            args = (owner, friend, before, limit)
+        else:
+            stmt = f"SELECT id, owner, amount, friend, desc, cleared FROM {self.archived} WHERE owner = (?) AND id < (?) ORDER BY id DESC LIMIT (?)"
+            args = (owner, before, limit)
 
-        if res:
-            return reversed(res)
-        return None
+        return [x for x in self.reader.execute(stmt, args)]
+
+    def event_balance(self, owner, friend):
+        """Returns the total in cents and number of records with a friend according to the log,
+        as the friend's snapshot plus the events since"""
+        # Prepare statements
+        snapshot = "SELECT event, total, count FROM snapshots WHERE owner = (?) AND friend = (?)"
+        tail = "SELECT IFNULL(SUM(amount), 0), IFNULL(SUM(count), 0) FROM events WHERE owner = (?) AND friend = (?) AND id > (?)"
+
+        event, total, count = self.reader.execute(snapshot, (owner, friend)).fetchone() or (0, 0, 0)
+        amount, records = self.reader.execute(tail, (owner, friend, event)).fetchone()
+
+        return total + amount, count + records
+
+    def compact_events(self, before, batch=EVENT_COMPACT_BATCH):
+        """Fold up to batch of the oldest events created before the Unix time before into the snapshots, and drop them
+        Returns the number of events folded. Folded operations can no longer be undone"""
+        def compact(conn):
+            last = conn.execute("SELECT MAX(id) FROM (SELECT id FROM events WHERE created < (?) ORDER BY id LIMIT (?))", (before, batch)).fetchone()[0]
+            if last is None:
+                return 0
+
+            # Never split an operation, so /undo always reverts whole ones. Its events are next to each other
+            last = conn.execute("SELECT MAX(e.id) FROM events c JOIN events e ON e.owner = c.owner AND e.op = c.op WHERE c.id = (?)", (last,)).fetchone()[0]
+
+            conn.execute("INSERT INTO snapshots (owner, friend, event, total, count) "
+                         "SELECT owner, friend, MAX(id), SUM(amount), SUM(count) FROM events WHERE id <= (?) AND friend IS NOT NULL GROUP BY owner, friend "
+                         "ON CONFLICT (owner, friend) DO UPDATE SET event = excluded.event, total = total + excluded.total, count = count + excluded.count", (last,))
+            return conn.execute("DELETE FROM events WHERE id <= (?)", (last,)).rowcount
+
+        return self._submit(compact)
+
+    def check_recent(self, owner, before=None, after=None, limit=RECENT_PAGE_SIZE):
+        """Returns a page of the user's records, newest first
+        Pass before=ID for the page of older records, or after=ID for the page of newer ones"""
+        # Prepare statement
+        if after is not None:
+            # Walk forwards from the cursor, then flip back to newest first
+            stmt = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id > (?) ORDER BY id ASC LIMIT (?)"
+            args = (owner, after, limit)
+            return [x for x in self.reader.execute(stmt, args)][::-1]
+
+        if before is not None:
+            stmt = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id < (?) ORDER BY id DESC LIMIT (?)"
+            args = (owner, before, limit)
+        else:
+            stmt = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) ORDER BY id DESC LIMIT (?)"
+            args = (owner, limit)
+
+        return [x for x in self.reader.execute(stmt, args)]
 
     def check_records(self, owner, friend):
         """Returns records between the user and a friend"""
         # Prepare statement
-        stmt = "SELECT amount, desc FROM records WHERE owner = (?) AND friend like (?)"
+        stmt = "SELECT amount, desc FROM records WHERE owner = (?) AND friend = (?) COLLATE NOCASE"
         args = (owner, friend,)
 
-        return [x for x in self.conn.execute(stmt, args)]
+        return [x for x in self.reader.execute(stmt, args)]
+
+    def iter_records(self, owner, chunk_size=EXPORT_CHUNK_SIZE):
+        """Yields every (id, amount, friend, desc) record of the user that counts towards a total,
+        the archived ones first, then the others, oldest first
+        Rows are fetched chunk_size at a time, so the whole ledger is never held in memory"""
+        # Prepare statements
+        stmts = [f"SELECT id, amount, friend, desc FROM {self.archived} a WHERE owner = (?) AND cleared = 0 AND NOT EXISTS (SELECT 1 FROM records r WHERE r.id = a.id) ORDER BY id",
+                 "SELECT id, amount, friend, desc FROM records WHERE owner = (?) ORDER BY id"]
+        args = (owner,)
+
+        # A cursor of its own, so other reads on this thread don't reset it
+        cursor = self.reader.cursor()
+        try:
+            for stmt in stmts:
+                cursor.execute(stmt, args)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+        finally:
+            cursor.close()
+
+    def get_balance(self, owner, friend):
+        """Returns the (total in cents, count) of records between the user and a friend"""
+        # Prepare statement
+        stmt = "SELECT total, count FROM balances WHERE owner = (?) AND friend = (?)"
+        args = (owner, friend)
+
+        res = self.reader.execute(stmt, args).fetchone()
+
+        # No records means nothing is owed
+        return res if res else (0, 0)
+
+    def check_balances(self, owner, offset=0, limit=BALANCES_PAGE_SIZE):
+        """Returns a page of (friend, total in cents, count) for every friend of the user, largest amounts first,
+        along with the net total in cents and the number of friends"""
+        # Prepare statement
+        # The window functions add the totals over all friends to every row, so one query does it all
+        stmt = "SELECT friend, total, count, SUM(total) OVER (), COUNT(*) OVER () FROM balances WHERE owner = (?) ORDER BY ABS(total) DESC, friend LIMIT (?) OFFSET (?)"
+        args = (owner, limit, offset)
+
+        data = [x for x in self.reader.execute(stmt, args)]
+
+        # No records at all
+        if not data:
+            return [], 0, 0
+
+        return [x[:3] for x in data], data[0][3], data[0][4]
+
+    def search_records(self, owner, terms, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Returns a page of the user's records whose friend or description contains every term, best matches first
+        Fetches one record past the page, so callers can tell whether there is another page"""
+        # Prepare statement
+        # The full-text index finds the matching records without reading the others.
+        # It can't tell a negative owner (group chats) from a positive one, so records are checked too
+        stmt = "SELECT r.id, r.owner, r.amount, r.friend, r.desc FROM records_fts JOIN records r ON r.id = records_fts.rowid WHERE records_fts MATCH (?) AND r.owner = (?) ORDER BY records_fts.rank, r.id DESC LIMIT (?) OFFSET (?)"
+        args = (search_query(owner, terms), owner, limit + 1, offset)
+
+        return [x for x in self.reader.execute(stmt, args)]
+
+    def verify_balances(self):
+        """Returns every (owner, friend, stored total, actual total, stored count, actual count) where balances has drifted from records"""
+        # Archived records that weren't cleared still count, once if they are in both tables
+        stmt = f"""
+            WITH actual AS (
+                SELECT owner, friend, SUM(amount) AS total, COUNT(*) AS count FROM (
+                    SELECT owner, friend, amount FROM records
+                    UNION ALL
+                    SELECT owner, friend, amount FROM {self.archived} a WHERE cleared = 0 AND NOT EXISTS (SELECT 1 FROM records r WHERE r.id = a.id)
+                ) GROUP BY owner, friend COLLATE NOCASE
+            )
+            SELECT a.owner, a.friend, b.total, a.total, b.count, a.count FROM actual a
+                LEFT JOIN balances b ON b.owner = a.owner AND b.friend = a.friend COLLATE NOCASE
+                WHERE b.owner IS NULL OR b.total != a.total OR b.count != a.count
+            UNION ALL
+            SELECT b.owner, b.friend, b.total, 0, b.count, 0 FROM balances b
+                WHERE NOT EXISTS (SELECT 1 FROM actual a WHERE a.owner = b.owner AND a.friend = b.friend COLLATE NOCASE)
+        """
+
+        return [x for x in self.reader.execute(stmt)]
+
+    def verify_archive(self):
+        """Returns the IDs of records that are both in records and in the archive, left by a move to a separate
+        archive file that was cut short. The next archive_records run moves them again"""
+        stmt = f"SELECT a.id FROM {self.archived} a JOIN records r ON r.id = a.id ORDER BY a.id"
+
+        return [x[0] for x in self.reader.execute(stmt)]
+
+    def verify_events(self):
+        """Returns every (owner, friend, stored total, logged total, stored count, logged count) where balances
+        differs from the snapshots plus the events since"""
+        stmt = """
+            WITH logged AS (
+                SELECT owner, friend, SUM(total) AS total, SUM(count) AS count FROM (
+                    SELECT owner, friend, total, count FROM snapshots
+                    UNION ALL
+                    SELECT owner, friend, amount, count FROM events WHERE friend IS NOT NULL
+                ) GROUP BY owner, friend COLLATE NOCASE
+            )
+            SELECT l.owner, l.friend, IFNULL(b.total, 0), l.total, IFNULL(b.count, 0), l.count FROM logged l
+                LEFT JOIN balances b ON b.owner = l.owner AND b.friend = l.friend COLLATE NOCASE
+                WHERE IFNULL(b.total, 0) != l.total OR IFNULL(b.count, 0) != l.count
+            UNION ALL
+            SELECT b.owner, b.friend, b.total, 0, b.count, 0 FROM balances b
+                WHERE NOT EXISTS (SELECT 1 FROM logged l WHERE l.owner = b.owner AND l.friend = b.friend COLLATE NOCASE)
+        """
+
+        return [x for x in self.reader.execute(stmt)]
+
+    def verify_group_balances(self):
+        """Returns every (chat, member, stored net, actual net) where group_balances has drifted from the expenses"""
+        stmt = """
+            WITH movements AS (
+                SELECT chat, payer AS member, amount AS net FROM group_expenses
+                UNION ALL
+                SELECT chat, member, -share FROM group_shares
+            ), actual AS (SELECT chat, member, SUM(net) AS net FROM movements GROUP BY chat, member)
+            SELECT a.chat, a.member, IFNULL(b.net, 0), a.net FROM actual a
+                LEFT JOIN group_balances b ON b.chat = a.chat AND b.member = a.member
+                WHERE IFNULL(b.net, 0) != a.net
+            UNION ALL
+            SELECT b.chat, b.member, b.net, 0 FROM group_balances b
+                WHERE b.net != 0 AND NOT EXISTS (SELECT 1 FROM actual a WHERE a.chat = b.chat AND a.member = b.member)
+        """
+
+        return [x for x in self.reader.execute(stmt)]
+
+    def verify_search_index(self):
+        """Returns whether the full-text index matches the records table"""
+        # FTS5 commands are written as inserts, so this goes through the write connection
+        def check(conn):
+            try:
+                conn.execute("INSERT INTO records_fts (records_fts, rank) VALUES ('integrity-check', 1)")
+            except sqlite3.DatabaseError:
+                return False
+            return True
+
+        return self._submit(check).result()
+
+    def rebuild_balances(self):
+        """Recompute the balances and group_balances tables, and the full-text index, from scratch out of records, the archive and expenses"""
+        def rebuild(conn):
+            conn.execute("INSERT INTO records_fts (records_fts) VALUES ('rebuild')")
+            conn.execute("DELETE FROM balances")
+            conn.execute("INSERT INTO balances (owner, friend, total, count) SELECT owner, friend, SUM(amount), COUNT(*) FROM "
+                         f"(SELECT owner, friend, amount FROM records UNION ALL SELECT owner, friend, amount FROM {self.archived} a "
+                         "WHERE cleared = 0 AND NOT EXISTS (SELECT 1 FROM records r WHERE r.id = a.id)) "
+                         "GROUP BY owner, friend COLLATE NOCASE")
+            conn.execute("DELETE FROM group_balances")
+            conn.execute("INSERT INTO group_balances (chat, member, net) SELECT chat, member, SUM(net) FROM "
+                         "(SELECT chat, payer AS member, amount AS net FROM group_expenses UNION ALL SELECT chat, member, -share FROM group_shares) "
+                         "GROUP BY chat, member")
+
+        return self._submit(rebuild)
 
     def get_record_by_ID(self, owner, id):
         """Returns single record by owner and ID"""
@@ -87,45 +917,55 @@ class DBHelper:
         stmt = "SELECT id, owner, amount, friend, desc FROM records WHERE owner = (?) AND id = (?)"
         args = (owner, id)
 
-        return [x for x in self.conn.execute(stmt, args)]
+        return [x for x in self.reader.execute(stmt, args)]
 
-    def check_friends(self, owner):
-        """Returns a list of all (unique) previously tabulated friends"""
-        stmt = "SELECT friend FROM records WHERE owner = (?)"
-        args = (owner,)
-        
-        # Create a set to keep track of seen names and result list to return
-        seen, result = set(), []
-        
-        # For every entry,
-        for friend in self.conn.execute(stmt, args):
-            # If new unique name
-            if friend[0].lower() not in seen:
-                # Add to seen set and append to results
-                seen.add(friend[0].lower())
-                result.append(friend[0])
-                
-        # Returns only unique names regardless of capitalization
-        return result
+    def check_friends(self, owner, limit=FRIENDS_LIMIT):
+        """Returns the user's most recently used friends, newest first"""
+        # Prepare statement
+        stmt = "SELECT display_name FROM friends WHERE owner = (?) ORDER BY last_used DESC LIMIT (?)"
+        args = (owner, limit)
+
+        # Names are already unique regardless of capitalization.
+        # Callers add their own buttons to the list, so they get a copy of the cached one
+        return list(self._cached(owner, ("friends", limit), lambda: [x[0] for x in self.reader.execute(stmt, args)]))
     
+    def search_friends(self, owner, prefix, limit=INLINE_RESULTS_LIMIT):
+        """Returns the (name, total in cents, count) of the user's friends whose name starts with prefix, most recently used first"""
+        # name_key is casefolded, so "él" finds Élodie
+        key = prefix.casefold()
+
+        # Prepare statement
+        # Names starting with the prefix are a range of the (owner, name_key) key, ending before prefix + the highest code point.
+        # Totals and counts come from balances, so no records are read
+        stmt = "SELECT f.display_name, IFNULL(b.total, 0), IFNULL(b.count, 0) FROM friends f LEFT JOIN balances b ON b.owner = f.owner AND b.friend = f.display_name WHERE f.owner = (?) AND f.name_key >= (?) AND f.name_key < (?) ORDER BY f.last_used DESC LIMIT (?)"
+        args = (owner, key, key + "\U0010ffff", limit)
+
+        return [x for x in self.reader.execute(stmt, args)]
+
     def check_default(self, owner):
         """Returns the default friend defined by the user"""
         # Prepare statement
         stmt = "SELECT defaultFriend FROM pref WHERE userID = (?)"
         args = (owner,)
-        return [x for x in self.conn.execute(stmt, args)]
+        return list(self._cached(owner, ("default",), lambda: [x for x in self.reader.execute(stmt, args)]))
     
+    def _change_default(self, owner, stmt, args, friend):
+        """Run stmt to change the default friend, logging the previous one for /undo"""
+        def change(conn):
+            previous = conn.execute("SELECT defaultFriend FROM pref WHERE userID = (?)", (owner,)).fetchone()
+            self._log(conn, owner, [("default", None, 0, 0, {"friend": friend, "previous": previous[0] if previous else None})])
+            return conn.execute(stmt, args).rowcount
+
+        # Execute statements and commit to database
+        return self._submit(change, self._invalidate(owner, "default"))
+
     def set_default(self, owner, friend):
         """Sets default friend of user"""
         # Prepare statement
         stmt = "INSERT OR REPLACE INTO `pref` (userID, defaultFriend) VALUES (?, ?)"
         args = (owner, friend)
 
-        # Execute statement
-        self.conn.execute(stmt, args)
-
-        # Commit to database
-        self.conn.commit()
+        return self._change_default(owner, stmt, args, friend)
 
     def delete_default(self, owner):
         """Deletes default friend of user"""
@@ -133,19 +973,166 @@ class DBHelper:
         stmt = "DELETE FROM `pref` WHERE userID = (?)"
         args = (owner,)
 
-        # Execute statement
-        self.conn.execute(stmt, args)
-
-        # Commit to database
-        self.conn.commit()
+        return self._change_default(owner, stmt, args, None)
     
+    def join_group(self, chat, user, name):
+        """Adds the user to the shared ledger of a group chat, or updates their name"""
+        # Prepare statement
+        stmt = "INSERT INTO group_members (chat, user, name) VALUES (?, ?, ?) ON CONFLICT (chat, user) DO UPDATE SET name = excluded.name"
+        args = (chat, user, name)
+
+        # Execute statement and commit to database
+        return self._execute(stmt, args)
+
+    def check_members(self, chat):
+        """Returns the (user, name) of every member of a group chat's ledger"""
+        # Prepare statement
+        stmt = "SELECT user, name FROM group_members WHERE chat = (?) ORDER BY name"
+        args = (chat,)
+
+        return [x for x in self.reader.execute(stmt, args)]
+
+    def add_expense(self, chat, payer, amount, shares, desc=""):
+        """Add an expense of a group chat, paid by payer and split into (member, share) shares, all in cents
+        The shares must add up to the amount, which keeps the group's balances adding up to zero"""
+        if sum(share for member, share in shares) != amount:
+            raise ValueError("Shares don't add up to the amount")
+
+        def add(conn):
+            # Prepare statements
+            expense = conn.execute("INSERT INTO group_expenses (chat, payer, amount, desc) VALUES (?, ?, ?, ?)",
+                                   (chat, payer, amount, desc)).lastrowid
+            conn.executemany("INSERT INTO group_shares (expense, chat, member, share) VALUES (?, ?, ?, ?)",
+                             [(expense, chat, member, share) for member, share in shares])
+            return expense
+
+        # Execute statements and commit to database
+        return self._submit(add)
+
+    def get_group_balances(self, chat):
+        """Returns the (member, name, net in cents) of every member of a group chat who isn't settled up"""
+        # Prepare statement
+        # Balances are kept per member by triggers, so this is one row per member whatever the number of expenses
+        stmt = "SELECT b.member, m.name, b.net FROM group_balances b LEFT JOIN group_members m ON m.chat = b.chat AND m.user = b.member WHERE b.chat = (?) AND b.net != 0"
+        args = (chat,)
+
+        return [x for x in self.reader.execute(stmt, args)]
+
+    def load_user_data(self, user_id):
+        """Returns the pickled user_data of a user, or None if there is none"""
+        # Prepare statement
+        stmt = "SELECT data FROM user_data WHERE user_id = (?)"
+        args = (user_id,)
+
+        res = self.reader.execute(stmt, args).fetchone()
+        return res[0] if res else None
+
+    def load_conversation(self, name, key):
+        """Returns the state of a conversation, or None if it is not in one"""
+        # Prepare statement
+        stmt = "SELECT state FROM conversations WHERE name = (?) AND key = (?)"
+        args = (name, key)
+
+        res = self.reader.execute(stmt, args).fetchone()
+        return res[0] if res else None
+
+    def save_persistence(self, user_data, conversations):
+        """Save changed user_data {user ID: data} and conversations {(name, key): state} in one transaction
+        A value of None deletes the entry"""
+        def save(conn):
+            conn.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                             [(k, v) for k, v in user_data.items() if v is not None])
+            conn.executemany("DELETE FROM user_data WHERE user_id = (?)",
+                             [(k,) for k, v in user_data.items() if v is None])
+            conn.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                             [(name, key, v) for (name, key), v in conversations.items() if v is not None])
+            conn.executemany("DELETE FROM conversations WHERE name = (?) AND key = (?)",
+                             [(name, key) for (name, key), v in conversations.items() if v is None])
+
+        return self._submit(save)
+
     def test(self):
         stmt = "INSERT INTO pref (userID, defaultFriend) VALUES (?, ?)"
         args = ('1264592652', 'bruh')
         print([x for x in self.conn.execute(stmt, args)])
         self.conn.commit()
         
-    
-# db = DBHelper()
-# db.setup()
-# print(db.set_default('1264592652', 'asd'))
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bot's database")
+    parser.add_argument("--db", default="debt.sqlite", help="path to the database file")
+    parser.add_argument("--archive", default=None, help="path to the archive database file, if it has one of its own")
+    parser.add_argument("command", choices=["setup", "explain", "verify", "rebuild", "compact", "archive"])
+    parser.add_argument("--days", type=float, default=30, help="compact: fold events older than this many days into snapshots, "
+                                                               "archive: move records older than this many days to the archive")
+    opts = parser.parse_args()
+
+    db = DBHelper(opts.db, archive=opts.archive)
+    db.setup()
+
+    if opts.command == "explain":
+        print(f"{db.check_query_plans()} queries use an index")
+
+    elif opts.command in ("verify", "rebuild"):
+        # Report drift between balances and records
+        drift = db.verify_balances()
+        for owner, friend, stored, actual, storedCount, actualCount in drift:
+            print(f"{owner} {friend}: stored {stored} ({storedCount}), actual {actual} ({actualCount})")
+        print(f"{len(drift)} balance(s) drifted")
+
+        # And between group_balances and the group expenses
+        groupDrift = db.verify_group_balances()
+        for chat, member, stored, actual in groupDrift:
+            print(f"group {chat} member {member}: stored {stored}, actual {actual}")
+        print(f"{len(groupDrift)} group balance(s) drifted")
+        drift += groupDrift
+
+        # And between the full-text index and records
+        if not db.verify_search_index():
+            print("Search index is out of sync")
+            drift.append("search")
+
+        # And records left in both tables by a move to the archive
+        both = db.verify_archive()
+        if both:
+            print(f"Records in both records and the archive: {', '.join(map(str, both))}")
+        print(f"{len(both)} record(s) in both records and the archive")
+        drift += both
+
+        # And between balances and the event log, which rebuilding doesn't change
+        logDrift = db.verify_events()
+        for owner, friend, stored, logged, storedCount, loggedCount in logDrift:
+            print(f"{owner} {friend}: stored {stored} ({storedCount}), logged {logged} ({loggedCount})")
+        print(f"{len(logDrift)} balance(s) differ from the event log")
+        drift += logDrift
+
+        if opts.command == "rebuild":
+            db.rebuild_balances().result()
+            print("Rebuilt balances from records, the archive and group expenses")
+
+        elif drift:
+            raise SystemExit(1)
+
+    elif opts.command == "compact":
+        # Fold a batch at a time, letting other writes in between
+        before = time.time() - opts.days * 86400
+        total = 0
+        while True:
+            folded = db.compact_events(before).result()
+            if not folded:
+                break
+            total += folded
+        print(f"Folded {total} event(s) into snapshots")
+
+    elif opts.command == "archive":
+        # Move a batch at a time, letting other writes in between
+        before = time.time() - opts.days * 86400
+        total = 0
+        while True:
+            moved = db.archive_records(before).result()
+            if not moved:
+                break
+            total += moved
+        print(f"Moved {total} record(s) to the archive")
+
+    db.close()
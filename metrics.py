@@ -0,0 +1,187 @@
+"""Latency, row and error metrics, exposed in the Prometheus text format
+
+Nothing is measured unless instrument_* is called, so with metrics disabled the
+handlers and database methods run exactly as before.
+"""
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram.ext import ConversationHandler, ExtBot
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+class Registry:
+    """Holds every metric by name and label"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+        # Functions returning [(name, label, value)] for gauges read at scrape time
+        self.collectors = []
+
+    def observe(self, name, label, value):
+        """Add a sample to the histogram name{label}, where label is a (key, value) pair"""
+        with self.lock:
+            self.histograms.setdefault((name, label), Histogram()).observe(value)
+
+    def inc(self, name, label, amount=1):
+        """Increase the counter name{label}"""
+        with self.lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def declare(name, kind):
+            # Each metric family is declared once, before its first sample
+            if f'# TYPE {name} {kind}' not in lines:
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            for (name, (key, value)), hist in sorted(self.histograms.items()):
+                declare(name, 'histogram')
+                total = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    total += count
+                    lines.append(f'{name}_bucket{{{key}="{value}",le="{bound}"}} {total}')
+                lines.append(f'{name}_bucket{{{key}="{value}",le="+Inf"}} {hist.count}')
+                lines.append(f'{name}_sum{{{key}="{value}"}} {hist.sum}')
+                lines.append(f'{name}_count{{{key}="{value}"}} {hist.count}')
+
+            for (name, (key, value)), count in sorted(self.counters.items()):
+                declare(name, 'counter')
+                lines.append(f'{name}{{{key}="{value}"}} {count}')
+
+        for collect in self.collectors:
+            for name, (key, value), gauge in collect():
+                declare(name, 'gauge')
+                lines.append(f'{name}{{{key}="{value}"}} {gauge}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Short human-readable overview: count, average and errors of every timed operation"""
+        lines = []
+
+        with self.lock:
+            for (name, label), hist in sorted(self.histograms.items()):
+                errors = self.counters.get((name.replace('_seconds', '_errors_total'), label), 0)
+                lines.append(f'{label[0]} {label[1]}: {hist.count} calls, avg {hist.sum / hist.count * 1000:.1f}ms, {errors} errors')
+
+        return lines
+
+registry = Registry()
+
+def timed(name, key, fn, rows=None):
+    """Wrap fn so every call is timed into name{key}, counting errors and optionally rows"""
+    label = (key, fn.__name__)
+    errors = name.replace('_seconds', '_errors_total')
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            registry.inc(errors, label)
+            raise
+
+        if isinstance(result, Future):
+            # Writes finish later, possibly on the writer thread
+            def done(future):
+                registry.observe(name, label, time.perf_counter() - start)
+                if future.exception():
+                    registry.inc(errors, label)
+                elif rows and isinstance(future.result(), int):
+                    registry.inc(rows, label, future.result())
+            result.add_done_callback(done)
+            return result
+
+        registry.observe(name, label, time.perf_counter() - start)
+        if rows and isinstance(result, list):
+            registry.inc(rows, label, len(result))
+        return result
+
+    return wrapper
+
+def instrument_handlers(handlers):
+    """Time the callback of every handler, including those inside conversations"""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            inner = list(handler.entry_points) + list(handler.fallbacks)
+            for state in handler.states.values():
+                inner += state
+            instrument_handlers(inner)
+        elif not getattr(handler.callback, '__wrapped__', None):
+            handler.callback = timed('bot_handler_seconds', 'handler', handler.callback)
+
+def instrument_dispatcher(dispatcher):
+    """Time every handler registered on the dispatcher"""
+    for group in dispatcher.handlers.values():
+        instrument_handlers(group)
+
+def instrument_db(db, methods):
+    """Time the given DBHelper methods, counting the rows they return or change"""
+    for method in methods:
+        # Already instrumented, e.g. by an earlier dispatcher sharing the same database
+        if getattr(getattr(db, method), '__wrapped__', None):
+            continue
+        setattr(db, method, timed('bot_db_seconds', 'method', getattr(db, method), rows='bot_db_rows_total'))
+
+class TimedBot(ExtBot):
+    """Bot that times every Telegram API call"""
+    def _post(self, endpoint, *args, **kwargs):
+        label = ('endpoint', endpoint)
+        start = time.perf_counter()
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except Exception:
+            registry.inc('bot_api_errors_total', label)
+            raise
+        finally:
+            registry.observe('bot_api_seconds', label, time.perf_counter() - start)
+
+def serve(listen='127.0.0.1', port=9100):
+    """Serve the metrics on http://listen:port/metrics from a background thread"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics: " + format, *args)
+
+    httpd = ThreadingHTTPServer((listen, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics-server", daemon=True).start()
+    return httpd
@@ -0,0 +1,231 @@
+"""Outbound message queue: handlers queue their replies instead of waiting on Telegram
+
+Messages are sent by background threads, in order for each chat, within
+Telegram's rate limits. Consecutive messages waiting for the same chat are
+merged into a single sendMessage call where that doesn't change what the user sees.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from statestore import StateStore
+
+# Longest text of a single message
+MAX_LENGTH = 4096
+
+# Put between the texts of merged messages
+SEPARATOR = '\n\n'
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `capacity`"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait(self, now):
+        """Seconds until a token is available, 0 if there is one now"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Message:
+    """A queued sendMessage call"""
+    def __init__(self, chat_id, text, kwargs):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+
+        # When each of the messages merged into this one was queued
+        self.queued = [time.monotonic()]
+
+    def merge(self, other):
+        """Append other to this message if the user would see the same thing, returns whether it did"""
+        # Inline buttons belong under their own message
+        if isinstance(self.kwargs.get('reply_markup'), InlineKeyboardMarkup):
+            return False
+
+        # Everything but the keyboard must match
+        mine = {k: v for k, v in self.kwargs.items() if k != 'reply_markup'}
+        theirs = {k: v for k, v in other.kwargs.items() if k != 'reply_markup'}
+        if mine != theirs or len(self.text) + len(SEPARATOR) + len(other.text) > MAX_LENGTH:
+            return False
+
+        # A reply keyboard applies to the whole chat, so the last one sent is the one that counts
+        self.text += SEPARATOR + other.text
+        if other.kwargs.get('reply_markup') is not None:
+            self.kwargs['reply_markup'] = other.kwargs['reply_markup']
+        self.queued += other.queued
+        return True
+
+class Outbox:
+    """Sends queued messages from `workers` threads
+    At most global_rate messages per second are sent overall and chat_rate per chat
+    (group_rate for groups, which have negative IDs). With workers=0 nothing is sent
+    until flush() is called, and chats aren't limited: flushing is for short-lived serverless
+    instances, where a per-process limit only delays the reply and limits nothing overall"""
+    def __init__(self, bot, workers=4, global_rate=30, chat_rate=1, group_rate=20 / 60, burst=3, observe=None):
+        self.bot = bot
+        self.cond = threading.Condition()
+
+        # Chat ID -> list of queued messages, and a heap of (due time, sequence, chat ID)
+        # with every chat that has messages and is not being sent to right now
+        self.chats = {}
+        self.ready = []
+        self.sequence = itertools.count()
+        self.busy = 0
+
+        # Rate limits. Buckets of chats that have been quiet for a minute are full again, so they can go
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = StateStore(lambda chat_id: TokenBucket(group_rate if chat_id < 0 else chat_rate, burst), ttl=60)
+
+        # Metrics. observe(seconds) is called with the time from queueing to delivery of every message
+        self.observe = observe
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.stopping = False
+        self.threads = [threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def send(self, chat_id, text, **kwargs):
+        """Queue a message, taking the same arguments as Bot.send_message"""
+        with self.cond:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = []
+                heapq.heappush(self.ready, (time.monotonic(), next(self.sequence), chat_id))
+            self.chats[chat_id].append(Message(chat_id, text, kwargs))
+            self.queued += 1
+            self.cond.notify()
+
+    def _next(self, block):
+        """Take the next message that may be sent now, waiting for one if block is set
+        Returns None once there is nothing left to send (or when stopping)"""
+        with self.cond:
+            while True:
+                if not self.ready:
+                    if not block or (self.stopping and not self.chats):
+                        return None
+                    self.cond.wait()
+                    continue
+
+                # Wait for the chat that is due first
+                now = time.monotonic()
+                due, _, chat_id = self.ready[0]
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+
+                # Both the global and the chat's limit must allow another message
+                bucket = self.buckets[chat_id] if self.threads else None
+                wait = max(self.bucket.wait(now), bucket.wait(now) if bucket else 0)
+                if wait:
+                    heapq.heapreplace(self.ready, (now + wait, next(self.sequence), chat_id))
+                    continue
+
+                heapq.heappop(self.ready)
+                self.bucket.take()
+                if bucket:
+                    bucket.take()
+
+                # Merge whatever else is waiting for this chat into the first message
+                queue = self.chats[chat_id]
+                message = queue.pop(0)
+                while queue and message.merge(queue[0]):
+                    queue.pop(0)
+                    self.merged += 1
+
+                # The chat stays out of the heap while its message is in flight, keeping its messages in order
+                self.busy += 1
+                return message
+
+    def _done(self, message, retry=0):
+        """Put the chat back in line after sending, or the message itself if it must be retried"""
+        with self.cond:
+            self.busy -= 1
+            queue = self.chats[message.chat_id]
+            if retry:
+                queue.insert(0, message)
+            if queue:
+                heapq.heappush(self.ready, (time.monotonic() + retry, next(self.sequence), message.chat_id))
+            else:
+                del self.chats[message.chat_id]
+            self.cond.notify_all()
+
+    def _send(self, message):
+        try:
+            self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except RetryAfter as e:
+            # Flood control: try again when Telegram says so
+            logging.warning("Rate limited by Telegram for %ss in chat %s", e.retry_after, message.chat_id)
+            self._done(message, retry=e.retry_after)
+            return
+        except Exception:
+            self.errors += 1
+            logging.exception("Error sending message to chat %s", message.chat_id)
+        else:
+            now = time.monotonic()
+            for queued in message.queued:
+                self.sent += 1
+                self.total_wait += now - queued
+                self.max_wait = max(self.max_wait, now - queued)
+                if self.observe:
+                    self.observe(now - queued)
+
+        self._done(message)
+
+    def _run(self):
+        """Sender thread"""
+        while True:
+            message = self._next(block=True)
+            if message is None:
+                break
+            self._send(message)
+
+    def flush(self):
+        """Send everything queued so far from the calling thread, waiting on the rate limits as needed"""
+        while True:
+            message = self._next(block=False)
+            if message is None:
+                break
+            self._send(message)
+
+        # Wait for messages already being sent by the workers
+        with self.cond:
+            while self.busy or (self.threads and self.chats):
+                self.cond.wait()
+
+    def stats(self):
+        """Returns queue depth, delivery and latency metrics"""
+        with self.cond:
+            depth = sum(len(x) for x in self.chats.values())
+
+        return {
+            'depth': depth,
+            'queued': self.queued,
+            'sent': self.sent,
+            'merged': self.merged,
+            'errors': self.errors,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def stop(self):
+        """Send what is still queued, then stop the sender threads"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,172 @@
+import json
+import logging
+import pickle
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+from statestore import StateStore
+
+class LazyConversations:
+    """Conversation states that are looked up in the database the first time a key is used
+    Keys without a conversation are held as None, so those chats don't hit the database every time"""
+    def __init__(self, loader, ttl=None, maxsize=None):
+        self.states = StateStore(loader, ttl, maxsize)
+
+    def get(self, key, default=None):
+        state = self.states[key]
+        return default if state is None else state
+
+    def __contains__(self, key):
+        return self.states[key] is not None
+
+    def __getitem__(self, key):
+        state = self.states[key]
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        self.states[key] = state
+
+    def __delitem__(self, key):
+        self.states[key] = None
+
+class SQLitePersistence(BasePersistence):
+    """Keeps user_data and conversation states in the bot's own SQLite database
+    Changes are only recorded in memory when they happen. Every flush_seconds the
+    ones that really changed are written in a single transaction. With
+    flush_seconds=None nothing is written until flush() is called.
+    In memory, at most max_entries users and conversations are kept, each for up to
+    ttl seconds after its last use. Anything dropped is read back from the database."""
+    def __init__(self, db, flush_seconds=1.0, ttl=None, max_entries=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # Handed out to the conversation handlers, kept for the metrics
+        self.conversations = {}
+
+        # Pending changes: user ID -> pickled data, (name, key) -> state. None deletes the row
+        self.lock = threading.Lock()
+        self.dirty_users = {}
+        self.dirty_conversations = {}
+
+        # Changes being written by flush(), still newer than the database until it commits
+        self.flushing_users = {}
+        self.flushing_conversations = {}
+
+        # Pickled user_data as last loaded or saved, to skip rewriting unchanged entries
+        self.saved = StateStore(ttl=ttl, maxsize=max_entries)
+
+        self.stopping = threading.Event()
+        if flush_seconds:
+            self.flush_seconds = flush_seconds
+            threading.Thread(target=self._flush_loop, name="persistence-flush", daemon=True).start()
+
+    def _load_user_data(self, user_id):
+        """Read one user's data, from the pending changes or else the database"""
+        with self.lock:
+            for pending in (self.dirty_users, self.flushing_users):
+                if user_id in pending:
+                    return {} if pending[user_id] is None else pickle.loads(pending[user_id])
+
+        data = self.db.load_user_data(user_id)
+        if data is None:
+            return {}
+
+        self.saved[user_id] = data
+        return pickle.loads(data)
+
+    def get_user_data(self):
+        return StateStore(self._load_user_data, self.ttl, self.max_entries)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        def load(key):
+            # Pending changes first, the database holds an older state
+            with self.lock:
+                for pending in (self.dirty_conversations, self.flushing_conversations):
+                    if (name, json.dumps(key)) in pending:
+                        state = pending[(name, json.dumps(key))]
+                        return None if state is None else json.loads(state)
+
+            state = self.db.load_conversation(name, json.dumps(key))
+            return None if state is None else json.loads(state)
+
+        self.conversations[name] = LazyConversations(load, self.ttl, self.max_entries)
+        return self.conversations[name]
+
+    def update_user_data(self, user_id, data):
+        # Empty user_data is stored as no row at all
+        data = pickle.dumps(data) if data else None
+
+        with self.lock:
+            if self.saved.get(user_id) == data:
+                # Unchanged since it was last saved, drop any pending write of an older version
+                self.dirty_users.pop(user_id, None)
+            else:
+                self.dirty_users[user_id] = data
+
+    def update_conversation(self, name, key, new_state):
+        with self.lock:
+            self.dirty_conversations[(name, json.dumps(key))] = None if new_state is None else json.dumps(new_state)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        """Write every pending change in one transaction"""
+        with self.lock:
+            users, self.dirty_users = self.dirty_users, {}
+            conversations, self.dirty_conversations = self.dirty_conversations, {}
+            self.flushing_users, self.flushing_conversations = users, conversations
+
+            # Count them as saved already, so later changes are compared against what is being written
+            previous = {x: self.saved.get(x) for x in users}
+            for user_id, data in users.items():
+                self.saved[user_id] = data
+
+        if not users and not conversations:
+            return
+
+        try:
+            self.db.save_persistence(users, conversations).result()
+        except Exception:
+            # Put the changes back, unless newer ones came in meanwhile
+            with self.lock:
+                for user_id, data in users.items():
+                    self.dirty_users.setdefault(user_id, data)
+                    self.saved[user_id] = previous[user_id]
+                for key, state in conversations.items():
+                    self.dirty_conversations.setdefault(key, state)
+            raise
+        finally:
+            with self.lock:
+                self.flushing_users, self.flushing_conversations = {}, {}
+
+    def _flush_loop(self):
+        """Flush thread: write pending changes periodically"""
+        while not self.stopping.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Error saving conversation state")
+
+    def stats(self):
+        """Returns the number of conversation states held in memory, by conversation
+        (user_data is copied when handed to the dispatcher, so it is counted there)"""
+        return {name: conversations.states.stats()['entries'] for name, conversations in self.conversations.items()}
+
+    def stop(self):
+        """Stop the flush thread and write what is left"""
+        self.stopping.set()
+        self.flush()
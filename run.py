@@ -1,6 +1,7 @@
 import logging
 from telegram.ext import Updater
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, Bot
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, Update, Bot
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import CallbackContext
 from telegram.ext import CommandHandler
 from telegram.ext import MessageHandler, Filters
@@ -11,12 +12,37 @@ from telegram.ext import (
     Filters,
     ConversationHandler,
     CallbackContext,
+    CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    ExtBot,
+    JobQueue,
+    Dispatcher,
 )
+from telegram.utils.request import Request
 from dotenv import load_dotenv
+from queue import Queue
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import csv
+import io
+import json
 import re
 import os
 from os.path import join, dirname
-from dbhelper import DBHelper
+from dbhelper import DBHelper, RECENT_PAGE_SIZE, BALANCES_PAGE_SIZE, SEARCH_PAGE_SIZE, INLINE_RESULTS_LIMIT, HISTORY_PAGE_SIZE
+from scheduler import ChatScheduler, ShardedDispatcher
+from webhook import WebhookServer
+from persistence import SQLitePersistence
+from outbox import Outbox
+from statestore import StateStore
+from backup import BackupScheduler
+import settle
+import metrics
+from urllib.parse import urlparse
+import signal
+import tempfile
+import threading
+import time
 
 # Logging config
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,101 +54,133 @@ CALC = 0
 WIPE, CONFIRMCLEAR = range(2)
 REMOVE, CONFIRMDELETE = range(2)
 SETDEFAULT = 0
+IMPORTFILE = 0
 
 # Retrieve bot token
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
 TOKEN = os.environ.get('BOT_TOKEN')
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
 
-db = DBHelper()
-
-# def lambda_handler(event, context):
-    
-# # Initialize telegram bot updater and dispatcher
-#     updater = Updater(token=TOKEN, use_context=True)
-#     dispatcher = updater.dispatcher
-
-#     # Command handlers
-#     start_handler = CommandHandler('start', start)
-#     dispatcher.add_handler(start_handler)
-
-#     help_handler = CommandHandler('help', start)
-#     dispatcher.add_handler(help_handler)
-
-#     github_handler = CommandHandler('github', github)
-#     dispatcher.add_handler(github_handler)
-
-#     # Conversation Handler for adding records
-#     addConv = ConversationHandler(
-#         entry_points=[CommandHandler('add', add)],
-#         states={
-#             FRIEND: [MessageHandler(Filters.text & (~ Filters.command), friend)],
-#             AMOUNT: [MessageHandler(Filters.text & (~ Filters.command), amount)],
-#             DESC: [MessageHandler(Filters.text & (~ Filters.command), desc)]
-#         },
-#         fallbacks=[CommandHandler('skip', skipDesc), CommandHandler('cancel', cancel)],
-#     )
-#     dispatcher.add_handler(addConv)
-
-#     # Conversation Handler for checking records
-#     checkConv = ConversationHandler(
-#         entry_points=[CommandHandler('check', check)],
-#         states={
-#             CALC: [MessageHandler(Filters.text & (~ Filters.command), calc)]
-#         },
-#         fallbacks=[CommandHandler('cancel', cancel)],
-#     )
-#     dispatcher.add_handler(checkConv)
-
-#     # Conversation Handler for clearing records
-#     clearConv = ConversationHandler(
-#         entry_points=[CommandHandler('clear', clear)],
-#         states={
-#             WIPE: [MessageHandler(Filters.text & (~ Filters.command), wipe)],
-#             CONFIRMCLEAR: [MessageHandler(Filters.text & (~ Filters.command), confirmClear)]
-#         },
-#         fallbacks=[CommandHandler('cancel', cancel)],
-#     )
-#     dispatcher.add_handler(clearConv)
-
-#     # Conversation Handler for deleting a single record
-#     deleteConv = ConversationHandler(
-#         entry_points=[CommandHandler('delete', delete)],
-#         states={
-#             REMOVE: [MessageHandler(Filters.text & (~ Filters.command), remove)],
-#             CONFIRMDELETE: [MessageHandler(Filters.text & (~ Filters.command), confirmDelete)]
-#         },
-#         fallbacks=[CommandHandler('cancel', cancel)],
-#     )
-#     dispatcher.add_handler(deleteConv)
-
-#     # Conversation Handler for setting default friend
-#     defaultConv = ConversationHandler(
-#         entry_points=[CommandHandler('default', default)],
-#         states={
-#             SETDEFAULT: [MessageHandler(Filters.text & (~ Filters.command), setDefault)]
-#         },
-#         fallbacks=[CommandHandler('remove', removeDefault), CommandHandler('cancel', cancel)],
-#     )
-#     dispatcher.add_handler(defaultConv)
-
-#     # Handler for unknown commands
-#     unknown_handler = MessageHandler(Filters.command, unknown)
-#     dispatcher.add_handler(unknown_handler)
-
-#     try:
-#         # Process user input
-#         dispatcher.process_update(
-#             Update.de_json(json.loads(event["body"]), bot)
-#         )
-
-#     except Exception as e:
-#         print(e)
-#         return {"statusCode": 500}
-
-#     return {"statusCode": 200}
+# Database settings
+# With DB_WRITE_BEHIND=1, writes are committed in batches of up to DB_BATCH_SIZE
+# by a background thread, at most DB_FLUSH_MS milliseconds after they arrive.
+# Friend lists and default friends of the last DB_CACHE_ENTRIES active users are kept in memory.
+# Archived records go to the database file ARCHIVE_DB if it is set, or to a table of the main database.
+# The database is only opened by openDatabase, so importing this module touches no file
+db = None
+
+# Number of threads handling updates. Updates from one chat are always handled
+# in order by the same thread, while different chats are spread over all of them
+WORKERS = int(os.environ.get('WORKERS', 8))
+
+# How often to log the queue depth and wait time of every worker, in seconds
+SCHEDULER_REPORT_SECONDS = int(os.environ.get('SCHEDULER_REPORT_SECONDS', 300))
+
+# Metrics settings
+# With METRICS_ENABLED=1, handlers, database calls and Telegram API calls are timed.
+# The metrics are served for Prometheus on METRICS_LISTEN:METRICS_PORT/metrics (port 0 turns the endpoint off)
+# and summarised by /stats to the users listed in ADMIN_IDS
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == '1'
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').split(',') if x.strip()}
+
+# DBHelper methods timed when metrics are enabled
+DB_METHODS = ['add_record', 'add_records', 'clear_record', 'delete_record', 'check_recent', 'check_records', 'get_balance', 'check_balances', 'search_records', 'search_friends',
+              'get_record_by_ID', 'check_friends', 'check_default', 'set_default', 'delete_default',
+              'join_group', 'check_members', 'add_expense', 'get_group_balances', 'undo', 'check_history']
+
+# Conversation states and user_data are saved to the database in batches, every
+# PERSISTENCE_FLUSH_SECONDS seconds (serverless invocations save before returning)
+PERSISTENCE_FLUSH_SECONDS = float(os.environ.get('PERSISTENCE_FLUSH_SECONDS', 1))
+
+# Conversation state kept in memory: at most STATE_MAX_ENTRIES users, each dropped
+# STATE_TTL_SECONDS after its last use (it is read back from the database when needed)
+STATE_TTL_SECONDS = float(os.environ.get('STATE_TTL_SECONDS', 3600))
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', 10000))
+
+# Answers to inline queries are reused for this many seconds, by the bot and by Telegram
+INLINE_CACHE_SECONDS = int(os.environ.get('INLINE_CACHE_SECONDS', 10))
+
+# User ID -> {query: (time answered, friends)} for users who recently used inline mode
+inlineCache = StateStore(ttl=INLINE_CACHE_SECONDS, maxsize=STATE_MAX_ENTRIES)
+
+# Every change to a ledger is logged, and can be undone until it is EVENT_RETENTION_DAYS old.
+# Older events are folded into per-friend snapshots every EVENT_COMPACT_SECONDS (0 keeps them all)
+EVENT_RETENTION_DAYS = float(os.environ.get('EVENT_RETENTION_DAYS', 30))
+EVENT_COMPACT_SECONDS = int(os.environ.get('EVENT_COMPACT_SECONDS', 3600))
+
+# Records older than ARCHIVE_AFTER_DAYS (0 never archives them) are moved to the archive every ARCHIVE_SECONDS,
+# a batch per transaction with a pause of ARCHIVE_PAUSE_MS milliseconds in between to let other writes through
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_SECONDS = int(os.environ.get('ARCHIVE_SECONDS', 3600))
+ARCHIVE_PAUSE_MS = int(os.environ.get('ARCHIVE_PAUSE_MS', 50))
+
+# With BACKUP_DIR set, the database (and the archive) is backed up into it every BACKUP_SECONDS, keeping the
+# BACKUP_KEEP newest snapshots. BACKUP_PAGES pages are copied at a time, with BACKUP_PAUSE_MS milliseconds in between
+BACKUP_DIR = os.environ.get('BACKUP_DIR')
+BACKUP_SECONDS = int(os.environ.get('BACKUP_SECONDS', 3600))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+BACKUP_PAGES = int(os.environ.get('BACKUP_PAGES', 256))
+BACKUP_PAUSE_MS = int(os.environ.get('BACKUP_PAUSE_MS', 10))
+
+# Background backups of every database file, see main
+backups = []
+
+# Conversations left unanswered for this many seconds are cancelled (0 never cancels them)
+CONVERSATION_TIMEOUT = float(os.environ.get('CONVERSATION_TIMEOUT', 600))
+
+# Most lines a single /add message may add
+BULK_ADD_LIMIT = 50
+
+# Columns of the CSV files written by /export and read by /import
+CSV_HEADER = ['id', 'friend', 'amount', 'description']
+
+# Records inserted per transaction by /import
+IMPORT_BATCH_SIZE = 1000
+
+# Amounts must be below this many cents either way, so they fit an SQLite integer and a float exactly
+MAX_CENTS = 2 ** 53
+
+# Largest file accepted by /import, the most bots are allowed to download
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+# Dispatcher reused across serverless invocations, see getLambdaDispatcher
+lambdaDispatcher = None
+
+# Outgoing messages are queued and sent by OUTBOX_WORKERS threads, at most OUTBOX_GLOBAL_RATE
+# per second overall and OUTBOX_CHAT_RATE per second to each chat. 0 workers sends them from the handlers
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', 4))
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+
+# Queue of outgoing messages, see reply
+outbox = None
+
+# Webhook settings
+# If WEBHOOK_URL is set, Telegram pushes updates to that URL instead of the bot polling for them.
+# The bot listens on plain HTTP, so TLS has to be terminated in front of it (e.g. by the load balancer)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_MAX_PENDING = int(os.environ.get('WEBHOOK_MAX_PENDING', 100))
+
+def openDatabase():
+    """Returns the bot's database, opening it with the settings above on first use
+    Benchmarks and tests put a database of their own in run.db before that"""
+    global db
+
+    if db is None:
+        db = DBHelper(write_behind=os.environ.get('DB_WRITE_BEHIND') == '1',
+                      batch_size=int(os.environ.get('DB_BATCH_SIZE', 100)),
+                      flush_ms=int(os.environ.get('DB_FLUSH_MS', 0)),
+                      synchronous=os.environ.get('DB_SYNCHRONOUS', 'NORMAL'),
+                      cache_kb=int(os.environ.get('DB_CACHE_KB', 8192)),
+                      cache_entries=int(os.environ.get('DB_CACHE_ENTRIES', 10000)),
+                      archive=os.environ.get('ARCHIVE_DB') or None)
+
+    return db
 
 def isValidName(name):
     """Check if name is suitable"""
@@ -132,40 +190,283 @@ def isValidName(name):
 
 def isValidAmount(amount):
     """Check if amount is suitable to put into the database"""
+    return parseAmount(amount) is not None
+
+def parseAmount(amount):
+    """Converts an amount typed by the user to integer cents, or None if it isn't valid
+    Fractions of a cent are rounded half away from zero"""
     # Uses regex to test for suitable amount
     # Accepts: 12.04, +12.04, -12.04, .5, 0
-    # Rejects: '12.', '.'
-    return bool(re.match('^[-|+]?(0|[1-9]\d*)?(\.\d+)?(?<=\d)$', amount))
+    # Rejects: '12.', '.', '|5'
+    if not re.match('^[-+]?(0|[1-9]\d*)?(\.\d+)?(?<=\d)$', amount):
+        return None
 
-def formatAmount(amount):
-    """Formats the amount to start with a + for positive values, or a - for negative values"""
-    # Convert to float
+    # Decimal keeps the digits exactly as typed, unlike float
     try:
-        amount = float(amount)
-    except:
-        return False
+        cents = int((Decimal(amount) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        return None
+
+    # Too large to store
+    if abs(cents) >= MAX_CENTS:
+        return None
+
+    return cents
 
+def formatCents(cents):
+    """Formats a non-negative amount in cents as dollars, e.g. 450 -> 4.50"""
+    dollars, cents = divmod(cents, 100)
+    return f'{dollars}.{cents:02d}'
+
+def formatAmount(amount):
+    """Formats the amount in cents to start with a + for positive values, or a - for negative values"""
     if amount >= 0:
         # Positive or 0
-        return f'+${amount}'
+        return f'+${formatCents(amount)}'
 
     # Negative
-    return f'-${abs(amount)}'
+    return f'-${formatCents(abs(amount))}'
 
 def formatTotal(amount):
-    """Formats the total to start with - for negative values, or nothing for positive values"""
-    # Convert to float
-    try:
-        amount = round(float(amount), 2)
-    except:
-        return False
-
+    """Formats the total in cents to start with - for negative values, or nothing for positive values"""
     if amount >= 0:
         # Positive or 0
-        return f'${amount}'
+        return f'${formatCents(amount)}'
 
     # Negative
-    return f'-${abs(amount)}'
+    return f'-${formatCents(abs(amount))}'
+
+def formatRecord(record):
+    """Formats a (id, owner, amount, friend, desc) record as a single line"""
+    return f'{record[0]}) {record[3]} {formatAmount(record[2])} {", " + record[4] if record[4] else ""}'
+
+def recentPage(chat_id, before=None, after=None):
+    """Builds one page of the /delete listing and its inline keyboard, or None if there are no records"""
+    # Fetch one extra record to find out whether there is another page in that direction
+    data = db.check_recent(chat_id, before=before, after=after, limit=RECENT_PAGE_SIZE + 1)
+
+    if after is not None:
+        # Paging towards newer records, which are returned newest first
+        newer, older = len(data) > RECENT_PAGE_SIZE, True
+        data = data[-RECENT_PAGE_SIZE:]
+    else:
+        # First page or paging towards older records
+        newer, older = before is not None, len(data) > RECENT_PAGE_SIZE
+        data = data[:RECENT_PAGE_SIZE]
+
+    if not data:
+        return None
+
+    # Craft response
+    header = [f'Recent records:']
+    body = [formatRecord(x) for x in data]
+    footer = ['', 'Choose the ID of the record to delete:']
+    res = '\n'.join(header + body + footer)
+
+    # One button per record, five to a row
+    buttons = [InlineKeyboardButton(str(x[0]), callback_data=f'recent:pick:{x[0]}') for x in data]
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+
+    # Navigation buttons carry the ID at the edge of this page as the cursor
+    nav = []
+    if newer:
+        nav.append(InlineKeyboardButton('« Newer', callback_data=f'recent:newer:{data[0][0]}'))
+    if older:
+        nav.append(InlineKeyboardButton('Older »', callback_data=f'recent:older:{data[-1][0]}'))
+    if nav:
+        keyboard.append(nav)
+
+    return res, InlineKeyboardMarkup(keyboard)
+
+def exportCSV(chat_id, f):
+    """Write all of the user's records to the binary file f as CSV, returning how many there were"""
+    # Write text into the binary file, then let go of it without closing it
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(CSV_HEADER)
+
+    count = 0
+    for id, amount, friend, desc in db.iter_records(chat_id):
+        writer.writerow([id, friend, ('-' if amount < 0 else '') + formatCents(abs(amount)), desc])
+        count += 1
+
+    text.flush()
+    text.detach()
+
+    return count
+
+def importCSV(chat_id, f):
+    """Add the records in the binary CSV file f, IMPORT_BATCH_SIZE per transaction
+    Columns are friend, amount and an optional description, unless a header row names them (as in /export)
+    Returns the number of records added and the line numbers of the rows that were rejected"""
+    text = io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    columns = None
+    batch = []
+    imported = 0
+    rejected = []
+
+    for row in reader:
+        row = [x.strip() for x in row]
+
+        # Look for a header on the first row
+        if columns is None:
+            header = [x.lower() for x in row]
+            if 'friend' in header and 'amount' in header:
+                columns = (header.index('friend'), header.index('amount'),
+                           header.index('description') if 'description' in header else None)
+                continue
+            columns = (0, 1, 2)
+
+        # Skip blank lines
+        if not any(row):
+            continue
+
+        # Retrieve and validate fields
+        friendCol, amountCol, descCol = columns
+        friend = row[friendCol] if friendCol < len(row) else ''
+        amount = parseAmount(row[amountCol]) if amountCol < len(row) else None
+        desc = row[descCol] if descCol is not None and descCol < len(row) else ''
+
+        if not isValidName(friend) or amount is None:
+            rejected.append(reader.line_num)
+            continue
+
+        batch.append((friend, amount, desc))
+
+        # Send a full batch to the database and wait until it is saved
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            imported += db.add_records(chat_id, batch).result()
+            batch = []
+
+    if batch:
+        imported += db.add_records(chat_id, batch).result()
+
+    # Let go of f without closing it
+    text.detach()
+
+    return imported, rejected
+
+def reply(update, text, **kwargs):
+    """Reply in the chat of the update, taking the same arguments as Message.reply_text
+    With the outbox running the reply is only queued, so the handler doesn't wait on Telegram"""
+    if outbox is None:
+        return update.effective_message.reply_text(text, **kwargs)
+
+    # Quote the user's message in groups, like reply_text
+    if update.message and update.effective_chat.type != 'private':
+        kwargs.setdefault('reply_to_message_id', update.message.message_id)
+
+    outbox.send(update.effective_chat.id, text, **kwargs)
+
+def balancesPage(chat_id, page=0):
+    """Builds one page of the /balances overview and its inline keyboard, or None if there are no records"""
+    data, net, friends = db.check_balances(chat_id, offset=page * BALANCES_PAGE_SIZE)
+
+    if not data:
+        return None
+
+    # Craft response
+    header = [f'Balances with {friends} friend(s):']
+    body = [f'{friend}: {formatTotal(total)} ({count} record{"s" if count != 1 else ""})' for friend, total, count in data]
+    footer = ['', f'Net: {formatTotal(net)}']
+    res = '\n'.join(header + body + footer)
+
+    # Navigation buttons carry the page to show
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('« Previous', callback_data=f'balances:{page - 1}'))
+    if (page + 1) * BALANCES_PAGE_SIZE < friends:
+        nav.append(InlineKeyboardButton('Next »', callback_data=f'balances:{page + 1}'))
+
+    return res, InlineKeyboardMarkup([nav]) if nav else None
+
+def searchPage(chat_id, terms, page=0):
+    """Builds one page of /search results and its inline keyboard, or None if nothing matches"""
+    data = db.search_records(chat_id, terms, offset=page * SEARCH_PAGE_SIZE)
+
+    if not data:
+        return None
+
+    # One record past the page means there is another page
+    more = len(data) > SEARCH_PAGE_SIZE
+    data = data[:SEARCH_PAGE_SIZE]
+    query = " ".join(terms)
+
+    # Craft response
+    res = '\n'.join([f'Records matching "{query}":'] + [formatRecord(x) for x in data])
+
+    # Navigation buttons carry the page and the search itself, which must fit in Telegram's 64 bytes of callback data
+    nav = []
+    if len(f'search:{page + 1}:{query}'.encode()) <= 64:
+        if page > 0:
+            nav.append(InlineKeyboardButton('« Previous', callback_data=f'search:{page - 1}:{query}'))
+        if more:
+            nav.append(InlineKeyboardButton('Next »', callback_data=f'search:{page + 1}:{query}'))
+    elif more:
+        res += '\n\nShowing the best matches only. Use fewer words to see them all.'
+
+    return res, InlineKeyboardMarkup([nav]) if nav else None
+
+def historyPage(chat_id, friend=None, before=None):
+    """Builds one page of /history and its inline keyboard, or None if nothing is archived"""
+    # Fetch one extra record to find out whether there is another page
+    data = db.check_history(chat_id, friend, before=before, limit=HISTORY_PAGE_SIZE + 1)
+    more = len(data) > HISTORY_PAGE_SIZE
+    data = data[:HISTORY_PAGE_SIZE]
+
+    if not data:
+        return None
+
+    # Craft response
+    header = [f'Archived records{" for " + friend if friend else ""}:']
+    body = [formatRecord(x) + (' (cleared)' if x[5] else '') for x in data]
+    res = '\n'.join(header + body)
+
+    # The button carries the ID of the oldest record shown and the friend, which must fit in Telegram's 64 bytes of callback data
+    callback = f'history:{data[-1][0]}:{friend or ""}'
+    if more and len(callback.encode()) <= 64:
+        return res, InlineKeyboardMarkup([[InlineKeyboardButton('Older »', callback_data=callback)]])
+
+    return res, None
+
+def describeTotal(total):
+    """Says who owes whom, for a total in cents between the user and a friend, e.g. owes you $4.50"""
+    if total > 0:
+        return f'owes you {formatTotal(total)}'
+    if total < 0:
+        return f'you owe {formatTotal(-total)}'
+    return 'settled up'
+
+def shareTotal(name, total):
+    """The same, as the user would say it to others, e.g. Bob owes me $4.50"""
+    if total > 0:
+        return f'{name} owes me {formatTotal(total)}.'
+    if total < 0:
+        return f'I owe {name} {formatTotal(-total)}.'
+    return f'{name} and I are settled up.'
+
+def inlineFriends(user_id, query):
+    """Returns the (name, total, count) of the user's friends whose name starts with query
+    Answers are cached for INLINE_CACHE_SECONDS, so a burst of keystrokes doesn't query the database for each one"""
+    now = time.monotonic()
+    cached = inlineCache[user_id]
+
+    # The answer to a shorter query that found every match also answers the longer ones,
+    # so typing out a name usually takes a single query
+    for i in range(len(query), -1, -1):
+        hit = cached.get(query[:i])
+        if hit and now - hit[0] < INLINE_CACHE_SECONDS and (i == len(query) or len(hit[1]) < INLINE_RESULTS_LIMIT):
+            return [x for x in hit[1] if x[0].casefold().startswith(query.casefold())]
+
+    data = db.search_friends(user_id, query)
+
+    # Forget stale answers while we are here
+    for key in [k for k, v in cached.items() if now - v[0] >= INLINE_CACHE_SECONDS]:
+        del cached[key]
+    cached[query] = (now, data)
+
+    return data
 
 def start(update: Update, context: CallbackContext):
     # Help menu
@@ -176,25 +477,48 @@ Here are the available commands:
 /start or /help \- Display this menu\.
 
 /add \- Add a new record\. Can also be done in one line\. Example: /add Bob 15 Pizza
+Put one record on each line to add several at once\.
 
 /check \- Check existing records and total between you and a friend\.
 
+/balances \- See the totals with all of your friends at once\.
+
+/search \- Find records by friend or description\. Example: /search pizza
+
 /clear \- Clear all records between you and a friend\.
 
+/history \- See old and cleared records\. Example: /history Bob
+
 /delete \- Delete a specific record\.
 
 /default \- Sets your default friend\. Enables you to use /add without specifying your friend's name\.
 
+/undo \- Undo your last change: an added, deleted or cleared record, or your default friend\. Send it again to go further back\.
+
+/export \- Download all of your records as a CSV file\.
+
+/import \- Add records from a CSV file\.
+
+__*In group chats*__
+/join \- Join the group's shared ledger\.
+
+/split \- Split something you paid for between the group\. Example: /split 30 Dinner
+Name members to split it with just them and you\. Example: /split 30 @bob @carl Dinner
+
+/paid \- Record money you paid back to a member\. Example: /paid @bob 15
+
+/settle \- See the fewest payments that settle everyone up\.
+
 /github \- View the open\-source code behind this bot on GitHub\.
     """
-    context.bot.send_message(chat_id=update.effective_chat.id, text=res, parse_mode='MarkdownV2')
+    reply(update, text=res, parse_mode='MarkdownV2')
 
 def github(update: Update, context: CallbackContext):
     # Display github repo
     res = """
     Check out the code behind this bot at https://github.com/Frankwotfurters/DebtCollectorBot
     """
-    context.bot.send_message(chat_id=update.effective_chat.id, text=res)
+    reply(update, text=res)
 
 def quickAdd(chat_id, args):
     """Add new record without starting conversation
@@ -204,8 +528,8 @@ def quickAdd(chat_id, args):
         friend = args[0]
 
         # Retrieve and validate amount
-        if isValidAmount(args[1]):
-            amount = args[1]
+        amount = parseAmount(args[1]) if len(args) > 1 else None
+        if amount is not None:
 
             # Retrieve and check for desc
             if len(args) > 2:
@@ -215,8 +539,8 @@ def quickAdd(chat_id, args):
                 # No desc given
                 desc = ""
 
-            # Send to database
-            db.add_record(chat_id, args[0], args[1], desc)
+            # Send to database and wait until it is saved
+            db.add_record(chat_id, friend, amount, desc).result()
 
             return friend, amount, desc
 
@@ -227,7 +551,7 @@ def quickAdd(chat_id, args):
     elif isValidAmount(args[0]):
         # If first argument isn't a name,
         # Check if next argument is the amount
-        amount = args[0]
+        amount = parseAmount(args[0])
 
         # Retrieve default friend
         result = db.check_default(chat_id)
@@ -248,8 +572,8 @@ def quickAdd(chat_id, args):
             # No desc given
             desc = ""
             
-        # Send to database
-        db.add_record(chat_id, friend, args[0], desc)
+        # Send to database and wait until it is saved
+        db.add_record(chat_id, friend, amount, desc).result()
 
         return friend, amount, desc
 
@@ -257,33 +581,90 @@ def quickAdd(chat_id, args):
         # Unknown command
         return None, None, None
 
+def bulkAdd(chat_id, lines):
+    """Add one record per line, all in a single transaction
+    Example: /add Ryan 12 Pizza
+             Bob -4 Coffee
+    Returns the (friend, amount, desc) records added and the lines that were rejected"""
+    records = []
+    rejected = []
+    default = None
+
+    for line in lines[:BULK_ADD_LIMIT]:
+        args = line.split()
+
+        if len(args) > 1 and isValidName(args[0]) and isValidAmount(args[1]):
+            # Name, amount and optional desc
+            records.append((args[0], parseAmount(args[1]), " ".join(args[2:])))
+
+        elif args and isValidAmount(args[0]):
+            # Amount for the default friend, retrieved once for the whole message
+            if default is None:
+                default = db.check_default(chat_id)
+
+            if default:
+                records.append((default[0][0], parseAmount(args[0]), " ".join(args[1:])))
+            else:
+                rejected.append(line)
+
+        else:
+            rejected.append(line)
+
+    # Anything past the limit is not looked at
+    rejected += lines[BULK_ADD_LIMIT:]
+
+    if records:
+        # Send to database and wait until it is saved
+        db.add_records(chat_id, records).result()
+
+    return records, rejected
+
 def add(update: Update, context: CallbackContext):
     """Start conversation to add a new record"""
+    # Several lines add one record each
+    lines = [x.strip() for x in update.message.text.split('\n')]
+
+    # The first line also holds the command itself
+    lines[0] = lines[0].partition(' ')[2].strip()
+    lines = [x for x in lines if x]
+
+    if len(lines) > 1:
+        records, rejected = bulkAdd(update.message.chat_id, lines)
+
+        # Summarise everything in one reply
+        res = [f'Added {len(records)} record(s):'] + [f'{x[0]} {formatAmount(x[1])}, {x[2]}' for x in records]
+        if rejected:
+            res += ['', f'Rejected {len(rejected)} line(s):'] + rejected
+            res += ['', f'Each line must be: [name](optional) [amount] [description](optional), at most {BULK_ADD_LIMIT} lines.']
+        reply(update, '\n'.join(res))
+
+        return ConversationHandler.END
+
     # If user gave arguments with the command (for quickAdd):
     if context.args:
         friend, amount, desc = quickAdd(update.message.chat_id, context.args)
 
         # Check if command is successful
-        if friend and amount:
+        if friend and amount is not None:
             # If successfully added record
-            update.message.reply_text(f'Added record: {friend} {formatAmount(amount)}, {desc}')
-        elif friend and not amount:
+            reply(update, f'Added record: {friend} {formatAmount(amount)}, {desc}')
+        elif friend:
             # Invalid amount given
-            update.message.reply_text('Please enter a valid amount!\n' +
-                                        'Examples: 4.50, -2, 0.64')
-        elif not friend and amount:
+            reply(update, 'Please enter a valid amount!\n' +
+                            'Examples: 4.50, -2, 0.64')
+        elif amount is not None:
             # Default friend is not set
-            update.message.reply_text('Please set a default friend to use /add without supplying a name!\n' + 
-                                        '/default')
+            reply(update, 'Please set a default friend to use /add without supplying a name!\n' + 
+                            '/default')
         else:
             # Incorrect usage
-            update.message.reply_text(f'Usage of quick /add:\n' +
-                                        '\t\t/add [name](optional) [amount] [description](optional)\n' +
-                                        'Examples:\n' +
-                                        '\t\t/add Ryan 8.70 Starbucks\n' +
-                                        '\t\t/add 2 Iced Tea\n' +
-                                        '\t\t/add 5\n' +
-                                        'Note: Names cannot contain any numbers.')
+            reply(update, f'Usage of quick /add:\n' +
+                            '\t\t/add [name](optional) [amount] [description](optional)\n' +
+                            'Examples:\n' +
+                            '\t\t/add Ryan 8.70 Starbucks\n' +
+                            '\t\t/add 2 Iced Tea\n' +
+                            '\t\t/add 5\n' +
+                            'Note: Names cannot contain any numbers.')
 
         return ConversationHandler.END
     
@@ -294,7 +675,7 @@ def add(update: Update, context: CallbackContext):
     reply_keyboard[0].append('/cancel')
 
     # Prompt user for friend input
-    update.message.reply_text(
+    reply(update,
         'Who owes you money? Choose below or type a new name (case insensitive)!',
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Who?'
@@ -311,13 +692,13 @@ def friend(update: Update, context: CallbackContext):
     # Ensure name is valid
     if not isValidName(context.user_data["addFriend"]):
         # If invalid name
-        context.bot.send_message(chat_id=update.effective_chat.id, text='Name must be a single word without any numbers or special characters! Please try again.')
+        reply(update, text='Name must be a single word without any numbers or special characters! Please try again.')
 
         # Repeat this function
         return FRIEND
 
     # Prompt user for amount input
-    update.message.reply_text(
+    reply(update,
         'How much do they owe you?\n' +
         'Or, send /cancel to go back.',
         reply_markup=ReplyKeyboardRemove(),
@@ -327,22 +708,22 @@ def friend(update: Update, context: CallbackContext):
 
 def amount(update: Update, context: CallbackContext):
     """Stores amount info and ends the conversation."""
-    # Retrieve user input
-    context.user_data["addAmount"] = update.message.text
+    # Retrieve user input, converted to cents
+    context.user_data["addAmount"] = parseAmount(update.message.text)
 
-    if not isValidAmount(context.user_data["addAmount"]):
+    if context.user_data["addAmount"] is None:
         # If invalid input
         # Display error
-        update.message.reply_text('Please enter a valid number!')
+        reply(update, 'Please enter a valid number!')
 
         # Prompt user for amount input again
-        update.message.reply_text('How much do they owe you?')
+        reply(update, 'How much do they owe you?')
 
         # Repeat this function
         return AMOUNT
 
     # Prompt user for desc input
-    update.message.reply_text(
+    reply(update,
         'Add a short description! (or skip)',
         reply_markup=ReplyKeyboardMarkup(
             [['/skip', '/cancel']], one_time_keyboard=True, input_field_placeholder='Skip?'
@@ -356,30 +737,28 @@ def desc(update: Update, context: CallbackContext):
     # Retrieve user input
     context.user_data["addDesc"] = update.message.text
 
-    # Send to database
-    db.add_record(update.message.chat_id, context.user_data["addFriend"], context.user_data["addAmount"], context.user_data["addDesc"])
+    # Send to database and wait until it is saved
+    db.add_record(update.message.chat_id, context.user_data["addFriend"], context.user_data["addAmount"], context.user_data["addDesc"]).result()
 
     # Logging and remove on-screen keyboard
-    update.message.reply_text(f'Added record: {context.user_data["addFriend"]} {formatAmount(context.user_data["addAmount"])}, {context.user_data["addDesc"]}',
-                              reply_markup=ReplyKeyboardRemove()
-                              )
+    reply(update, f'Added record: {context.user_data["addFriend"]} {formatAmount(context.user_data["addAmount"])}, {context.user_data["addDesc"]}',
+                  reply_markup=ReplyKeyboardRemove()
+                  )
 
     # Clear data
     del context.user_data["addFriend"]
     del context.user_data["addAmount"]
+    del context.user_data["addDesc"]
 
     return ConversationHandler.END
 
 def skipDesc(update: Update, context: CallbackContext):
     """Sends data to database without a description"""
-    # Retrieve user input
-    context.user_data["addDesc"] = update.message.text
-
-    # Send to database
-    db.add_record(update.message.chat_id, context.user_data["addFriend"], context.user_data["addAmount"])
+    # Send to database and wait until it is saved
+    db.add_record(update.message.chat_id, context.user_data["addFriend"], context.user_data["addAmount"]).result()
 
     # Logging
-    update.message.reply_text(f'Added record: {context.user_data["addFriend"]} {formatAmount(context.user_data["addAmount"])}')
+    reply(update, f'Added record: {context.user_data["addFriend"]} {formatAmount(context.user_data["addAmount"])}')
 
     # Clear data
     del context.user_data["addFriend"]
@@ -396,7 +775,7 @@ def check(update: Update, context: CallbackContext):
     reply_keyboard[0].append('/cancel')
 
     # Prompt user for friend input
-    update.message.reply_text(
+    reply(update,
         'Check records for who?',
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Who?'
@@ -411,14 +790,17 @@ def calc(update: Update, context: CallbackContext):
     # Retrieve user input
     context.user_data["checkFriend"] = update.message.text
 
-    # Query database
+    # Query database. The running total also counts archived records
     data = db.check_records(update.message.chat_id, context.user_data["checkFriend"])
+    balance, count = db.get_balance(update.message.chat_id, context.user_data["checkFriend"])
     
-    if data:
+    if count:
         # If records exist, build response
-        header = [f'{len(data)} record(s) found for {context.user_data["checkFriend"]}:']
+        header = [f'{count} record(s) found for {context.user_data["checkFriend"]}:']
         body = [f'{formatAmount(x[0])} {x[1]}' for x in data]
-        total = [f'Total: {formatTotal(sum([x[0] for x in data]))}']
+        if count > len(data):
+            body.append(f'{count - len(data)} older record(s) in /history')
+        total = [f'Total: {formatTotal(balance)}']
         res = '\n'.join(header + body + total)
         
     else:
@@ -426,66 +808,205 @@ def calc(update: Update, context: CallbackContext):
         res = f'No records found for {context.user_data["checkFriend"]}.'
 
     # Reply with data
-    update.message.reply_text(text=res,
-                              reply_markup=ReplyKeyboardRemove()
-                              )
+    reply(update, text=res,
+                  reply_markup=ReplyKeyboardRemove()
+                  )
 
     # Clear cache
     del context.user_data["checkFriend"]
 
     return ConversationHandler.END
 
+def balances(update: Update, context: CallbackContext):
+    """Show the total with every friend, largest amounts first"""
+    page = balancesPage(update.message.chat_id)
+
+    # No records found
+    if page is None:
+        reply(update, 'You have not added any records!\n' +
+                      'Start with /add.')
+        return
+
+    res, reply_markup = page
+    reply(update, res, reply_markup=reply_markup)
+
+def turnBalances(update: Update, context: CallbackContext):
+    """Show another page of the /balances overview"""
+    query = update.callback_query
+    query.answer()
+
+    # Callback data is balances:<page>
+    page = balancesPage(update.effective_chat.id, int(query.data.split(':')[1]))
+
+    # Records may have been cleared since the overview was sent
+    if page is None:
+        query.edit_message_text('No more records.')
+        return
+
+    res, reply_markup = page
+    query.edit_message_text(text=res, reply_markup=reply_markup)
+
+def search(update: Update, context: CallbackContext):
+    """Find the user's records by friend or description
+    Example: /search pizza march"""
+    if not context.args:
+        reply(update, 'Please tell me what to look for. Example: /search pizza')
+        return
+
+    page = searchPage(update.message.chat_id, context.args)
+
+    # No records found
+    if page is None:
+        reply(update, f'No records matching "{" ".join(context.args)}".')
+        return
+
+    res, reply_markup = page
+    reply(update, res, reply_markup=reply_markup)
+
+def turnSearch(update: Update, context: CallbackContext):
+    """Show another page of /search results"""
+    query = update.callback_query
+    query.answer()
+
+    # Callback data is search:<page>:<terms>
+    _, page, terms = query.data.split(':', 2)
+    page = searchPage(update.effective_chat.id, terms.split(), int(page))
+
+    # Records may have been deleted since the results were sent
+    if page is None:
+        query.edit_message_text('No more records.')
+        return
+
+    res, reply_markup = page
+    query.edit_message_text(text=res, reply_markup=reply_markup)
+
+def history(update: Update, context: CallbackContext):
+    """Show the user's archived records, newest first
+    Example: /history Bob"""
+    friend = ' '.join(context.args)
+    page = historyPage(update.message.chat_id, friend or None)
+
+    # Nothing archived yet
+    if page is None:
+        reply(update, f'No archived records{" for " + friend if friend else ""}.')
+        return
+
+    res, reply_markup = page
+    reply(update, res, reply_markup=reply_markup)
+
+def turnHistory(update: Update, context: CallbackContext):
+    """Show older archived records"""
+    query = update.callback_query
+    query.answer()
+
+    # Callback data is history:<ID of the oldest record shown>:<friend>
+    _, before, friend = query.data.split(':', 2)
+    page = historyPage(update.effective_chat.id, friend or None, before=int(before))
+
+    # Records may have been restored with /undo since the page was sent
+    if page is None:
+        query.edit_message_text('No more records.')
+        return
+
+    res, reply_markup = page
+    query.edit_message_text(text=res, reply_markup=reply_markup)
+
+def inlineQuery(update: Update, context: CallbackContext):
+    """Suggest friends and their totals as the user types @bot <name> in any chat"""
+    query = update.inline_query
+    text = query.query.strip()
+
+    # Only names can match, anything else has no suggestions
+    if text and not isValidName(text):
+        query.answer([], cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+        return
+
+    # Records of private chats are owned by the chat ID, which is the user's ID
+    data = inlineFriends(query.from_user.id, text)
+
+    results = [
+        InlineQueryResultArticle(
+            id=str(i),
+            title=f'{name}: {describeTotal(total)}',
+            description=f'{count} record(s)',
+            input_message_content=InputTextMessageContent(shareTotal(name, total)),
+        )
+        for i, (name, total, count) in enumerate(data)
+    ]
+
+    # Every user gets their own answers, which Telegram may reuse as well
+    query.answer(results, cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+
 def delete(update: Update, context: CallbackContext):
     """Start conversation to delete a single existing record"""
-    # Retrieve recent records
-    data = db.check_recent(update.message.chat_id)
+    # Retrieve the most recent page of records
+    page = recentPage(update.message.chat_id)
 
     # No records found
-    if data is None:
-        update.message.reply_text(text=f'You have not added any records!\n' +
-                                  'Start with /add.',
-                                reply_markup=ReplyKeyboardRemove()
-                                )
+    if page is None:
+        reply(update, text=f'You have not added any records!\n' +
+                      'Start with /add.',
+                    reply_markup=ReplyKeyboardRemove()
+                    )
 
         # End the conversation
         return ConversationHandler.END
 
-    # Craft response
-    header = [f'Recent records:']
-    body = [f'{x[0]}) {x[3]} {formatAmount(x[2])} {", " + x[4] if x[4] else ""}' for x in data]
-    res = '\n'.join(header + body)
+    # Reply with the listing and prompt user for ID input
+    res, reply_markup = page
+    reply(update, text=res, reply_markup=reply_markup)
 
-    # Reply with data
-    update.message.reply_text(text=res,
-                              reply_markup=ReplyKeyboardRemove()
-                              )
+    return REMOVE
 
-    # Prepare reply keyboard
-    reply_keyboard = [[x.split(')')[0] for x in body]]
-    reply_keyboard[0].append('/cancel')
+def turnPage(update: Update, context: CallbackContext):
+    """Show the next or previous page of the /delete listing"""
+    query = update.callback_query
+    query.answer()
 
-    # Prompt user for ID input
-    update.message.reply_text(
-        'Choose the ID of the record to delete:',
-        reply_markup=ReplyKeyboardMarkup(
-            reply_keyboard, one_time_keyboard=True, input_field_placeholder='ID'
-        ),
-    )
+    # Callback data is recent:<older|newer>:<cursor ID>
+    _, direction, cursor = query.data.split(':')
+
+    if direction == 'older':
+        page = recentPage(update.effective_chat.id, before=int(cursor))
+    else:
+        page = recentPage(update.effective_chat.id, after=int(cursor))
+
+    # Records may have been deleted since the listing was sent
+    if page is None:
+        query.edit_message_text('No more records.')
+        return REMOVE
+
+    res, reply_markup = page
+    query.edit_message_text(text=res, reply_markup=reply_markup)
 
     return REMOVE
 
+def pick(update: Update, context: CallbackContext):
+    """Retrieve the record tapped on the /delete listing"""
+    query = update.callback_query
+    query.answer()
+
+    # Callback data is recent:pick:<ID>
+    context.user_data["deleteID"] = query.data.split(':')[2]
+
+    return promptDelete(update, context)
+
 def remove(update: Update, context: CallbackContext):
     """Retrieve user input and display record to be removed"""
     # Retrieve user input
     context.user_data["deleteID"] = update.message.text
 
+    return promptDelete(update, context)
+
+def promptDelete(update: Update, context: CallbackContext):
+    """Display the chosen record and ask for confirmation to remove it"""
     # Get existing record first
-    data = db.get_record_by_ID(update.message.chat_id, context.user_data["deleteID"])
+    data = db.get_record_by_ID(update.effective_chat.id, context.user_data["deleteID"])
 
     if not data:
         # Record does not exist / not owned by user
         # Prompt user for reply again
-        update.message.reply_text('ID not found! Please try again:')
+        reply(update, 'ID not found! Please try again:')
 
         # Repeat this function
         return REMOVE
@@ -494,9 +1015,9 @@ def remove(update: Update, context: CallbackContext):
     reply_keyboard = [['Yes', 'No']]
 
     # Prompt user for confirmation
-    update.message.reply_text(
+    reply(update,
         'Would you like to delete:\n' +
-        f'{data[0][0]}) {data[0][3]} {formatAmount(data[0][2])} {", " + data[0][4] if data[0][4] else ""}',
+        formatRecord(data[0]),
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Confirmation'
         ),
@@ -515,13 +1036,13 @@ def confirmDelete(update: Update, context: CallbackContext):
     # Check user's response
     if confirmDelete.lower() == 'yes':
         # Received confirmation to delete record
-        db.delete_record(update.message.chat_id, context.user_data["deleteID"])
+        db.delete_record(update.message.chat_id, context.user_data["deleteID"]).result()
 
         # Reply user with the record that was deleted
-        update.message.reply_text(text='Deleted record:\n' +
-                                f'{data[0][0]}) {data[0][3]} {formatAmount(data[0][2])} {", " + data[0][4] if data[0][4] else ""}',
-                                reply_markup=ReplyKeyboardRemove()
-                                )
+        reply(update, text='Deleted record:\n' +
+                    formatRecord(data[0]),
+                    reply_markup=ReplyKeyboardRemove()
+                    )
 
         # Clear cache
         del context.user_data["deleteID"]
@@ -530,9 +1051,9 @@ def confirmDelete(update: Update, context: CallbackContext):
 
     else:
         # Anything else will cancel the deletion
-        update.message.reply_text(text='Cancelled deletion.',
-                                reply_markup=ReplyKeyboardRemove()
-                                )
+        reply(update, text='Cancelled deletion.',
+                    reply_markup=ReplyKeyboardRemove()
+                    )
 
         # Clear cache
         del context.user_data["deleteID"]
@@ -548,7 +1069,7 @@ def clear(update: Update, context: CallbackContext):
     reply_keyboard[0].append('/cancel')
 
     # Prompt user for friend input
-    update.message.reply_text(
+    reply(update,
         'Clear records for who?',
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Who?'
@@ -565,24 +1086,27 @@ def wipe(update: Update, context: CallbackContext):
     # Check for records
     data = db.check_records(update.message.chat_id, context.user_data["clearFriend"])
 
+    # Save total amount, which also counts archived records
+    context.user_data["clearTotal"] = db.get_balance(update.message.chat_id, context.user_data["clearFriend"])
+
     # Build response
     header = [f'You are deleting:']
     body = [f'{formatAmount(x[0])} {x[1]}' for x in data]
+    archived = context.user_data["clearTotal"][1] - len(data)
+    if archived > 0:
+        body.append(f'{archived} older record(s) in /history')
     res = '\n'.join(header + body)
 
-    # Save total amount
-    context.user_data["clearTotal"] = (sum([x[0] for x in data]), len(data))
-
     # Send user deleted records
-    update.message.reply_text(text=res,
-                            reply_markup=ReplyKeyboardRemove()
-                            )
+    reply(update, text=res,
+                reply_markup=ReplyKeyboardRemove()
+                )
 
     # Prepare reply keyboard
     reply_keyboard = [['Yes', 'No']]    
 
     # Prompt user for confirmation
-    update.message.reply_text(
+    reply(update,
         f'Would you like to clear all records between you and {context.user_data["clearFriend"]}?',
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Confirmation'
@@ -600,7 +1124,7 @@ def confirmClear(update: Update, context: CallbackContext):
     # Check user's response
     if confirmClear.lower() == 'yes':
         # Delete from database
-        db.clear_record(update.message.chat_id, context.user_data["clearFriend"])
+        db.clear_record(update.message.chat_id, context.user_data["clearFriend"]).result()
 
         records = context.user_data["clearTotal"][1]
 
@@ -612,9 +1136,9 @@ def confirmClear(update: Update, context: CallbackContext):
             res = f'Cleared {formatTotal(context.user_data["clearTotal"][0])} of debt ({records} transaction) from {context.user_data["clearFriend"]}.'
 
         # Reply with data
-        update.message.reply_text(text=res,
-                                reply_markup=ReplyKeyboardRemove()
-                                )
+        reply(update, text=res,
+                    reply_markup=ReplyKeyboardRemove()
+                    )
 
         # Clear cache
         del context.user_data["clearFriend"]
@@ -624,12 +1148,13 @@ def confirmClear(update: Update, context: CallbackContext):
 
     else:
         # Anything else will cancel the operation
-        update.message.reply_text(text='Cancelled clearing of records.',
-                                reply_markup=ReplyKeyboardRemove()
-                                )
+        reply(update, text='Cancelled clearing of records.',
+                    reply_markup=ReplyKeyboardRemove()
+                    )
 
         # Clear cache
         del context.user_data["clearFriend"]
+        del context.user_data["clearTotal"]
 
         return ConversationHandler.END
 
@@ -654,7 +1179,7 @@ def default(update: Update, context: CallbackContext):
     reply_keyboard[0].append('/cancel')
 
     # Prompt user for friend input
-    update.message.reply_text(
+    reply(update,
         f'{res} Choose one of the following \(or enter a new name\) to be set as your default friend:',
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder='Who?'
@@ -670,30 +1195,253 @@ def setDefault(update: Update, context: CallbackContext):
     context.user_data["defaultFriend"] = update.message.text
 
     # Send to database
-    db.set_default(update.message.chat_id, context.user_data["defaultFriend"])
+    db.set_default(update.message.chat_id, context.user_data["defaultFriend"]).result()
 
     # Reply user
-    update.message.reply_text(
+    reply(update,
         f'Your default friend is now *{context.user_data["defaultFriend"]}*\.',
         reply_markup=ReplyKeyboardRemove(),
         parse_mode='MarkdownV2'
     )
 
+    # Clear cache
+    del context.user_data["defaultFriend"]
+
     return ConversationHandler.END
 
 def removeDefault(update: Update, context: CallbackContext):
     """Deletes default friend record"""
     # Send to database
-    db.delete_default(update.message.chat_id)
+    db.delete_default(update.message.chat_id).result()
 
     # Reply user
-    update.message.reply_text(
+    reply(update,
         'Removed your default friend.',
         reply_markup=ReplyKeyboardRemove()
     )
 
     return ConversationHandler.END    
 
+def undo(update: Update, context: CallbackContext):
+    """Revert the user's last change"""
+    # Send to database and wait until it is reverted
+    events = db.undo(update.message.chat_id).result()
+
+    # Nothing left in the log
+    if not events:
+        reply(update, 'Nothing to undo!')
+        return
+
+    # Describe what came back or went away, all events of an operation are of the same kind
+    kind, friend, amount, count, payload = events[0]
+    if kind == 'add' and len(events) > 1:
+        res = f'Removed the {len(events)} records you added.'
+    elif kind == 'add':
+        res = f'Removed the record you added: {friend} {formatAmount(amount)}.'
+    elif kind == 'delete':
+        res = f'Restored the record you deleted: {friend} {formatAmount(payload["amount"])}.'
+    elif kind == 'clear':
+        res = f'Restored {-count} record(s) with {friend}.'
+    elif payload['previous']:
+        res = f'Your default friend is {payload["previous"]} again.'
+    else:
+        res = 'You have no default friend again.'
+
+    reply(update, res)
+
+def export(update: Update, context: CallbackContext):
+    """Send all of the user's records as a CSV file"""
+    # Spool to a temporary file rather than building the whole CSV in memory
+    with tempfile.TemporaryFile() as f:
+        count = exportCSV(update.message.chat_id, f)
+
+        # No records found
+        if not count:
+            reply(update, 'You have not added any records!\n' +
+                          'Start with /add.')
+            return
+
+        f.seek(0)
+        context.bot.send_document(chat_id=update.effective_chat.id, document=f, filename='records.csv',
+                                  caption=f'{count} record(s)')
+
+def importRecords(update: Update, context: CallbackContext):
+    """Start conversation to import records from a CSV file"""
+    # Prompt user for the file
+    reply(update,
+        'Send me a CSV file with one record per row: name, amount and an optional description.\n' +
+        'Files from /export work too. Or, send /cancel to go back.',
+        reply_markup=ReplyKeyboardRemove(),
+    )
+
+    return IMPORTFILE
+
+def importFile(update: Update, context: CallbackContext):
+    """Retrieve the uploaded CSV file and add its records"""
+    document = update.message.document
+
+    if not document:
+        # Anything other than a file
+        reply(update, 'Please send the records as a CSV file, or /cancel.')
+
+        # Repeat this function
+        return IMPORTFILE
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        # Telegram won't let the bot download it
+        reply(update, f'That file is too large! Files can be at most {IMPORT_MAX_BYTES // 1024 // 1024}MB.')
+        return IMPORTFILE
+
+    # Download to a temporary file, then read it a row at a time
+    with tempfile.TemporaryFile() as f:
+        document.get_file().download(out=f)
+        f.seek(0)
+
+        try:
+            imported, rejected = importCSV(update.message.chat_id, f)
+        except (UnicodeDecodeError, csv.Error):
+            # Batches before the broken row are already saved
+            reply(update, 'Could not read that file! Please send a UTF-8 CSV file.')
+            return ConversationHandler.END
+
+    # Craft response
+    res = f'Imported {imported} record(s).'
+    if rejected:
+        lines = ', '.join(str(x) for x in rejected[:10]) + (', ...' if len(rejected) > 10 else '')
+        res += f'\nSkipped {len(rejected)} invalid row(s), on line(s) {lines}.'
+    reply(update, res)
+
+    return ConversationHandler.END
+
+def memberName(user):
+    """The name a user goes by in a group's ledger"""
+    return user.username or user.first_name
+
+def joinMember(update):
+    """Adds the sender to the ledger of the group chat, returns False in private chats"""
+    if update.effective_chat.type == 'private':
+        reply(update, 'Shared ledgers live in group chats. Add me to a group and /join there.')
+        return False
+
+    user = update.effective_user
+    db.join_group(update.effective_chat.id, user.id, memberName(user)).result()
+    return True
+
+def findMembers(chat_id, mentions):
+    """Looks up @name mentions among the members of a group's ledger
+    Returns the user IDs of the members found and the names that aren't members"""
+    members = {name.lower(): user for user, name in db.check_members(chat_id)}
+    found = []
+    unknown = []
+
+    for mention in mentions:
+        name = mention[1:].lower()
+        if name in members:
+            found.append(members[name])
+        else:
+            unknown.append(mention)
+
+    return found, unknown
+
+def join(update: Update, context: CallbackContext):
+    """Join the shared ledger of a group chat"""
+    if joinMember(update):
+        reply(update, f'{memberName(update.effective_user)} joined the ledger of this group.')
+
+def split(update: Update, context: CallbackContext):
+    """Split an expense paid by the sender between members of the group
+    Example: /split 30 @bob @carl Dinner"""
+    args = context.args
+
+    # Validate amount, splitting nothing or a negative amount makes no sense
+    amount = parseAmount(args[0]) if args else None
+    if amount is None or amount <= 0:
+        reply(update, 'Please give the amount you paid. Example: /split 30 Dinner')
+        return
+
+    # Payers always join the ledger
+    if not joinMember(update):
+        return
+    chat_id = update.effective_chat.id
+    payer = update.effective_user.id
+
+    # Mentions right after the amount pick who shares it, the remaining words are the description
+    mentions = []
+    for arg in args[1:]:
+        if not arg.startswith('@'):
+            break
+        mentions.append(arg)
+    desc = " ".join(args[1 + len(mentions):])
+
+    if mentions:
+        # Split between the members named and the payer
+        members, unknown = findMembers(chat_id, mentions)
+        if unknown:
+            reply(update, f'{", ".join(unknown)} not found. Everyone sharing an expense has to /join first.')
+            return
+        members = [payer] + [x for x in dict.fromkeys(members) if x != payer]
+    else:
+        # Split between everyone
+        members = [x[0] for x in db.check_members(chat_id)]
+
+    if len(members) < 2:
+        reply(update, 'Nobody to split with yet! Everyone sharing expenses has to /join first.')
+        return
+
+    # Send to database and wait until it is saved
+    db.add_expense(chat_id, payer, amount, settle.split(amount, members), desc).result()
+
+    reply(update, f'Split {formatTotal(amount)}{" for " + desc if desc else ""} between {len(members)} members, '
+                  f'{formatTotal(amount // len(members))} each.\n'
+                  'Use /settle to see who owes whom.')
+
+def paid(update: Update, context: CallbackContext):
+    """Record a payment from the sender to another member of the group
+    Example: /paid @bob 15"""
+    args = context.args
+
+    # Validate arguments
+    amount = parseAmount(args[1]) if len(args) > 1 else None
+    if not args or not args[0].startswith('@') or amount is None or amount <= 0:
+        reply(update, 'Please name who you paid and how much. Example: /paid @bob 15')
+        return
+
+    if not joinMember(update):
+        return
+    chat_id = update.effective_chat.id
+
+    members, unknown = findMembers(chat_id, args[:1])
+    if unknown:
+        reply(update, f'{args[0]} not found. They have to /join first.')
+        return
+
+    # A payment is an expense paid by the sender that is entirely the other member's share
+    db.add_expense(chat_id, update.effective_user.id, amount, [(members[0], amount)], "Payment").result()
+
+    reply(update, f'Recorded {formatTotal(amount)} paid to {args[0][1:]}.')
+
+def settleUp(update: Update, context: CallbackContext):
+    """Show the fewest payments that settle up the whole group"""
+    if update.effective_chat.type == 'private':
+        reply(update, 'Shared ledgers live in group chats. Add me to a group and /join there.')
+        return
+
+    data = db.get_group_balances(update.effective_chat.id)
+
+    # Nothing owed
+    if not data:
+        reply(update, 'Everyone is settled up!')
+        return
+
+    names = {member: name or f'Member {member}' for member, name, net in data}
+    payments = settle.simplify({member: net for member, name, net in data})
+
+    # Craft response
+    header = [f'{len(payments)} payment(s) settle everyone up:']
+    body = [f'{names[debtor]} pays {names[creditor]} {formatTotal(amount)}' for debtor, creditor, amount in payments]
+    footer = ['', 'Record each payment with /paid once it is made.']
+    reply(update, '\n'.join(header + body + footer))
+
 def cancel(update: Update, context: CallbackContext):
     """Cancels and ends the conversation."""
     user = update.message.from_user
@@ -706,23 +1454,127 @@ def cancel(update: Update, context: CallbackContext):
     for x in cache:
         del context.user_data[x]
 
-    update.message.reply_text(
+    reply(update,
         'Cancelled request.', reply_markup=ReplyKeyboardRemove()
     )
 
     return ConversationHandler.END
 
-def unknown(update: Update, context: CallbackContext):
-    context.bot.send_message(chat_id=update.effective_chat.id, text="Sorry, I didn't understand that command.")
+def timeout(update: Update, context: CallbackContext):
+    """Ends a conversation left unanswered for CONVERSATION_TIMEOUT seconds"""
+    # Clear cache. Look the user up again, the copy held by this context may have been dropped from memory meanwhile
+    context.dispatcher.user_data[update.effective_user.id].clear()
 
-def main():
-    """Run the bot"""
-    # Perform first time setup of database
-    db.setup()
-    
-    # Initialize telegram bot updater and dispatcher
-    updater = Updater(token=TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+    # Jobs don't save user_data by themselves
+    context.dispatcher.update_persistence(update)
+
+    reply(update, text='Cancelled request due to inactivity.', reply_markup=ReplyKeyboardRemove())
+
+def unknown(update: Update, context: CallbackContext):
+    reply(update, text="Sorry, I didn't understand that command.")
+
+def stats(update: Update, context: CallbackContext):
+    """Admin only: summarise the collected metrics"""
+    # Everyone else gets the same reply as for any unknown command
+    if update.effective_user.id not in ADMIN_IDS:
+        return unknown(update, context)
+
+    if not METRICS_ENABLED:
+        reply(update, 'Metrics are disabled. Set METRICS_ENABLED=1 to collect them.')
+        return
+
+    # Timings of handlers, database and API calls
+    lines = metrics.registry.summary()
+
+    # Friend and default friend cache
+    x = db.cache_stats()
+    lines.append(f'db cache: {x["entries"]} users, {x["hits"]} hits, {x["misses"]} misses')
+
+    # Outgoing messages
+    if outbox:
+        x = outbox.stats()
+        lines.append(f'outbox: depth {x["depth"]}, {x["sent"]} sent, {x["merged"]} merged, '
+                     f'avg wait {x["avg_wait"] * 1000:.1f}ms, max wait {x["max_wait"] * 1000:.1f}ms')
+
+    # Worker queues, if this dispatcher has them
+    scheduler = getattr(context.dispatcher, 'scheduler', None)
+    if scheduler:
+        for x in scheduler.stats():
+            lines.append(f'shard {x["shard"]}: depth {x["depth"]}, max wait {x["max_wait"] * 1000:.1f}ms')
+
+    # Conversation state held in memory
+    for store, entries in stateEntries(context.dispatcher).items():
+        lines.append(f'{store}: {entries} entries in memory')
+
+    # Backups
+    for backup in backups:
+        x = backup.stats()
+        lines.append(f'backup {backup.prefix}: {x["backups"]} taken, {x["skipped"]} skipped, {x["failed"]} failed, '
+                     f'last {x["last_seconds"]:.2f}s for {x["last_pages"]} pages')
+
+    reply(update, '\n'.join(lines) or 'Nothing measured yet.')
+
+def stateEntries(dispatcher):
+    """Returns the number of users and conversation states held in memory, by store"""
+    if not isinstance(dispatcher.persistence, SQLitePersistence):
+        return {}
+
+    stores = {'user_data': dispatcher.user_data.stats()['entries']}
+    for name, entries in dispatcher.persistence.stats().items():
+        stores[f'conversation:{name}'] = entries
+    return stores
+
+def reportScheduler(context: CallbackContext):
+    """Log queue depth and wait time of every worker"""
+    for x in context.dispatcher.scheduler.stats():
+        logging.info("Shard %s: depth %s, processed %s, avg wait %.1fms, max wait %.1fms",
+                     x['shard'], x['depth'], x['processed'], x['avg_wait'] * 1000, x['max_wait'] * 1000)
+
+def compactEvents(context: CallbackContext):
+    """Fold events older than EVENT_RETENTION_DAYS into snapshots, a batch per transaction"""
+    before = time.time() - EVENT_RETENTION_DAYS * 86400
+    total = 0
+
+    while True:
+        folded = db.compact_events(before).result()
+        if not folded:
+            break
+        total += folded
+
+    if total:
+        logging.info("Folded %s event(s) into snapshots", total)
+
+def archiveRecords(context: CallbackContext):
+    """Move records older than ARCHIVE_AFTER_DAYS to the archive, a batch per transaction"""
+    before = time.time() - ARCHIVE_AFTER_DAYS * 86400
+    total = 0
+
+    while True:
+        moved = db.archive_records(before).result()
+        if not moved:
+            break
+        total += moved
+
+        # Hand the write lock to the handlers between batches
+        time.sleep(ARCHIVE_PAUSE_MS / 1000)
+
+    if total:
+        logging.info("Moved %s record(s) to the archive", total)
+
+def runNowAndEvery(job_queue, callback, interval):
+    """Run a job as soon as the job queue starts, then every interval seconds"""
+    # A repeating job with first=0 that is scheduled before the job queue starts only runs after a whole
+    # interval. Nor is a first run dropped as missed, however long the rest of the startup takes
+    job_queue.run_once(callback, 0, job_kwargs={'misfire_grace_time': None})
+    job_queue.run_repeating(callback, interval=interval)
+
+def addHandlers(dispatcher, persistent=False, conversation_timeout=None):
+    """Register every command and conversation on the dispatcher
+    With persistent=True, conversation states are saved to the dispatcher's persistence.
+    With conversation_timeout set, conversations are cancelled after that many seconds without a reply,
+    which needs the dispatcher to have a job queue"""
+    # Receives the last update of a conversation that timed out
+    timeout_handler = TypeHandler(Update, timeout)
 
     # Command handlers
     start_handler = CommandHandler('start', start)
@@ -734,15 +1586,61 @@ def main():
     github_handler = CommandHandler('github', github)
     dispatcher.add_handler(github_handler)
 
+    stats_handler = CommandHandler('stats', stats)
+    dispatcher.add_handler(stats_handler)
+
+    export_handler = CommandHandler('export', export)
+    dispatcher.add_handler(export_handler)
+
+    balances_handler = CommandHandler('balances', balances)
+    dispatcher.add_handler(balances_handler)
+
+    undo_handler = CommandHandler('undo', undo)
+    dispatcher.add_handler(undo_handler)
+
+    join_handler = CommandHandler('join', join)
+    dispatcher.add_handler(join_handler)
+
+    split_handler = CommandHandler('split', split)
+    dispatcher.add_handler(split_handler)
+
+    paid_handler = CommandHandler('paid', paid)
+    dispatcher.add_handler(paid_handler)
+
+    settle_handler = CommandHandler('settle', settleUp)
+    dispatcher.add_handler(settle_handler)
+
+    balances_page_handler = CallbackQueryHandler(turnBalances, pattern='^balances:')
+    dispatcher.add_handler(balances_page_handler)
+
+    search_handler = CommandHandler('search', search)
+    dispatcher.add_handler(search_handler)
+
+    search_page_handler = CallbackQueryHandler(turnSearch, pattern='^search:')
+    dispatcher.add_handler(search_page_handler)
+
+    history_handler = CommandHandler('history', history)
+    dispatcher.add_handler(history_handler)
+
+    history_page_handler = CallbackQueryHandler(turnHistory, pattern='^history:')
+    dispatcher.add_handler(history_page_handler)
+
+    inline_handler = InlineQueryHandler(inlineQuery)
+    dispatcher.add_handler(inline_handler)
+
     # Conversation Handler for adding records
     addConv = ConversationHandler(
         entry_points=[CommandHandler('add', add)],
         states={
             FRIEND: [MessageHandler(Filters.text & (~ Filters.command), friend)],
             AMOUNT: [MessageHandler(Filters.text & (~ Filters.command), amount)],
-            DESC: [MessageHandler(Filters.text & (~ Filters.command), desc)]
+            DESC: [MessageHandler(Filters.text & (~ Filters.command), desc)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
         },
         fallbacks=[CommandHandler('skip', skipDesc), CommandHandler('cancel', cancel)],
+        name='add',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
     )
     dispatcher.add_handler(addConv)
 
@@ -750,9 +1648,13 @@ def main():
     checkConv = ConversationHandler(
         entry_points=[CommandHandler('check', check)],
         states={
-            CALC: [MessageHandler(Filters.text & (~ Filters.command), calc)]
+            CALC: [MessageHandler(Filters.text & (~ Filters.command), calc)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='check',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
     )
     dispatcher.add_handler(checkConv)
 
@@ -761,9 +1663,13 @@ def main():
         entry_points=[CommandHandler('clear', clear)],
         states={
             WIPE: [MessageHandler(Filters.text & (~ Filters.command), wipe)],
-            CONFIRMCLEAR: [MessageHandler(Filters.text & (~ Filters.command), confirmClear)]
+            CONFIRMCLEAR: [MessageHandler(Filters.text & (~ Filters.command), confirmClear)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='clear',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
     )
     dispatcher.add_handler(clearConv)
 
@@ -771,10 +1677,18 @@ def main():
     deleteConv = ConversationHandler(
         entry_points=[CommandHandler('delete', delete)],
         states={
-            REMOVE: [MessageHandler(Filters.text & (~ Filters.command), remove)],
-            CONFIRMDELETE: [MessageHandler(Filters.text & (~ Filters.command), confirmDelete)]
+            REMOVE: [
+                MessageHandler(Filters.text & (~ Filters.command), remove),
+                CallbackQueryHandler(turnPage, pattern='^recent:(older|newer):'),
+                CallbackQueryHandler(pick, pattern='^recent:pick:'),
+            ],
+            CONFIRMDELETE: [MessageHandler(Filters.text & (~ Filters.command), confirmDelete)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='delete',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
     )
     dispatcher.add_handler(deleteConv)
 
@@ -782,18 +1696,213 @@ def main():
     defaultConv = ConversationHandler(
         entry_points=[CommandHandler('default', default)],
         states={
-            SETDEFAULT: [MessageHandler(Filters.text & (~ Filters.command), setDefault)]
+            SETDEFAULT: [MessageHandler(Filters.text & (~ Filters.command), setDefault)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
         },
         fallbacks=[CommandHandler('remove', removeDefault), CommandHandler('cancel', cancel)],
+        name='default',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
     )
     dispatcher.add_handler(defaultConv)
 
+    # Conversation Handler for importing records
+    importConv = ConversationHandler(
+        entry_points=[CommandHandler('import', importRecords)],
+        states={
+            IMPORTFILE: [MessageHandler(Filters.document | (Filters.text & (~ Filters.command)), importFile)],
+            ConversationHandler.TIMEOUT: [timeout_handler]
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='import',
+        persistent=persistent,
+        conversation_timeout=conversation_timeout,
+    )
+    dispatcher.add_handler(importConv)
+
     # Handler for unknown commands
     unknown_handler = MessageHandler(Filters.command, unknown)
     dispatcher.add_handler(unknown_handler)
 
-    # Start the bot and wait for response
-    updater.start_polling()
+def instrument(dispatcher):
+    """Time every handler of the dispatcher and every database call"""
+    metrics.instrument_dispatcher(dispatcher)
+    metrics.instrument_db(db, DB_METHODS)
+
+def getLambdaDispatcher(bot=None):
+    """Returns the dispatcher used by lambda_handler, building it on the first call
+    Everything built here survives between invocations while the process stays warm"""
+    global lambdaDispatcher, outbox
+
+    if lambdaDispatcher is None:
+        # Perform first time setup of database
+        openDatabase().setup()
+
+        # Conversations must outlive the process, so their states are persisted.
+        # Handlers run inline (workers=0): the response is only sent once they are done
+        persistence = SQLitePersistence(db, flush_seconds=None, ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES)
+        dispatcher = Dispatcher(bot or (metrics.TimedBot if METRICS_ENABLED else Bot)(TOKEN), Queue(),
+                                workers=0, persistence=persistence, use_context=True)
+        addHandlers(dispatcher, persistent=True)
+
+        # Replies are sent together at the end of each invocation, merged where possible
+        outbox = Outbox(dispatcher.bot, workers=0, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE)
+
+        if METRICS_ENABLED:
+            instrument(dispatcher)
+
+        lambdaDispatcher = dispatcher
+
+    return lambdaDispatcher
+
+def lambda_handler(event, context):
+    """Serverless entry point: handle one update posted to the webhook"""
+    dispatcher = getLambdaDispatcher()
+
+    try:
+        # Process user input
+        dispatcher.process_update(
+            Update.de_json(json.loads(event["body"]), dispatcher.bot)
+        )
+
+        # The process may be frozen as soon as we return, so send the replies and save conversation state now
+        outbox.flush()
+        dispatcher.persistence.flush()
+
+    except Exception:
+        logging.exception("Error handling serverless event")
+        return {"statusCode": 500}
+
+    return {"statusCode": 200}
+
+def buildUpdater(bot, scheduler, persistence):
+    """Returns the updater used by main, with its background jobs scheduled and every handler registered
+    Nothing is started: the job queue, polling and the scheduler's workers are left to the caller"""
+    dispatcher = ShardedDispatcher(bot, Queue(), job_queue=JobQueue(), scheduler=scheduler,
+                                   persistence=persistence, use_context=True)
+
+    # Updater doesn't hand the job queue a dispatcher it didn't build itself, and
+    # refuses a worker count with one: the scheduler's threads run the handlers
+    dispatcher.job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+
+    # Periodically report how busy the workers are
+    updater.job_queue.run_repeating(reportScheduler, interval=SCHEDULER_REPORT_SECONDS)
+
+    # Keep the event log short
+    if EVENT_COMPACT_SECONDS:
+        runNowAndEvery(updater.job_queue, compactEvents, EVENT_COMPACT_SECONDS)
+
+    # Keep the records table small
+    if ARCHIVE_AFTER_DAYS and ARCHIVE_SECONDS:
+        runNowAndEvery(updater.job_queue, archiveRecords, ARCHIVE_SECONDS)
+
+    # Register every command and conversation
+    addHandlers(dispatcher, persistent=True, conversation_timeout=CONVERSATION_TIMEOUT or None)
+
+    return updater
+
+def main():
+    """Run the bot"""
+    global outbox
+
+    # Perform first time setup of database
+    openDatabase().setup()
+    
+    # Initialize telegram bot updater and dispatcher
+    # Every worker and outbox thread may be sending at the same time, so size the connection pool to match
+    bot = (metrics.TimedBot if METRICS_ENABLED else ExtBot)(TOKEN, request=Request(con_pool_size=WORKERS + OUTBOX_WORKERS + 4))
+
+    # Send replies in the background, merged and within Telegram's rate limits
+    if OUTBOX_WORKERS:
+        observe = (lambda seconds: metrics.registry.observe('bot_outbox_seconds', ('stage', 'delivered'), seconds)) if METRICS_ENABLED else None
+        outbox = Outbox(bot, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, observe=observe)
+
+    # In webhook mode, cap the updates waiting on the workers so the server can push back
+    scheduler = ChatScheduler(WORKERS, max_pending=WEBHOOK_MAX_PENDING if WEBHOOK_URL else None)
+
+    # Keep conversation states in the database so a restart doesn't drop them
+    persistence = SQLitePersistence(db, flush_seconds=PERSISTENCE_FLUSH_SECONDS,
+                                    ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES)
+
+    updater = buildUpdater(bot, scheduler, persistence)
+    dispatcher = updater.dispatcher
+
+    # Back up every database file in the background
+    if BACKUP_DIR and BACKUP_SECONDS:
+        for dbname in [db.dbname] + ([db.archive] if db.archive else []):
+            backup = BackupScheduler(dbname, BACKUP_DIR, interval=BACKUP_SECONDS, keep=BACKUP_KEEP,
+                                     pages=BACKUP_PAGES, pause_ms=BACKUP_PAUSE_MS)
+            if METRICS_ENABLED:
+                backup.observe = lambda seconds, pages, prefix=backup.prefix: metrics.registry.observe('bot_backup_seconds', ('backup', prefix), seconds)
+            backup.start()
+            backups.append(backup)
+
+    if METRICS_ENABLED:
+        instrument(dispatcher)
+
+        # Queue depth of every worker, read when scraped
+        metrics.registry.collectors.append(lambda: [('bot_scheduler_queue_depth', ('shard', x['shard']), x['depth'])
+                                                    for x in scheduler.stats()])
+
+        # Friend and default friend cache
+        metrics.registry.collectors.append(lambda: [('bot_db_cache', ('value', x), db.cache_stats()[x]) for x in ('entries', 'hits', 'misses')])
+
+        # Outgoing messages waiting and sent
+        if outbox:
+            metrics.registry.collectors.append(lambda: [('bot_outbox_queue_depth', ('queue', 'messages'), outbox.stats()['depth'])] +
+                                                       [('bot_outbox_messages', ('result', x), outbox.stats()[x]) for x in ('sent', 'merged', 'errors')])
+
+        # Users and conversations held in memory
+        metrics.registry.collectors.append(lambda: [('bot_state_entries', ('store', store), entries)
+                                                    for store, entries in stateEntries(dispatcher).items()])
+
+        # Backups taken and pages copied
+        metrics.registry.collectors.append(lambda: [(name, ('backup', backup.prefix), backup.stats()[x]) for backup in backups
+                                                    for name, x in (('bot_backups_taken', 'backups'), ('bot_backups_skipped', 'skipped'),
+                                                                    ('bot_backups_failed', 'failed'), ('bot_backup_pages', 'total_pages'))])
+
+        if METRICS_PORT:
+            metrics.serve(METRICS_LISTEN, METRICS_PORT)
+
+    if WEBHOOK_URL:
+        # Receive updates through the webhook server
+        server = WebhookServer(dispatcher, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                               path=urlparse(WEBHOOK_URL).path or '/', secret=WEBHOOK_SECRET,
+                               max_pending=WEBHOOK_MAX_PENDING)
+        server.start()
+        updater.job_queue.start()
+
+        if METRICS_ENABLED:
+            metrics.registry.collectors.append(lambda: [('bot_webhook_updates_total', ('result', 'accepted'), server.accepted),
+                                                        ('bot_webhook_updates_total', ('result', 'rejected'), server.rejected)])
+
+        # Point Telegram at it
+        bot.set_webhook(WEBHOOK_URL, max_connections=40,
+                        api_kwargs={'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else None)
+
+        # Wait until told to stop
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *args: stop.set())
+        stop.wait()
+
+        server.stop()
+        updater.job_queue.stop()
+
+    else:
+        # Start the bot and wait for response
+        updater.start_polling()
+        updater.idle()
+
+    # Finish updates that were already queued and send their replies, then flush pending writes
+    scheduler.stop()
+    if outbox:
+        outbox.stop()
+    persistence.stop()
+    for backup in backups:
+        backup.stop()
+    db.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+import time
+from telegram import Update
+from telegram.ext import Dispatcher
+
+class Shard:
+    """A single worker thread with its own queue of updates"""
+    def __init__(self, number, slots=None):
+        self.number = number
+        self.queue = queue.Queue()
+
+        # Shared with the other shards to cap the number of pending updates
+        self.slots = slots
+
+        # Metrics
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.thread = threading.Thread(target=self._run, name=f"chat-shard-{number}", daemon=True)
+        self.thread.start()
+
+    def put(self, fn, args):
+        """Queue fn(*args), stamped with the time it was queued"""
+        self.queue.put((time.monotonic(), fn, args))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            queued, fn, args = item
+
+            # Record how long the update waited behind others on this shard
+            wait = time.monotonic() - queued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception("Unhandled error on shard %s", self.number)
+            finally:
+                if self.slots:
+                    self.slots.release()
+
+            self.processed += 1
+
+    def stats(self):
+        """Returns queue depth and wait time metrics of this shard"""
+        return {
+            'shard': self.number,
+            'depth': self.queue.qsize(),
+            'processed': self.processed,
+            'avg_wait': self.total_wait / self.processed if self.processed else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def stop(self):
+        """Finish the queued work, then stop the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+class ChatScheduler:
+    """Runs work on a pool of shards, keeping work for the same chat in order
+    Every chat always maps to the same shard, so its updates are handled one at
+    a time in the order they arrived while other shards carry on in parallel
+    With max_pending set, submit() blocks while that many updates are waiting or running"""
+    def __init__(self, shards=8, max_pending=None):
+        self.slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.shards = [Shard(i, self.slots) for i in range(shards)]
+
+    def submit(self, chat_id, fn, *args):
+        """Queue fn(*args) on the shard of chat_id"""
+        if self.slots:
+            self.slots.acquire()
+        self.shards[hash(chat_id) % len(self.shards)].put(fn, args)
+
+    def stats(self):
+        """Returns the metrics of every shard"""
+        return [shard.stats() for shard in self.shards]
+
+    def stop(self):
+        """Drain and stop every shard"""
+        for shard in self.shards:
+            shard.stop()
+
+class ShardedDispatcher(Dispatcher):
+    """Dispatcher that hands each update to a ChatScheduler instead of handling it inline"""
+    def __init__(self, *args, scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def process_update(self, update):
+        # Errors put on the update queue and updates without a chat or user
+        # (e.g. polls) have nothing to be ordered against
+        if isinstance(update, Update) and (update.effective_chat or update.effective_user):
+            key = update.effective_chat.id if update.effective_chat else update.effective_user.id
+            self.scheduler.submit(key, super().process_update, update)
+        else:
+            super().process_update(update)
+
+    def update_persistence(self, update=None):
+        # Without an update (after every job) PTB saves every user's data, which would also count
+        # as a use of each entry and keep them all in memory. Jobs that change a user's data save
+        # it themselves by passing the update
+        if update is not None:
+            super().update_persistence(update)
@@ -0,0 +1,58 @@
+"""Settling up a shared group ledger
+
+Every member of a group has a net balance: what they paid for the group minus
+their shares of what the group spent. Balances always add up to zero, and
+settling up means finding payments from the members below zero to the members
+above it that bring everyone back to zero.
+"""
+import heapq
+from collections import defaultdict
+
+def split(amount, members):
+    """Splits amount in cents evenly between members, as a list of (member, share in cents)
+    The cents that don't divide evenly go one each to the first members, so the shares always add up to amount"""
+    base, extra = divmod(amount, len(members))
+    return [(member, base + (1 if i < extra else 0)) for i, member in enumerate(members)]
+
+def simplify(balances):
+    """Returns the (debtor, creditor, amount in cents) payments that settle {member: net balance in cents}
+    A debtor and a creditor whose balances cancel out exactly pay each other first. The rest is
+    greedy: the largest debt pays off the largest credit, so every payment clears at least one
+    member and there are never more payments than members with a balance, less one"""
+    if sum(balances.values()) != 0:
+        raise ValueError("Balances don't add up to zero")
+
+    payments = []
+
+    # Pair off exact matches, which settle two members with a single payment
+    creditors = defaultdict(list)
+    for member, net in balances.items():
+        if net > 0:
+            creditors[net].append(member)
+
+    debtors = []
+    for member, net in balances.items():
+        if net < 0:
+            if creditors[-net]:
+                payments.append((member, creditors[-net].pop(), -net))
+            else:
+                debtors.append((net, member))
+
+    # Largest first: debts are negative already, credits are negated for the min-heap
+    credits = [(-net, member) for net, members in creditors.items() for member in members]
+    heapq.heapify(debtors)
+    heapq.heapify(credits)
+
+    while debtors:
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(credits)
+        amount = min(-debt, -credit)
+        payments.append((debtor, creditor, amount))
+
+        # Whoever isn't settled yet goes back in line with what is left
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+        if -credit > amount:
+            heapq.heappush(credits, (credit + amount, creditor))
+
+    return payments
@@ -0,0 +1,117 @@
+"""In-memory state with a bounded size
+
+A StateStore keeps at most maxsize entries and forgets the ones that have not
+been used for ttl seconds, least recently used first. Forgotten entries are
+built again by the loader on their next use.
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+class StateStore(defaultdict):
+    """defaultdict with a time to live per entry and a cap on the number of entries
+    Missing entries are built by loader(key), or start as an empty dict without one"""
+    def __init__(self, loader=None, ttl=None, maxsize=None):
+        super().__init__(dict)
+        self.loader = loader
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+
+        # Key -> time of last use, least recently used first
+        self.used = OrderedDict()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _touch(self, key, now):
+        self.used[key] = now
+        self.used.move_to_end(key)
+
+    def _evict(self, now):
+        """Drop expired entries, then the least recently used ones over the cap"""
+        while self.used:
+            key, last = next(iter(self.used.items()))
+            expired = self.ttl and now - last > self.ttl
+            full = self.maxsize and len(self.used) > self.maxsize
+            if not expired and not full:
+                break
+
+            del self.used[key]
+            dict.__delitem__(self, key)
+            self.evictions += 1
+
+    def __getitem__(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            if dict.__contains__(self, key):
+                self.hits += 1
+                self._touch(key, now)
+                return dict.__getitem__(self, key)
+            self.misses += 1
+
+        # Loading may query the database, so don't hold up other keys meanwhile
+        value = self.loader(key) if self.loader else self.default_factory()
+
+        with self.lock:
+            # Another thread may have loaded the same key first
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, value)
+            self._touch(key, now)
+            self._evict(now)
+            return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """The entry for key if it is held, without loading it"""
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            if not dict.__contains__(self, key):
+                return default
+            self.hits += 1
+            self._touch(key, now)
+            return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        with self.lock:
+            dict.__setitem__(self, key, value)
+            self._touch(key, now)
+            self._evict(now)
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+            del self.used[key]
+
+    def pop(self, key, *default):
+        with self.lock:
+            self.used.pop(key, None)
+            return dict.pop(self, key, *default)
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            self.used.clear()
+
+    def __copy__(self):
+        # Keep the loader and limits when the persistence machinery copies us
+        new = self.__class__(self.loader, self.ttl, self.maxsize)
+        for key, value in dict.items(self):
+            new[key] = value
+        return new
+
+    def stats(self):
+        """Returns the number of live entries and how often they were found"""
+        with self.lock:
+            self._evict(time.monotonic())
+
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
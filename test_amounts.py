@@ -0,0 +1,51 @@
+"""Amounts typed by users: what is accepted, and that what isn't never reaches the database
+
+Run with: python -m unittest
+"""
+import io
+import unittest
+import run
+from dbhelper import DBHelper
+
+class ParseAmountTest(unittest.TestCase):
+    def test_valid(self):
+        for amount, cents in [('12.04', 1204), ('+12.04', 1204), ('-12.04', -1204), ('.5', 50), ('0', 0), ('0.005', 1), ('-0.005', -1)]:
+            self.assertEqual(run.parseAmount(amount), cents, amount)
+            self.assertTrue(run.isValidAmount(amount), amount)
+
+    def test_invalid(self):
+        for amount in ['12.', '.', '', 'abc', '01', '1e5', '--5', '|5', '+|5']:
+            self.assertIsNone(run.parseAmount(amount), amount)
+            self.assertFalse(run.isValidAmount(amount), amount)
+
+    def test_too_large(self):
+        # Just below the cap still fits
+        self.assertEqual(run.parseAmount('90071992547409.91'), run.MAX_CENTS - 1)
+        for amount in ['90071992547409.92', '-90071992547409.92', '99999999999999999999', '1' * 40]:
+            self.assertIsNone(run.parseAmount(amount), amount)
+            self.assertFalse(run.isValidAmount(amount), amount)
+
+class RejectedAmountTest(unittest.TestCase):
+    def setUp(self):
+        self.db = run.db = DBHelper(':memory:')
+        self.db.setup()
+
+    def tearDown(self):
+        self.db.close()
+        run.db = None
+
+    def test_add(self):
+        self.assertEqual(run.quickAdd(1, ['Bob', '|5']), ('Bob', None, None))
+        self.assertEqual(run.quickAdd(1, ['Bob', '99999999999999999999']), ('Bob', None, None))
+
+        records, rejected = run.bulkAdd(1, ['Bob |5', 'Bob 99999999999999999999', 'Bob 5'])
+        self.assertEqual(records, [('Bob', 500, '')])
+        self.assertEqual(rejected, ['Bob |5', 'Bob 99999999999999999999'])
+
+    def test_import(self):
+        f = io.BytesIO(b'friend,amount\nBob,|5\nBob,99999999999999999999\nBob,5\n')
+        self.assertEqual(run.importCSV(1, f), (1, [2, 3]))
+        self.assertEqual(self.db.get_balance(1, 'Bob'), (500, 1))
+
+if __name__ == "__main__":
+    unittest.main()
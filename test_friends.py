@@ -0,0 +1,54 @@
+"""The friends of each user, as offered on the reply keyboard
+
+Run with: python -m unittest
+"""
+import unittest
+import run
+from dbhelper import DBHelper, MIGRATIONS
+
+class FriendsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DBHelper(':memory:')
+        self.db.setup()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_case(self):
+        # One friend however each name is capitalized, in any alphabet, shown as last used
+        self.db.add_records(1, [('Élodie', 100, ''), ('élodie', 200, ''), ('STRAßE', 300, ''), ('strasse', 400, ''), ('Bob', 500, ''), ('bob', 600, '')]).result()
+        self.assertEqual(self.db.check_friends(1), ['bob', 'strasse', 'élodie'])
+
+    def test_migration(self):
+        self.db.add_records(1, [('Élodie', 100, ''), ('élodie', 200, ''), ('Bob', 300, '')]).result()
+
+        # Keys as migration 3 made them, lowercased by SQLite
+        self.db.conn.execute("DELETE FROM friends")
+        self.db.conn.execute("INSERT INTO friends (owner, name_key, display_name, last_used) SELECT owner, lower(friend), friend, MAX(id) FROM records GROUP BY owner, lower(friend)")
+        self.db.conn.execute(f"PRAGMA user_version = {len(MIGRATIONS) - 1}")
+        self.db.conn.commit()
+        self.assertEqual(self.db.conn.execute("SELECT COUNT(*) FROM friends").fetchone()[0], 3)
+
+        self.db.migrate()
+        self.assertEqual(self.db.conn.execute("SELECT name_key, display_name FROM friends ORDER BY last_used").fetchall(),
+                         [('élodie', 'élodie'), ('bob', 'Bob')])
+
+    def test_search(self):
+        self.db.add_records(1, [('Élodie', 100, ''), ('Bob', 200, ''), ('STRAßE', 300, '')]).result()
+        for prefix in ['él', 'ÉL', 'Él']:
+            self.assertEqual(self.db.search_friends(1, prefix), [('Élodie', 100, 1)], prefix)
+        self.assertEqual(self.db.search_friends(1, 'strass'), [('STRAßE', 300, 1)])
+
+    def test_inline(self):
+        self.db.add_records(1, [('Élodie', 100, ''), ('Émile', 200, '')]).result()
+        run.db = self.db
+        self.addCleanup(setattr, run, 'db', None)
+
+        # The longer queries are answered from the cached answer to the first one, the same as the database would
+        self.assertEqual(run.inlineFriends(1, 'é'), [('Émile', 200, 1), ('Élodie', 100, 1)])
+        for query in ['él', 'ÉL', 'Élo']:
+            self.assertEqual(run.inlineFriends(1, query), self.db.search_friends(1, query), query)
+            self.assertEqual(run.inlineFriends(1, query), [('Élodie', 100, 1)], query)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Splitting expenses and settling up group ledgers
+
+Run with: python -m unittest
+"""
+import random
+import unittest
+import settle
+
+def ledger(rng, members, expenses):
+    """Net balances of members after random expenses, each split between a random subset of them"""
+    balances = dict.fromkeys(members, 0)
+    for _ in range(expenses):
+        payer = rng.choice(members)
+        amount = rng.randint(1, 100000)
+        balances[payer] += amount
+        for member, share in settle.split(amount, rng.sample(members, rng.randint(1, len(members)))):
+            balances[member] -= share
+    return balances
+
+class SplitTest(unittest.TestCase):
+    def test_shares_add_up(self):
+        rng = random.Random(0)
+        for _ in range(1000):
+            amount = rng.randint(0, 100000)
+            members = list(range(rng.randint(1, 50)))
+            shares = settle.split(amount, members)
+
+            self.assertEqual([member for member, share in shares], members)
+            self.assertEqual(sum(share for member, share in shares), amount)
+
+            # Even to the cent, the extra cents going to the first members
+            amounts = [share for member, share in shares]
+            self.assertLessEqual(max(amounts) - min(amounts), 1)
+            self.assertEqual(amounts, sorted(amounts, reverse=True))
+
+    def test_single_member(self):
+        self.assertEqual(settle.split(1001, ['a']), [('a', 1001)])
+
+    def test_uneven(self):
+        self.assertEqual(settle.split(1000, ['a', 'b', 'c']), [('a', 334), ('b', 333), ('c', 333)])
+
+class SimplifyTest(unittest.TestCase):
+    def assertSettles(self, balances):
+        """Assert that the payments settle everyone, with at most one less than there are members owing or owed"""
+        payments = settle.simplify(balances)
+
+        after = dict(balances)
+        for debtor, creditor, amount in payments:
+            self.assertGreater(amount, 0)
+            self.assertLess(balances[debtor], 0)
+            self.assertGreater(balances[creditor], 0)
+            after[debtor] += amount
+            after[creditor] -= amount
+
+        self.assertFalse(any(after.values()), "Payments don't settle everyone up")
+        self.assertLessEqual(len(payments), max(sum(1 for x in balances.values() if x) - 1, 0))
+        return payments
+
+    def test_random_ledgers(self):
+        rng = random.Random(0)
+        for _ in range(1000):
+            balances = ledger(rng, list(range(rng.randint(1, 50))), rng.randint(0, 200))
+
+            # Balances net to zero after every expense
+            self.assertEqual(sum(balances.values()), 0)
+            self.assertSettles(balances)
+
+    def test_empty(self):
+        self.assertEqual(settle.simplify({}), [])
+
+    def test_single_member(self):
+        self.assertEqual(settle.simplify({'a': 0}), [])
+        self.assertEqual(self.assertSettles(ledger(random.Random(0), ['a'], 10)), [])
+
+    def test_settled(self):
+        self.assertEqual(settle.simplify({'a': 0, 'b': 0, 'c': 0}), [])
+
+    def test_exact_matches(self):
+        # Every debt cancels a credit exactly, so each pair pays once
+        payments = self.assertSettles({'a': -5, 'b': -7, 'c': 7, 'd': 5})
+        self.assertEqual(sorted(payments), [('a', 'd', 5), ('b', 'c', 7)])
+
+    def test_unbalanced(self):
+        with self.assertRaises(ValueError):
+            settle.simplify({'a': 5, 'b': -4})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""Starting the bot: the updater, dispatcher and job queue main() builds, driven by a stub bot
+
+Run with: python -m unittest
+"""
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from telegram import Update
+from telegram.ext import ConversationHandler
+import run
+from benchmark import StubBot, message
+from dbhelper import DBHelper
+from persistence import SQLitePersistence
+from scheduler import ChatScheduler
+
+class StartupTest(unittest.TestCase):
+    """Builds what main() builds, on a database in a temporary directory"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = run.db = DBHelper(os.path.join(self.tmp.name, "test.sqlite"))
+        self.db.setup()
+
+        self.scheduler = ChatScheduler(2)
+        self.persistence = SQLitePersistence(self.db, flush_seconds=None)
+        self.bot = StubBot()
+        self.updater = run.buildUpdater(self.bot, self.scheduler, self.persistence)
+        self.dispatcher = self.updater.dispatcher
+
+        # Errors of handlers and jobs are otherwise only logged
+        self.errors = []
+        self.dispatcher.add_error_handler(lambda update, context: self.errors.append(context.error))
+
+    def tearDown(self):
+        self.updater.job_queue.stop()
+        self.scheduler.stop()
+        self.persistence.stop()
+        self.db.close()
+        run.db = None
+        self.tmp.cleanup()
+
+    def wait(self, condition, seconds=5):
+        """Wait until condition() holds, as work happens on other threads"""
+        deadline = time.monotonic() + seconds
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out waiting")
+            time.sleep(0.01)
+
+class BuildUpdaterTest(StartupTest):
+    def test_job_queue(self):
+        # The job queue is the dispatcher's, and knows which dispatcher to run its jobs with
+        self.assertIs(self.updater.job_queue, self.dispatcher.job_queue)
+        self.assertIs(self.updater.job_queue._dispatcher, self.dispatcher)
+
+        names = {job.name for job in self.updater.job_queue.jobs()}
+        self.assertEqual(names, {'reportScheduler', 'compactEvents', 'archiveRecords'})
+
+    def test_jobs_run(self):
+        # Run every job the way the job queue does, with the dispatcher it was given
+        self.updater.job_queue.start()
+        for job in self.updater.job_queue.jobs():
+            job.run(self.updater.job_queue._dispatcher)
+        self.assertEqual(self.errors, [])
+
+    def test_handlers(self):
+        self.assertTrue(self.dispatcher.handlers)
+        self.assertIs(self.dispatcher.persistence, self.persistence)
+
+class ConversationTimeoutTest(StartupTest):
+    def setUp(self):
+        patcher = mock.patch.object(run, 'CONVERSATION_TIMEOUT', 0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+        self.updater.job_queue.start()
+
+    def send(self, update_id, text):
+        """Hand a message from user 1 to the dispatcher and wait until the worker is done with it"""
+        self.dispatcher.process_update(Update.de_json(message(update_id, 1, text), self.bot))
+        self.wait(lambda: sum(x['processed'] for x in self.scheduler.stats()) == update_id)
+
+    def test_add(self):
+        conversations = next(handler for handlers in self.dispatcher.handlers.values() for handler in handlers
+                             if isinstance(handler, ConversationHandler) and handler.name == 'add').conversations
+
+        # Stop halfway through, with the friend already kept in user_data
+        self.send(1, '/add')
+        self.send(2, 'Bob')
+        self.assertIn((1, 1), conversations)
+        self.assertEqual(self.dispatcher.user_data[1], {'addFriend': 'Bob'})
+
+        self.wait(lambda: (1, 1) not in conversations)
+        self.wait(lambda: self.bot.calls[-1][1].get('text') == 'Cancelled request due to inactivity.')
+        self.assertEqual(self.dispatcher.user_data[1], {})
+        self.assertEqual(self.errors, [])
+
+class BackgroundJobTest(StartupTest):
+    """The jobs main() schedules run as soon as the job queue starts"""
+    def setUp(self):
+        super().setUp()
+        self.db.add_records(1, [('Bob', 500, 'lunch'), ('Alice', -250, 'taxi'), ('Bob', 125, '')]).result()
+        self.balances = [self.db.get_balance(1, friend) for friend in ('Bob', 'Alice')]
+
+        # Old enough to be compacted and archived
+        age = 400 * 86400
+        self.db.conn.execute("UPDATE records SET created = created - (?)", (age,))
+        self.db.conn.execute("UPDATE events SET created = created - (?)", (age,))
+        self.db.conn.commit()
+
+    def count(self, query):
+        return self.db.reader.execute(query).fetchone()[0]
+
+    def assertUnchanged(self):
+        self.assertEqual([self.db.get_balance(1, friend) for friend in ('Bob', 'Alice')], self.balances)
+        self.assertEqual(self.db.verify_balances(), [])
+        self.assertEqual(self.db.verify_events(), [])
+        self.assertEqual(self.db.verify_archive(), [])
+        self.assertEqual(self.errors, [])
+
+    def test_compact_events(self):
+        self.updater.job_queue.start()
+        self.wait(lambda: not self.count("SELECT COUNT(*) FROM events"))
+
+        self.assertEqual(self.count("SELECT COUNT(*) FROM snapshots WHERE owner = 1"), 2)
+        self.assertUnchanged()
+
+    def test_archive_records(self):
+        self.updater.job_queue.start()
+        self.wait(lambda: not self.count("SELECT COUNT(*) FROM records"))
+
+        self.assertEqual(len(self.db.check_history(1)), 3)
+        self.assertUnchanged()
+
+if __name__ == "__main__":
+    unittest.main()
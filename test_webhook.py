@@ -0,0 +1,55 @@
+"""Webhook server: what it answers to requests that aren't a well-formed update
+
+Run with: python -m unittest
+"""
+import http.client
+import json
+import unittest
+from queue import Queue
+from telegram.ext import Dispatcher
+from benchmark import StubBot, message
+from webhook import WebhookServer
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self):
+        self.updates = []
+        dispatcher = Dispatcher(StubBot(), Queue(), workers=0, use_context=True)
+        dispatcher.process_update = self.updates.append
+
+        self.server = WebhookServer(dispatcher, listen='127.0.0.1', port=0, workers=1)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self, body, headers):
+        """Post body with exactly the given headers, returning the status code"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        try:
+            conn.putrequest('POST', '/')
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.endheaders(body)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_update(self):
+        body = json.dumps(message(1, 1, '/start')).encode()
+        self.assertEqual(self.post(body, {'Content-Length': str(len(body))}), 200)
+
+    def test_not_an_update(self):
+        for body in [b'[1, 2]', b'{}', b'"text"', b'{', b'']:
+            self.assertEqual(self.post(body, {'Content-Length': str(len(body))}), 400, body)
+        self.assertEqual(self.server.accepted, 0)
+
+    def test_length(self):
+        # Answered without waiting on a body, which the client never sends
+        self.assertEqual(self.post(b'', {'Content-Length': '-1'}), 400)
+        self.assertEqual(self.post(b'', {'Content-Length': 'abc'}), 400)
+        self.assertEqual(self.post(b'', {}), 411)
+        self.assertEqual(self.post(b'', {'Content-Length': str(2 << 20)}), 413)
+        self.assertEqual(self.server.accepted, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+"""Webhook server: receives updates from Telegram over HTTP instead of long polling
+
+Usage: python webhook.py replay <payloads.json> [--url URL] [--secret SECRET]
+posts recorded updates (a JSON list, or one update per line) to a running server.
+"""
+import argparse
+import http.client
+import json
+import logging
+import queue
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+
+# Telegram sends this header back on every request when a secret is set on the webhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 20
+
+class WebhookServer:
+    """HTTP server that acknowledges updates straight away and processes them in the background
+    At most `workers` updates are processed at once and at most `max_pending` wait for
+    a worker. Beyond that the server answers 503 so Telegram backs off and retries later."""
+    def __init__(self, dispatcher, listen='0.0.0.0', port=8443, path='/', secret=None, workers=4, max_pending=100):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.updates = queue.Queue(max_pending)
+
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+
+        self.httpd = ThreadingHTTPServer((listen, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.threads = [threading.Thread(target=self._work, name=f"webhook-worker-{i}", daemon=True) for i in range(workers)]
+
+    def _handler(self):
+        """Build the request handler class bound to this server"""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # Only accept updates on the configured path, from Telegram
+                if self.path != server.path:
+                    return self.reply(404)
+                if server.secret and self.headers.get(SECRET_HEADER) != server.secret:
+                    return self.reply(403)
+
+                # Read and parse the update. Without a length, or with a negative one, reading the body
+                # would block until the client hangs up
+                if self.headers.get('Content-Length') is None:
+                    return self.reply(411)
+                try:
+                    length = int(self.headers['Content-Length'])
+                except ValueError:
+                    return self.reply(400)
+                if length < 0:
+                    return self.reply(400)
+                if length > MAX_BODY:
+                    return self.reply(413)
+                try:
+                    data = json.loads(self.rfile.read(length))
+
+                    # Valid JSON that isn't an update object, e.g. [1, 2] or one without update_id
+                    if not isinstance(data, dict):
+                        raise ValueError("Update is not an object")
+                    update = Update.de_json(data, server.dispatcher.bot)
+
+                    # An empty object parses to None, which would stop a worker
+                    if update is None:
+                        raise ValueError("Empty update")
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    return self.reply(400)
+
+                # Queue it, or push back if we are already too far behind
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    server.rejected += 1
+                    return self.reply(503)
+
+                server.accepted += 1
+                self.reply(200)
+
+            def reply(self, status):
+                self.send_response(status)
+                if status == 503:
+                    self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # Every update would otherwise be printed to stderr
+                logging.debug("Webhook: " + format, *args)
+
+        return Handler
+
+    def _work(self):
+        """Worker thread: process queued updates"""
+        while True:
+            update = self.updates.get()
+            if update is None:
+                break
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                logging.exception("Error processing webhook update")
+
+    @property
+    def port(self):
+        """Port the server is listening on, useful when started on port 0"""
+        return self.httpd.server_address[1]
+
+    def start(self):
+        """Start serving in background threads"""
+        for t in self.threads:
+            t.start()
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-server", daemon=True).start()
+
+    def stop(self):
+        """Stop accepting updates, then finish the ones already queued"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for t in self.threads:
+            self.updates.put(None)
+        for t in self.threads:
+            t.join()
+
+def replay(url, payloads, secret=None):
+    """Post recorded update payloads to a webhook, returning the status code of each
+    Updates that got no response at all, e.g. because the connection dropped, count as status 0"""
+    statuses = []
+
+    for payload in payloads:
+        request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+        if secret:
+            request.add_header(SECRET_HEADER, secret)
+
+        try:
+            with urllib.request.urlopen(request) as res:
+                statuses.append(res.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            logging.warning("No response to update %s: %s", payload.get('update_id') if isinstance(payload, dict) else None, e)
+            statuses.append(0)
+
+    return statuses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post recorded updates to a webhook server")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("payloads", help="JSON file with a list of updates, or one update per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/")
+    parser.add_argument("--secret")
+    opts = parser.parse_args()
+
+    with open(opts.payloads) as f:
+        text = f.read()
+    try:
+        payloads = json.loads(text)
+    except ValueError:
+        payloads = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    statuses = replay(opts.url, payloads, opts.secret)
+    for status in sorted(set(statuses)):
+        print(f"{status or 'no response'}: {statuses.count(status)}")